@@ -0,0 +1,447 @@
+"""Benchmark suite: the hot paths of every script, on synthetic data at
+several scales, with results kept as JSON to compare runs.
+
+Usage: python bench_suite.py [case ...] [--scales 1k 10k 100k]
+                             [--output FILE] [--compare BASELINE] [--tolerance 0.25]
+
+Each case builds its inputs first (not timed), then times its code path,
+taking the fastest of --repeat runs. Nothing touches the network: routes are
+queried from a StubClient in place of googlemaps.Client, and traffic feeds
+are fetched from a FeedServer on localhost. Scales are numbers of routes
+(or od-pairs, traffic segments, polylines); grids get finer with the scale,
+from 0.001 degrees down.
+
+Results are written to a JSON file with the run's commit, versions and
+machine, and for each case and scale the seconds taken and other figures.
+With --compare, every timing is checked against an earlier results file,
+and those more than --tolerance slower are flagged as regressions (and the
+exit status is 1).
+
+benchmarks.py checks the vectorized code against the original code; this
+suite only times the current code, to follow it from one change to the next.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import scipy
+import shapely
+
+import diff_segments
+import generate_od_pairs
+import get_routes
+import get_traffic_data
+import grid_creation
+import map_matching
+import merge_results
+import polyline
+from benchmarks import chicago_grid_args, exposure_routes, lattice_routes, random_route, \
+    traffic_network, write_merge_inputs, write_route_csv
+from traffic_segments import TrafficSegments
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA_DIR = SCRIPT_DIR + "/data/"
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000}
+GRID_SIZES = {1000: 0.001, 10000: 0.0005, 100000: 0.00025}  # degrees, by scale
+DEFAULT_SCALES = ["1k", "10k"]
+TOLERANCE = 0.25  # slowdown flagged as a regression
+NOISE_SEC = 0.02  # slowdowns smaller than this are never flagged
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow what the scripts print, so it is not part of the timings."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(run, repeat):
+    """(fastest seconds, last result) of repeat calls of run()."""
+
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with quiet():
+            result = run()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+class StubClient(object):
+    """Stands in for googlemaps.Client: directions() answers at once with
+    responses shaped like Google's, from a small pool of random routes."""
+
+    def __init__(self, seed=0, pool=64, alternatives=2, steps=10, points_per_step=8):
+        rng = np.random.default_rng(seed)
+        self.responses = []
+        for _ in range(pool):
+            response = []
+            for _ in range(alternatives):
+                points = random_route(rng, steps * points_per_step + 1)
+                response.append({'legs': [{
+                    'steps': [{'polyline': {'points': polyline.encode(
+                                   points[i * points_per_step:(i + 1) * points_per_step + 1])},
+                               'maneuver': "turn-left"} for i in range(steps)],
+                    'duration': {'value': int(rng.integers(300, 3600))},
+                    'distance': {'value': int(rng.integers(1000, 20000))}}]})
+            self.responses.append(response)
+        self.queries = 0
+
+    def directions(self, origin, destination, **kwargs):
+        self.queries += 1
+        return self.responses[hash((origin, destination)) % len(self.responses)]
+
+
+class FeedServer(object):
+    """Serves the City of Chicago's sra*.jsp traffic feeds from localhost."""
+
+    def __init__(self, roads):
+        """roads: Dict{str : List[int]} - segment IDs of each color"""
+
+        bodies = {f"/{get_traffic_data.FEED_PARAMS[color]}.jsp":
+                  json.dumps({"sra_" + color: [{"segmentid": str(road)} for road in ids]}).encode()
+                  for color, ids in roads.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = bodies.get(self.path)
+                self.send_response(200 if body else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_poly1(fn, num_segments, rng):
+    """A poly1.txt of num_segments random segments in Chicago."""
+
+    with open(fn, 'w') as fout:
+        fout.write("[\n{\n")
+        for segment_id in range(num_segments):
+            points = random_route(rng, int(rng.integers(2, 8)))
+            fout.write(f"{segment_id}:[[" +
+                       ",".join(f"{{x:{lon!r},y:{lat!r}}}" for lat, lon in points.tolist()) +
+                       "]],\n")
+        fout.write("}\n]\n")
+
+
+def case_decode(n, tmp_dir, repeat):
+    """polyline.decode_many on n polylines of 50 points."""
+
+    rng = np.random.default_rng(0)
+    strings = [polyline.encode(random_route(rng, 50)) for _ in range(n)]
+    seconds, (coords, _) = timed(lambda: polyline.decode_many(strings), repeat)
+    return {'seconds': seconds, 'points_per_sec': len(coords) / seconds}
+
+
+def case_grid(n, tmp_dir, repeat):
+    """grid_creation.grid_cells over Chicago, finer as the scale grows."""
+
+    args = chicago_grid_args(GRID_SIZES[n])
+    seconds, _ = timed(lambda: grid_creation.grid_cells(*args), repeat)
+    return {'seconds': seconds, 'grid_size': GRID_SIZES[n]}
+
+
+def case_od_pairs(n, tmp_dir, repeat):
+    """generate_od_pairs.odpairs_from_grid_centroids: n od-pairs from the
+    0.001 degree grid, read from GeoJSON and written to CSV."""
+
+    grid_fn = os.path.join(tmp_dir, "grid_0.001.geojson")
+    if not os.path.exists(grid_fn):
+        with quiet():
+            grid_creation.grid(grid_fn, *chicago_grid_args(0.001))
+    output_fn = os.path.join(tmp_dir, "od_pairs.csv")
+    seconds, _ = timed(lambda: generate_od_pairs.odpairs_from_grid_centroids(
+        grid_fn, output_fn, 0, 20, num_pairs=n, seed=0), repeat)
+    return {'seconds': seconds, 'pairs_per_sec': n / seconds}
+
+
+def case_parse_poly1(n, tmp_dir, repeat):
+    """Compiling a poly1.txt of n segments into a segment table, and loading
+    the table once compiled."""
+
+    poly1_fn = os.path.join(tmp_dir, f"poly1_{n}.txt")
+    write_poly1(poly1_fn, n, np.random.default_rng(0))
+
+    def compile_table():
+        table_dir = tempfile.mkdtemp(dir=tmp_dir)
+        return TrafficSegments.from_poly1(poly1_fn, table_dir)
+
+    seconds, segments = timed(compile_table, repeat)
+    table_dir = os.path.splitext(poly1_fn)[0] + ".table"
+    TrafficSegments.from_poly1(poly1_fn, table_dir)
+    load_sec, _ = timed(lambda: TrafficSegments.from_poly1(poly1_fn, table_dir), repeat)
+    return {'seconds': seconds, 'load_sec': load_sec, 'segments': len(segments)}
+
+
+def case_routes(n, tmp_dir, repeat):
+    """get_routes: n od-pairs queried by 4 workers from a StubClient (two
+    routes each), parsed, and written to a routes CSV."""
+
+    rng = np.random.default_rng(0)
+    od_pairs = [{'id': str(i), 'origin': tuple(rng.uniform(41.7, 42.0, 2)),
+                 'destination': tuple(rng.uniform(41.7, 42.0, 2))} for i in range(n)]
+    with open(os.path.join(tmp_dir, "key.txt"), 'w') as fout:
+        fout.write("stub\n")
+    os.makedirs(os.path.join(tmp_dir, "logs"), exist_ok=True)
+
+    def run():
+        api = get_routes.GoogleAPI(os.path.join(tmp_dir, "key.txt"), stop_at_api_limit=False,
+                                   output_num=2)
+        api.client = StubClient()
+        with open(os.path.join(tmp_dir, "routes.csv"), 'w') as fout:
+            writer = csv.DictWriter(fout, fieldnames=get_routes.ROUTE_FIELDS)
+            writer.writeheader()
+            for _, routes in get_routes.fetch_routes_concurrently(api, od_pairs, 4, qps=1e9):
+                writer.writerows(routes)
+        return api.queries_made
+
+    # GoogleAPI logs to logs/ under the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_dir)
+    try:
+        seconds, queries = timed(run, repeat)
+    finally:
+        os.chdir(cwd)
+    assert queries == n
+    return {'seconds': seconds, 'queries_per_sec': n / seconds}
+
+
+def case_traffic(n, tmp_dir, repeat):
+    """get_traffic_data: three feeds with n segments in all fetched from a
+    FeedServer, then joined with the segment table and written to CSV."""
+
+    rng = np.random.default_rng(0)
+    poly1_fn = os.path.join(tmp_dir, f"poly1_{n}.txt")
+    if not os.path.exists(poly1_fn):
+        write_poly1(poly1_fn, n, rng)
+    geo = TrafficSegments.from_poly1(poly1_fn, os.path.splitext(poly1_fn)[0] + ".table")
+    colors = rng.integers(0, len(get_traffic_data.COLORS), size=n)
+    roads = {color: np.flatnonzero(colors == i).tolist()
+             for i, color in enumerate(get_traffic_data.COLORS)}
+
+    with FeedServer(roads) as server:
+        seconds, (all_roads, _) = timed(
+            lambda: get_traffic_data.get_all_data(base_url=server.url, retries=0), repeat)
+    assert sum(len(ids) for ids in all_roads.values()) == n
+
+    write_sec, _ = timed(lambda: get_traffic_data.write_to_csv(
+        all_roads, geo, os.path.join(tmp_dir, "traffic.csv")), repeat)
+    return {'seconds': seconds, 'write_sec': write_sec}
+
+
+def case_segments(n, tmp_dir, repeat):
+    """diff_segments.get_segments and get_diffs on n pairs of lattice routes."""
+
+    routes1, routes2 = lattice_routes(np.random.default_rng(0), n)
+    route_ids = list(routes1)
+    segments_sec, segments = timed(lambda: diff_segments.get_segments([routes1, routes2]), repeat)
+    diffs_sec, _ = timed(lambda: diff_segments.get_diffs(routes1, routes2, route_ids), repeat)
+    return {'seconds': segments_sec + diffs_sec, 'get_segments_sec': segments_sec,
+            'get_diffs_sec': diffs_sec, 'segments': len(segments)}
+
+
+def case_weighted_line(n, tmp_dir, repeat, iterations=100):
+    """diff_segments.weighted_line end to end: n pairs of lattice routes read
+    from CSVs, bootstrapped 100 times, and written to GeoJSON."""
+
+    routes1, routes2 = lattice_routes(np.random.default_rng(0), n)
+    fns = [os.path.join(tmp_dir, f"routes{i}.csv") for i in (1, 2)]
+    for fn, routes in zip(fns, (routes1, routes2)):
+        write_route_csv(fn, routes)
+
+    output_fn = os.path.join(tmp_dir, "diffs.geojson")
+    seconds, _ = timed(lambda: diff_segments.weighted_line(*fns, output_fn, seed=0,
+                                                           iterations=iterations), repeat)
+    return {'seconds': seconds, 'routes_per_sec': n / seconds}
+
+
+def case_exposure(n, tmp_dir, repeat):
+    """map_matching: index 1300 traffic segments and match n routes of 200
+    points onto them."""
+
+    rng = np.random.default_rng(0)
+    geo = traffic_network(rng)
+    colors = {segment_id: get_traffic_data.COLORS[segment_id % 3] for segment_id in geo}
+    coords, offsets = exposure_routes(rng, geo, n)
+
+    index_sec, index = timed(lambda: map_matching.SegmentIndex(geo, colors), repeat)
+    seconds, _ = timed(lambda: map_matching.route_exposure(index, coords, offsets), repeat)
+    return {'seconds': seconds, 'index_sec': index_sec, 'routes_per_sec': n / seconds}
+
+
+def case_merge(n, tmp_dir, repeat):
+    """merge_results.main on n Google routes (some with alternatives) and
+    their GraphHopper routes, with three thresholds."""
+
+    write_merge_inputs(np.random.default_rng(0),
+                       os.path.join(tmp_dir, "chicago_routes_gmaps_fastest_matched.csv"),
+                       os.path.join(tmp_dir, "chicago_routes_gh_fastest.csv"), n)
+    argv = ["merge_results.py", "--data-dir", tmp_dir, "--threshold", "0.05", "0.1", "0.2"]
+
+    def run():
+        saved, sys.argv = sys.argv, argv
+        try:
+            merge_results.main()
+        finally:
+            sys.argv = saved
+
+    seconds, _ = timed(run, repeat)
+    return {'seconds': seconds, 'routes_per_sec': n / seconds}
+
+
+CASES = {
+    'decode': case_decode,
+    'grid': case_grid,
+    'od_pairs': case_od_pairs,
+    'parse_poly1': case_parse_poly1,
+    'routes': case_routes,
+    'traffic': case_traffic,
+    'segments': case_segments,
+    'weighted_line': case_weighted_line,
+    'exposure': case_exposure,
+    'merge': case_merge,
+}
+
+
+def run_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'shapely': shapely.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+def run_suite(cases, scales, repeat=None):
+    """Run cases at scales.
+
+    params
+     - cases: List[str] - names in CASES
+     - scales: List[str] - names in SCALES
+     - repeat: int - timed runs of each; 3 below 100k and 1 at 100k if None
+
+    return
+     - Dict{str : Dict{str : dict}} - results of each case at each scale
+    """
+
+    results = {}
+    for name in cases:
+        results[name] = {}
+        for scale in scales:
+            times = repeat or (1 if SCALES[scale] >= 100000 else 3)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                result = CASES[name](SCALES[scale], tmp_dir, times)
+            results[name][scale] = result
+            print(f"{name} {scale}: {result['seconds']:.3f} s" +
+                  "".join(f", {key} {value:.4g}" for key, value in result.items()
+                          if key != 'seconds'))
+    return results
+
+
+def is_timing(key):
+    # e.g. 'seconds' and 'load_sec', but not throughputs like 'pairs_per_sec'
+    return key == 'seconds' or (key.endswith('_sec') and not key.endswith('_per_sec'))
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Compare every timing with the same one in baseline.
+
+    return
+     - List[(str, str, str, float, float)] - case, scale, timing, baseline
+       and current seconds of each timing more than tolerance (and more
+       than NOISE_SEC) slower
+    """
+
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            before = baseline.get(name, {}).get(scale)
+            if before is None:
+                continue
+            for key, seconds in result.items():
+                if not is_timing(key) or key not in before:
+                    continue
+                ratio = seconds / before[key] if before[key] > 0 else np.inf
+                slower = ratio > 1 + tolerance and seconds - before[key] > NOISE_SEC
+                flag = "REGRESSION" if slower else ""
+                print(f"{name:>14} {scale:>4} {key:>16}: {before[key]:9.3f} s -> " +
+                      f"{seconds:9.3f} s ({ratio:5.2f}x) {flag}")
+                if flag:
+                    regressions.append((name, scale, key, before[key], seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs="*",
+                        help="Cases to run; all if none are given.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=DEFAULT_SCALES,
+                        help="Data sizes to run each case at.")
+    parser.add_argument("--repeat", type=int, default=None,
+                        help="Timed runs of each case, the fastest kept (default 3, 1 at 100k).")
+    parser.add_argument("--output", default=None,
+                        help="Results JSON; data/bench_results/<time>.json if not given.")
+    parser.add_argument("--compare", default=None,
+                        help="Earlier results JSON to check this run against.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Slowdown (0.25 = 25%%) past which a timing is a regression.")
+    args = parser.parse_args()
+    for name in args.cases:
+        if name not in CASES:
+            parser.error(f"unknown benchmark {name}; choose from {', '.join(sorted(CASES))}")
+
+    results = {'meta': run_metadata(),
+               'results': run_suite(args.cases or list(CASES), args.scales, args.repeat)}
+
+    output_fn = args.output or os.path.join(DATA_DIR, "bench_results",
+                                            time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_fn)), exist_ok=True)
+    with open(output_fn, 'w') as fout:
+        json.dump(results, fout, indent=1)
+    print(f"Results written to {output_fn}")
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        print(f"Compared with {args.compare} (commit {baseline['meta'].get('commit')}):")
+        regressions = compare(results['results'], baseline['results'], args.tolerance)
+        print(f"{len(regressions)} regressions past {args.tolerance:.0%}.")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
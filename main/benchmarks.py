@@ -0,0 +1,1001 @@
+"""Correctness checks and microbenchmarks for the hot paths in main/.
+
+Usage: python benchmarks.py [name ...]
+With no names, every benchmark is run.
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from math import ceil, floor
+
+import numpy as np
+import shapely
+from geojson import Polygon, LineString, Feature, FeatureCollection, dump
+from scipy import sparse
+from shapely.geometry import shape, Point
+
+import diff_segments
+import generate_od_pairs
+import get_traffic_data
+import grid_creation
+import map_matching
+import merge_results
+import polyline
+import route_store
+from diff_histograms import DiffLists
+from route_set import RouteSet, pair_alternatives, projector
+from segment_intern import SegmentTable
+from simplify_routes import simplify_routes
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA_DIR = SCRIPT_DIR + "/data/"
+
+
+def reference_decode(point_str):
+    """The original pure Python GoogleAPI.decode, kept to check against.
+
+    Code taken from: https://gist.github.com/signed0/2031157
+    """
+
+    # sone coordinate offset is represented by 4 to 5 binary chunks
+    coord_chunks = [[]]
+    for char in point_str:
+
+        # convert each character to decimal from ascii
+        value = ord(char) - 63
+
+        # values that have a chunk following have an extra 1 on the left
+        split_after = not (value & 0x20)
+        value &= 0x1F
+
+        coord_chunks[-1].append(value)
+
+        if split_after:
+            coord_chunks.append([])
+
+    del coord_chunks[-1]
+
+    coords = []
+
+    for coord_chunk in coord_chunks:
+        coord = 0
+
+        for i, chunk in enumerate(coord_chunk):
+            coord |= chunk << (i * 5)
+
+        #there is a 1 on the right if the coord is negative
+        if coord & 0x1:
+            coord = ~coord #invert
+        coord >>= 1
+        coord /= 100000.0
+
+        coords.append(coord)
+
+    # convert the 1 dimensional list to a 2 dimensional list and offsets to
+    # actual values
+    points = []
+    prev_x = 0
+    prev_y = 0
+    for i in range(0, len(coords) - 1, 2):
+        if coords[i] == 0 and coords[i + 1] == 0:
+            continue
+
+        prev_x += coords[i + 1]
+        prev_y += coords[i]
+        # a round to 6 digits ensures that the floats are the same as when
+        # they were encoded
+        points.append((round(prev_y, 6), round(prev_x, 6)))
+
+    return points
+
+
+def random_route(rng, num_points):
+    """Random walk of (lat, lon) points around Chicago, 5 decimal places."""
+
+    steps = rng.integers(-300, 301, size=(num_points, 2))
+    # some repeated points, which the decoder skips
+    steps[rng.random(num_points) < 0.05] = 0
+    start = np.array([[4187000, -8762000]])
+    return (start + np.cumsum(steps, axis=0)) / 100000.0
+
+
+def random_polylines(rng, count):
+    """Encoded random walks, plus some arbitrary and truncated strings."""
+
+    point_strs = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.8:
+            point_strs.append(polyline.encode(random_route(rng, int(rng.integers(0, 60)))))
+        elif kind < 0.9:
+            chars = rng.integers(63, 127, size=int(rng.integers(0, 40)))
+            point_strs.append(bytes(chars.astype(np.uint8)).decode("ascii"))
+        else:
+            point_str = polyline.encode(random_route(rng, int(rng.integers(1, 20))))
+            point_strs.append(point_str[:int(rng.integers(0, len(point_str) + 1))])
+    return point_strs
+
+
+def check_decode(trials=20000, seed=0):
+    """Check polyline.decode against the original decoder, bit for bit."""
+
+    rng = np.random.default_rng(seed)
+    point_strs = random_polylines(rng, trials)
+
+    # arbitrary strings can decode to values far outside lat/lon range,
+    # where the original decoder's float sums lose precision
+    expected = [reference_decode(point_str) for point_str in point_strs]
+    in_range = [all(abs(lat) <= 180 and abs(lon) <= 180 for lat, lon in points)
+                for points in expected]
+    point_strs = [point_str for point_str, ok in zip(point_strs, in_range) if ok]
+    expected = [points for points, ok in zip(expected, in_range) if ok]
+    for point_str, points in zip(point_strs, expected):
+        decoded = [tuple(point) for point in polyline.decode(point_str).tolist()]
+        assert decoded == points, point_str
+
+    coords, offsets = polyline.decode_many(point_strs)
+    for i, points in enumerate(expected):
+        assert coords[offsets[i]:offsets[i + 1]].tolist() == [list(point) for point in points]
+
+    for _ in range(1000):
+        route = random_route(rng, int(rng.integers(1, 60)))
+        route = route[np.concatenate(([True], (np.diff(route, axis=0) != 0).any(axis=1)))]
+        assert np.array_equal(polyline.decode(polyline.encode(route)), route)
+
+    return {'polylines_checked': len(point_strs)}
+
+
+def bench_decode(count=5000, seed=0):
+    """Time the original decoder against the vectorized ones."""
+
+    rng = np.random.default_rng(seed)
+    point_strs = [polyline.encode(random_route(rng, 40)) for _ in range(count)]
+
+    start = time.perf_counter()
+    for point_str in point_strs:
+        reference_decode(point_str)
+    reference_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for point_str in point_strs:
+        polyline.decode(point_str)
+    single_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    polyline.decode_many(point_strs)
+    batch_sec = time.perf_counter() - start
+
+    routes = [polyline.decode(point_str) for point_str in point_strs]
+    start = time.perf_counter()
+    for route in routes:
+        polyline.encode(route)
+    encode_sec = time.perf_counter() - start
+
+    return {'polylines': count, 'reference_sec': reference_sec,
+            'decode_sec': single_sec, 'decode_many_sec': batch_sec,
+            'encode_sec': encode_sec,
+            'decode_many_speedup': reference_sec / batch_sec}
+
+
+def reference_grid_features(xmin, xmax, ymin, ymax, grid_height, grid_width, boundary):
+    """The original grid_creation.grid loop, kept to check against.
+
+    Corners and IDs follow the cell size, as grid_creation does now; the
+    original always used 0.001 degree corners and IDs.
+    """
+
+    xmin, xmax, ymin, ymax = float(xmin), float(xmax), float(ymin), float(ymax)
+    grid_width, grid_height = float(grid_width), float(grid_height)
+
+    rows = ceil((ymax - ymin) / grid_height)
+    cols = ceil((xmax - xmin) / grid_width)
+    scale = grid_creation.id_scale(grid_height, grid_width)
+
+    countcols = 0
+    features = []
+    while countcols < cols:
+        grid_x_left = xmin + (countcols * grid_width)
+        countcols += 1
+
+        countrows = 0
+        while countrows < rows:
+            grid_y_bottom = ymin + (countrows * grid_height)
+            countrows += 1
+
+            bottomleftcorner = (grid_x_left, grid_y_bottom)
+            coords = [bottomleftcorner]
+            for i in grid_creation.corner_offsets(grid_height, grid_width):
+                coords.append((bottomleftcorner[0] + i[1], bottomleftcorner[1] + i[0]))
+
+            intersects = False
+            for corner in coords[1:]:
+                if boundary.contains(Point(corner)):
+                    intersects = True
+                    break
+
+            if intersects:
+                properties = {'rid': round(grid_y_bottom * 10**scale),
+                              'cid': round(grid_x_left * 10**scale)}
+                features.append(Feature(geometry=Polygon([coords]), properties=properties))
+
+    return features
+
+
+def chicago_grid_args(resolution):
+    """grid_features arguments for the Chicago boundary, as grid_creation.main sets them up."""
+
+    with open(DATA_DIR + "chicago_boundary.geojson", 'r', encoding='utf8') as fin:
+        feature = json.load(fin)
+
+    bb = feature["bbox"]
+    xmin = floor(bb[0] * 10**grid_creation.SCALE) / 10**grid_creation.SCALE
+    ymax = ceil(bb[3] * 10**grid_creation.SCALE) / 10**grid_creation.SCALE
+    return xmin, bb[2], bb[1], ymax, resolution, resolution, shape(feature["geometry"])
+
+
+def bench_grid(resolutions=(0.001, 0.0005)):
+    """Time the original grid loop against the vectorized one on Chicago.
+
+    Both must write the same GeoJSON, byte for byte.
+    """
+
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for resolution in resolutions:
+            args = chicago_grid_args(resolution)
+
+            start = time.perf_counter()
+            expected = reference_grid_features(*args)
+            with open(os.path.join(tmp_dir, "reference.geojson"), 'w') as fout:
+                dump(FeatureCollection(expected), fout)
+            reference_sec = time.perf_counter() - start
+
+            start = time.perf_counter()
+            grid_creation.grid_cells(*args)
+            cells_sec = time.perf_counter() - start
+
+            start = time.perf_counter()
+            quad_grid = grid_creation.grid(os.path.join(tmp_dir, "grid.geojson"), *args)
+            vectorized_sec = time.perf_counter() - start
+
+            with open(os.path.join(tmp_dir, "reference.geojson")) as fin:
+                expected = fin.read()
+            with open(os.path.join(tmp_dir, "grid.geojson")) as fin:
+                assert fin.read() == expected
+
+            result[f'{resolution}_cells'] = len(quad_grid)
+            result[f'{resolution}_reference_sec'] = reference_sec
+            result[f'{resolution}_cells_sec'] = cells_sec
+            result[f'{resolution}_vectorized_sec'] = vectorized_sec
+            result[f'{resolution}_speedup'] = reference_sec / vectorized_sec
+    return result
+
+
+def bench_od_pairs(num_pairs=1000000, checked=20000, seed=0):
+    """Check vectorized Vincenty against geopy, and time batched od-pair sampling."""
+
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(41.64, 42.02, size=(2, checked))
+    lon = rng.uniform(-87.94, -87.52, size=(2, checked))
+
+    start = time.perf_counter()
+    expected = [generate_od_pairs.get_distance((lat1, lon1), (lat2, lon2))
+                for lat1, lon1, lat2, lon2 in zip(lat[0], lon[0], lat[1], lon[1])]
+    geopy_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dist_km = generate_od_pairs.vincenty_km(lat[0], lon[0], lat[1], lon[1])
+    vincenty_sec = time.perf_counter() - start
+    max_error_km = float(np.abs(dist_km - expected).max())
+    assert max_error_km < 1e-9
+
+    # sample from a 1 km grid's worth of centroids
+    lat, lon = np.meshgrid(np.arange(41.64, 42.02, 0.009), np.arange(-87.94, -87.52, 0.012))
+    lat, lon = lat.ravel(), lon.ravel()
+    start = time.perf_counter()
+    generate_od_pairs.sample_od_pairs(lat, lon, num_pairs, 2, 20, rng)
+    sample_sec = time.perf_counter() - start
+
+    # a narrow distance window, by rejection and by filling it directly
+    narrow = num_pairs // 10
+    start = time.perf_counter()
+    generate_od_pairs.sample_od_pairs(lat, lon, narrow, 10, 10.1, rng)
+    narrow_reject_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generate_od_pairs.stratified_od_pairs(lat, lon, np.array([10, 10.1]), [narrow], rng)
+    narrow_stratified_sec = time.perf_counter() - start
+
+    return {'pairs_checked': checked, 'max_error_km': max_error_km,
+            'geopy_sec': geopy_sec, 'vincenty_sec': vincenty_sec,
+            'vincenty_speedup': geopy_sec / vincenty_sec,
+            'pairs_sampled': num_pairs, 'sample_sec': sample_sec,
+            'narrow_pairs': narrow, 'narrow_reject_sec': narrow_reject_sec,
+            'narrow_stratified_sec': narrow_stratified_sec}
+
+
+def lattice_routes(rng, num_routes, num_steps=60, step=0.001, size=40):
+    """Pairs of random routes along a size x size street lattice in Chicago.
+
+    The second route of a pair follows the first and then wanders off, so
+    the two sets share most segments, like the routes diff_segments compares.
+
+    return
+     - (routes1, routes2): Dict{str : List[(lon, lat)]} with the same IDs
+    """
+
+    moves = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]])
+    routes1, routes2 = {}, {}
+    for n in range(num_routes):
+        start = rng.integers(0, size, size=2)
+        walk1 = start + np.cumsum(moves[rng.integers(0, 4, size=num_steps)], axis=0)
+        split = int(rng.integers(0, num_steps))
+        walk2 = np.concatenate((walk1[:split], walk1[split - 1 if split else 0] +
+                                np.cumsum(moves[rng.integers(0, 4, size=num_steps - split)],
+                                          axis=0)))
+        for walk, routes in ((walk1, routes1), (walk2, routes2)):
+            points = np.round(np.array([-87.7, 41.85]) + np.clip(walk, 0, size) * step, 6)
+            routes[f"route{n}"] = [tuple(point) for point in points.tolist()]
+    return routes1, routes2
+
+
+def reference_bootstrap(diff_matrix, weights, block_size=None):
+    """Difference in segment use for every resample, as one matrix product,
+    kept whole rather than summed up chunk by chunk as bootstrap_parallel
+    does, to check against.
+
+    Row i of weights @ diff_matrix is what get_diffs gives for resample i.
+    It is computed a block of segments at a time to bound memory.
+
+    params
+     - diff_matrix: sparse (routes, segments) - times the first route of
+       each pair uses each segment, minus times the second one does
+     - weights: int64 array (iterations, routes) - see
+       diff_segments.bootstrap_weights
+     - block_size: int - segments per block; by default enough for about
+       8 million values per block
+
+    return
+     - int64 array (segments, iterations)
+    """
+
+    num_segments = diff_matrix.shape[1]
+    iterations = len(weights)
+    if block_size is None:
+        block_size = max(1, 8000000 // max(iterations, 1))
+
+    diff_by_segment = sparse.csr_matrix(diff_matrix.T)
+    weights_by_route = np.ascontiguousarray(weights.T)
+    diffs = np.empty((num_segments, iterations), dtype=np.int64)
+    for start in range(0, num_segments, block_size):
+        end = min(start + block_size, num_segments)
+        diffs[start:end] = diff_by_segment[start:end] @ weights_by_route
+
+    return diffs
+
+
+def bench_bootstrap(num_routes=2000, iterations=100, seed=0):
+    """Check the sparse bootstrap against the original loop on the same
+    resamples, and time both."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2 = lattice_routes(rng, num_routes)
+    route_ids = list(routes1)
+    all_segments = diff_segments.get_segments([routes1, routes2])
+
+    samples = list(diff_segments.legacy_samples(route_ids, iterations, random.Random(seed)))
+    positions = {route_id: i for i, route_id in enumerate(route_ids)}
+    weights = np.array([np.bincount([positions[route_id] for route_id in sampled_ids],
+                                    minlength=len(route_ids)) for sampled_ids in samples])
+
+    start = time.perf_counter()
+    expected = diff_segments.bootstrap_legacy(routes1, routes2, all_segments, samples,
+                                              DiffLists(len(all_segments)))
+    legacy_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = SegmentTable()
+    segments1, offsets1 = table.intern([routes1[route_id] for route_id in route_ids])
+    segments2, offsets2 = table.intern([routes2[route_id] for route_id in route_ids])
+    columns = np.arange(len(table))
+    diff_matrix = diff_segments.incidence_matrix(segments1, offsets1, columns) - \
+        diff_segments.incidence_matrix(segments2, offsets2, columns)
+    diffs = reference_bootstrap(diff_matrix, weights)
+    sparse_sec = time.perf_counter() - start
+
+    assert np.array_equal(np.sort(diffs, axis=1), expected.sorted_diffs())
+
+    # streaming the resamples through histograms, in any number of
+    # processes, must give what sorting all of them does
+    expected = diff_segments.summarize(
+        diff_segments.bootstrap_parallel(diff_matrix, iterations, seed, 1, DiffLists), 0.01)
+    for workers in (1, 2):
+        start = time.perf_counter()
+        histograms = diff_segments.bootstrap_parallel(diff_matrix, iterations, seed, workers)
+        parallel_sec = time.perf_counter() - start
+        assert diff_segments.summarize(histograms, 0.01) == expected
+
+    return {'routes': num_routes, 'segments': len(all_segments), 'iterations': iterations,
+            'legacy_sec': legacy_sec, 'sparse_sec': sparse_sec,
+            'speedup': legacy_sec / sparse_sec, 'parallel_2_workers_sec': parallel_sec}
+
+
+def bench_summary(num_routes=5000, iterations=(500, 2000, 10000), seed=0):
+    """Peak memory and time of summing up the resamples in histograms against
+    keeping and sorting all of them, as iterations grow."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2 = lattice_routes(rng, num_routes)
+    route_ids = list(routes1)
+    table = SegmentTable()
+    segments1, offsets1 = table.intern([routes1[route_id] for route_id in route_ids])
+    segments2, offsets2 = table.intern([routes2[route_id] for route_id in route_ids])
+    columns = np.arange(len(table))
+    diff_matrix = diff_segments.incidence_matrix(segments1, offsets1, columns) - \
+        diff_segments.incidence_matrix(segments2, offsets2, columns)
+
+    results = {'routes': num_routes, 'segments': len(table)}
+    for num_iterations in iterations:
+        stats = {}
+        for summary, accumulator in sorted(diff_segments.SUMMARIES.items()):
+            tracemalloc.start()
+            start = time.perf_counter()
+            diffs = diff_segments.bootstrap_parallel(diff_matrix, num_iterations, seed, 1,
+                                                     accumulator)
+            stats[summary] = diff_segments.summarize(diffs, 0.01)
+            results[f'{summary}_{num_iterations}_sec'] = time.perf_counter() - start
+            results[f'{summary}_{num_iterations}_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            del diffs
+        assert stats['histogram'] == stats['sort']
+
+    return results
+
+
+def provider_routes(rng, routes, points_per_step=5, jitter=2e-6):
+    """routes as another router might give them: extra vertices along each
+    segment, and every vertex a little off."""
+
+    noisy = {}
+    for route_id, route in routes.items():
+        route = np.array(route)
+        fractions = np.arange(points_per_step) / points_per_step
+        dense = (route[:-1, None] + fractions[:, None] * (route[1:] - route[:-1])[:, None]).reshape(-1, 2)
+        dense = np.concatenate((dense, route[-1:]))
+        noisy[route_id] = dense + rng.uniform(-jitter, jitter, size=dense.shape)
+    return noisy
+
+
+def bootstrap_seconds(route_sets, seed, iterations=100):
+    """Time interning two sets of routes and bootstrapping their differences."""
+
+    start = time.perf_counter()
+    route_ids = list(route_sets[0])
+    table = SegmentTable()
+    segments1, offsets1 = table.intern([route_sets[0][route_id] for route_id in route_ids])
+    segments2, offsets2 = table.intern([route_sets[1][route_id] for route_id in route_ids])
+    columns = np.arange(len(table))
+    diff_matrix = diff_segments.incidence_matrix(segments1, offsets1, columns) - \
+        diff_segments.incidence_matrix(segments2, offsets2, columns)
+    diff_segments.bootstrap_parallel(diff_matrix, iterations, seed, 1)
+    return time.perf_counter() - start
+
+
+def bench_simplify(num_routes=10000, seed=0):
+    """Segments and time saved by simplify_routes on lattice routes given
+    extra, slightly moved vertices."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2 = lattice_routes(rng, num_routes, size=200)
+    dense = [provider_routes(rng, routes, jitter=0) for routes in (routes1, routes2)]
+    noisy = [provider_routes(rng, routes) for routes in (routes1, routes2)]
+
+    unchanged, _ = simplify_routes(noisy, verbose=False)
+    assert all(np.array_equal(unchanged[i][route_id], noisy[i][route_id])
+               for i in range(2) for route_id in noisy[i])
+
+    # vectorized Douglas-Peucker is shapely's, one route at a time
+    simplified, _ = simplify_routes(noisy, tolerance=1e-5, verbose=False)
+    for route_id in list(noisy[0])[:200]:
+        expected = shapely.get_coordinates(
+            shapely.simplify(shapely.linestrings(noisy[0][route_id]), 1e-5, preserve_topology=False))
+        assert np.array_equal(simplified[0][route_id], expected)
+
+    # snapping the noise away, to a grid or to the noiseless points, must
+    # leave exactly the segments of the noiseless routes
+    _, dense_stats = simplify_routes(dense, grid_size=1e-4, verbose=False)
+    snapped, stats = simplify_routes(noisy, grid_size=1e-4, verbose=False)
+    assert stats['segments_after'] == dense_stats['segments_after']
+
+    table = SegmentTable()
+    for routes in dense:
+        table.intern(list(routes.values()))
+    _, node_stats = simplify_routes(noisy, nodes=table.points, node_tolerance=1e-5, verbose=False)
+    assert node_stats['segments_after'] == dense_stats['segments_after']
+
+    # Douglas-Peucker drops the points in between, but its long straight
+    # segments end wherever each route turns, so fewer of them are shared
+    simplified, dp_stats = simplify_routes(noisy, tolerance=1e-5, grid_size=1e-4, verbose=False)
+
+    return {'routes': 2 * num_routes, 'points': stats['points_before'],
+            'segments_before': stats['segments_before'],
+            'snap_grid_segments': stats['segments_after'], 'snap_grid_sec': stats['seconds'],
+            'snap_nodes_segments': node_stats['segments_after'],
+            'snap_nodes_sec': node_stats['seconds'],
+            'simplify_snap_points': dp_stats['points_after'],
+            'simplify_snap_segments': dp_stats['segments_after'],
+            'simplify_snap_sec': dp_stats['seconds'],
+            'raw_bootstrap_sec': bootstrap_seconds(noisy, seed),
+            'snap_grid_bootstrap_sec': bootstrap_seconds(snapped, seed),
+            'simplify_snap_bootstrap_sec': bootstrap_seconds(simplified, seed)}
+
+
+def write_route_csv(fn, routes):
+    """Write (lon, lat) routes to a routes CSV like get_routes makes."""
+
+    rows = ({'ID': route_id, 'name': "main", 'polyline_points': np.array(route)[:, ::-1],
+             'total_time_in_sec': 0} for route_id, route in routes.items())
+    route_store.write_routes(fn, route_store.ROUTE_FIELDS, rows)
+
+
+def read_diffs(fn):
+    with open(fn) as fin:
+        return {tuple(map(tuple, feature['geometry']['coordinates'])): feature['properties']
+                for feature in json.load(fin)['features']}
+
+
+def bench_contrasts(num_routes=2000, iterations=100, seed=0):
+    """All pairs of four route sets, compared one run at a time and in one
+    pass; every pair must come out the same both ways."""
+
+    rng = np.random.default_rng(seed)
+    route_sets = lattice_routes(rng, num_routes) + lattice_routes(rng, num_routes)
+    names = ["set1", "set2", "set3", "set4"]
+    pairs = [(name1, name2) for i, name1 in enumerate(names) for name2 in names[i + 1:]]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        route_files = {name: os.path.join(tmp_dir, f"{name}.csv") for name in names}
+        for name, routes in zip(names, route_sets):
+            write_route_csv(route_files[name], routes)
+
+        start = time.perf_counter()
+        for name1, name2 in pairs:
+            diff_segments.weighted_line(route_files[name1], route_files[name2],
+                                        os.path.join(tmp_dir, f"{name1}_{name2}.geojson"),
+                                        seed=seed, iterations=iterations)
+        pairwise_sec = time.perf_counter() - start
+
+        outputs = {pair: os.path.join(tmp_dir, "all_{}_{}.geojson".format(*pair)) for pair in pairs}
+        start = time.perf_counter()
+        diff_segments.weighted_lines(route_files, outputs, seed=seed, iterations=iterations)
+        one_pass_sec = time.perf_counter() - start
+
+        for (name1, name2), fn in outputs.items():
+            assert read_diffs(fn) == read_diffs(os.path.join(tmp_dir, f"{name1}_{name2}.geojson"))
+
+    return {'routes': num_routes, 'pairs': len(pairs), 'iterations': iterations,
+            'pairwise_sec': pairwise_sec, 'one_pass_sec': one_pass_sec}
+
+
+def reference_write_diffs(output_geojson, segments, stats):
+    """diff_segments' original output: a geojson.Feature per segment, then
+    geojson.dump of the whole FeatureCollection."""
+
+    output = []
+    for i, segment in enumerate(segments.tolist()):
+        output.append(Feature(geometry=LineString(segment),
+                              properties={name: stats[name][i] for name in
+                                          ('lower', 'upper', 'median', 'mean', 'significant')}))
+    with open(output_geojson, 'w') as fout:
+        dump(FeatureCollection(output), fout)
+
+
+def bench_output(num_routes=20000, seed=0):
+    """Time and peak memory of writing diff_segments output: the original
+    geojson.dump, streamed GeoJSON (which must be the same file) and GeoPackage."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2 = lattice_routes(rng, num_routes, size=400)
+    table = SegmentTable()
+    for routes in (routes1, routes2):
+        table.intern([np.array(route) for route in routes.values()])
+    segments = table.coords(np.arange(len(table)))
+    lower = rng.integers(-20, 5, size=len(segments))
+    upper = lower + rng.integers(0, 20, size=len(segments))
+    stats = diff_segments.summary(lower, upper, (lower + upper) // 2, (lower + upper) / 2)
+
+    results = {'segments': len(segments)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writers = [('dump', 'geojson', reference_write_diffs),
+                   ('stream', 'geojson', diff_segments.write_diffs),
+                   ('gpkg', 'gpkg', diff_segments.write_diffs)]
+        for name, extension, write in writers:
+            fn = os.path.join(tmp_dir, f"{name}.{extension}")
+            tracemalloc.start()
+            start = time.perf_counter()
+            write(fn, segments, stats)
+            results[f'{name}_sec'] = time.perf_counter() - start
+            results[f'{name}_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            results[f'{name}_mb'] = os.path.getsize(fn) / 2**20
+
+        with open(os.path.join(tmp_dir, "dump.geojson"), 'rb') as f1, \
+                open(os.path.join(tmp_dir, "stream.geojson"), 'rb') as f2:
+            assert f1.read() == f2.read()
+
+    return results
+
+
+def write_merge_inputs(rng, gmaps_csv, gh_csv, num_routes):
+    """Google and GraphHopper routes CSVs with the fields merge_results reads;
+    some routes have alternatives, and GraphHopper misses some routes."""
+
+    with open(gmaps_csv, 'w') as fgm, open(gh_csv, 'w') as fgh:
+        gm_writer = csv.DictWriter(fgm, fieldnames=merge_results.EXPECTED_HEADER[:7])
+        gh_writer = csv.DictWriter(fgh, fieldnames=merge_results.EXPECTED_HEADER)
+        gm_writer.writeheader()
+        gh_writer.writeheader()
+        for n in range(num_routes):
+            distances = rng.uniform(1000, 20000, size=int(rng.integers(1, 4)))
+            for i, distance in enumerate(distances):
+                name = "main" if i == 0 else f"alternative {i}"
+                gm_writer.writerow({'ID': f"route{n}", 'name': name,
+                                    'polyline_points': "[(41.85, -87.7), (41.86, -87.7)]",
+                                    'total_time_in_sec': 600.0, 'total_distance_in_meters': distance,
+                                    'number_of_steps': 4, 'maneuvers': "['turn-left']"})
+            if rng.random() < 0.1:
+                continue
+            row = {'ID': f"route{n}", 'name': "main", 'polyline_points': "[]",
+                   'total_time_in_sec': 600.0,
+                   'total_distance_in_meters': distances[0] * rng.uniform(0.8, 1.2),
+                   'number_of_steps': 4, 'maneuvers': "[]"}
+            row.update(zip(merge_results.GH_FIELDS, rng.random(len(merge_results.GH_FIELDS))))
+            gh_writer.writerow(row)
+
+
+def reference_merge(gmaps_csv, gh_csv, output_csv, threshold):
+    """merge_results' original merge: a dict of GraphHopper routes by ID,
+    one threshold per pass over the Google routes."""
+
+    gh_data = {}
+    for route in route_store.read_routes(gh_csv, parse=False)[1]:
+        try:
+            gh_data[route['ID']] = {field: float(route[field]) for field in
+                                    ['total_distance_in_meters'] + merge_results.GH_FIELDS}
+        except ValueError:
+            pass
+
+    api_header, api_routes = route_store.read_routes(gmaps_csv, parse=False)
+
+    def merged_routes():
+        for route in api_routes:
+            dist = float(route['total_distance_in_meters'])
+            gh_route = gh_data.get(route['ID'])
+            if gh_route and abs((dist - gh_route['total_distance_in_meters']) / dist) < threshold:
+                merged = {field: route[field] for field in api_header}
+                merged.update({field: gh_route[field] for field in merge_results.GH_FIELDS})
+                yield merged
+
+    route_store.write_routes(output_csv, merge_results.EXPECTED_HEADER, merged_routes())
+
+
+def bench_merge(num_routes=100000, num_thresholds=20, seed=0):
+    """Merge with many thresholds: the original merge once per threshold
+    against merge_results.merge doing all of them in one pass."""
+
+    rng = np.random.default_rng(seed)
+    thresholds = [round(0.01 * (i + 1), 2) for i in range(num_thresholds)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gmaps_csv = os.path.join(tmp_dir, "gmaps.csv")
+        gh_csv = os.path.join(tmp_dir, "gh.csv")
+        write_merge_inputs(rng, gmaps_csv, gh_csv, num_routes)
+
+        start = time.perf_counter()
+        for threshold in thresholds:
+            reference_merge(gmaps_csv, gh_csv, os.path.join(tmp_dir, f"ref_{threshold}.csv"),
+                            threshold)
+        reference_sec = time.perf_counter() - start
+
+        outputs = {threshold: os.path.join(tmp_dir, f"merged_{threshold}.csv")
+                   for threshold in thresholds}
+        start = time.perf_counter()
+        merge_results.merge(gmaps_csv, gh_csv, outputs)
+        one_pass_sec = time.perf_counter() - start
+
+        for threshold in thresholds:
+            with open(os.path.join(tmp_dir, f"ref_{threshold}.csv"), 'rb') as f1, \
+                    open(outputs[threshold], 'rb') as f2:
+                assert f1.read() == f2.read()
+
+    return {'routes': num_routes, 'thresholds': num_thresholds,
+            'reference_sec': reference_sec, 'one_pass_sec': one_pass_sec,
+            'speedup': reference_sec / one_pass_sec}
+
+
+def alternative_routes(rng, num_ids, alternatives=3, num_steps=60, step=0.001):
+    """Routes with several alternatives each, as two routers might give them.
+
+    Each ID's alternatives are lattice walks from the same start. The second
+    set has every route with extra, jittered vertices (see provider_routes),
+    and its alternatives are in a different order.
+
+    return
+     - (routes1, routes2, truth): Dicts{(ID, name) : (lon, lat) array}, and
+       the (ID, name) in routes2 of each route of routes1
+    """
+
+    moves = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]])
+    routes1, routes2, truth = {}, {}, {}
+    for n in range(num_ids):
+        start = rng.integers(0, 40, size=2)
+        order = rng.permutation(alternatives)
+        for a in range(alternatives):
+            walk = start + np.cumsum(moves[rng.integers(0, 4, size=num_steps)], axis=0)
+            route = np.round(np.array([-87.7, 41.85]) + walk * step, 6)
+            key1, key2 = (f"route{n}", f"alternative {a}"), (f"route{n}", f"alternative {order[a]}")
+            routes1[key1] = route
+            routes2[key2] = provider_routes(rng, {key2: route})[key2]
+            truth[key1] = key2
+    return routes1, routes2, truth
+
+
+def reference_distances(routes1, routes2, metric):
+    """Distances between every pair of routes, from all pairwise point
+    distances (and the full Frechet dynamic program)."""
+
+    from scipy.spatial.distance import cdist
+
+    distances = np.empty((len(routes1), len(routes2)))
+    for k, a in enumerate(routes1):
+        for l, b in enumerate(routes2):
+            d = cdist(a, b)
+            if metric == "hausdorff":
+                distances[k, l] = max(d.min(axis=1).max(), d.min(axis=0).max())
+                continue
+            reach = np.full(d.shape, np.inf)
+            for i in range(len(a)):
+                for j in range(len(b)):
+                    best = 0.0 if i == j == 0 else min(
+                        reach[i - 1, j] if i else np.inf, reach[i, j - 1] if j else np.inf,
+                        reach[i - 1, j - 1] if i and j else np.inf)
+                    reach[i, j] = max(d[i, j], best)
+            distances[k, l] = reach[-1, -1]
+    return distances
+
+
+def bench_alternatives(num_ids=2000, checked=50, seed=0):
+    """Pair up alternative routes of two sets by shape, check the pairs are
+    the true ones, and check distances on the first IDs against all
+    pairwise point distances."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2, truth = alternative_routes(rng, num_ids)
+
+    result = {'ids': num_ids, 'routes': len(routes1)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, routes in (("set1.csv", routes1), ("set2.csv", routes2)):
+            rows = ({'ID': route_id, 'name': route_name, 'polyline_points': route[:, ::-1],
+                     'total_time_in_sec': 0} for (route_id, route_name), route in routes.items())
+            route_store.write_routes(os.path.join(tmp_dir, name), route_store.ROUTE_FIELDS, rows)
+        set1 = RouteSet.read(os.path.join(tmp_dir, "set1.csv"))
+        set2 = RouteSet.read(os.path.join(tmp_dir, "set2.csv"))
+
+    to_meters = projector(np.median(set1.points[:, 0]))
+    for metric in ("hausdorff", "frechet"):
+        start = time.perf_counter()
+        pairs = pair_alternatives(set1, set2, metric)
+        result[f'{metric}_sec'] = time.perf_counter() - start
+        assert all(truth[set1.key(i)] == set2.key(j) for i, j, _ in pairs)
+        assert len(pairs) == len(truth)
+
+        # the pairs of the first IDs, against the brute force distances
+        start = time.perf_counter()
+        for route_id in list(set1.alternatives)[:checked]:
+            rows1, rows2 = set1.alternatives[route_id], set2.alternatives[route_id]
+            reference = reference_distances([to_meters(set1.route(i)) for i in rows1],
+                                            [to_meters(set2.route(j)) for j in rows2], metric)
+            for i, j, distance in pairs:
+                if i in rows1:
+                    assert np.isclose(distance, reference[rows1.index(i), rows2.index(j)])
+                    assert np.isclose(distance, reference[rows1.index(i)].min())
+        result[f'{metric}_reference_sec_per_id'] = (time.perf_counter() - start) / checked
+        result[f'{metric}_sec_per_id'] = result[f'{metric}_sec'] / num_ids
+
+        # a route with no points is left unmatched, not paired at inf
+        with_empty = RouteSet(["a", "a"], ["main", "alternative 1"],
+                              [[41.8, -87.6], [41.81, -87.6]], [0, 2, 2])
+        pairs = pair_alternatives(with_empty, with_empty, metric)
+        assert [(i, j) for i, j, _ in pairs] == [(0, 0)] and np.isfinite(pairs[0][2])
+
+        # an out of range pair is never chosen over two in range: distances
+        # (meters) of [[99, 101], [0, 99]] with max_distance 100
+        scale = projector(41.8)(np.ones(2))[0]
+        b2 = (np.sqrt(99 ** 2 - (9401 / 198) ** 2), 9401 / 198)  # 99 from b1, 101 from a1
+        in_meters = [(0, 99), (0, 0), (0, 0), b2]  # a1, b1, then a2, b2 (north, east)
+        points = np.array([41.8, -87.6]) + np.array(in_meters) / scale
+        near1 = RouteSet(["a", "a"], ["main", "alternative 1"], points[:2], [0, 1, 2])
+        near2 = RouteSet(["a", "a"], ["main", "alternative 1"], points[2:], [0, 1, 2])
+        pairs = pair_alternatives(near1, near2, metric, max_distance=100)
+        assert [(i, j) for i, j, _ in pairs] == [(0, 0), (1, 1)], pairs
+    return result
+
+
+def traffic_network(rng, num_segments=1300):
+    """Traffic segments like poly1.txt's: short walks anywhere in Chicago.
+
+    return
+     - Dict{int : float64 array (n, 2)} - (lon, lat) points of each segment
+    """
+
+    geo = {}
+    for segment_id in range(num_segments):
+        start = rng.uniform((-87.85, 41.65), (-87.52, 42.02))
+        steps = rng.uniform(-0.004, 0.004, size=(int(rng.integers(2, 8)) - 1, 2))
+        geo[segment_id] = np.vstack((start, start + np.cumsum(steps, axis=0)))
+    return geo
+
+
+def exposure_routes(rng, geo, num_routes, num_points=200):
+    """Routes that follow traffic segments for a stretch (forwards, or
+    backwards so direction matters), a few meters off, then wander off.
+
+    return
+     - (coords, offsets): (lat, lon) points of all routes and where each starts
+    """
+
+    segment_ids = list(geo)
+    routes = []
+    for _ in range(num_routes):
+        along = geo[segment_ids[int(rng.integers(len(segment_ids)))]]
+        if rng.random() < 0.3:
+            along = along[::-1]
+        along = along + rng.normal(0, 3e-5, size=along.shape)
+        steps = rng.uniform(-0.002, 0.002, size=(num_points - len(along), 2))
+        lon_lat = np.vstack((along, along[-1] + np.cumsum(steps, axis=0)))
+        routes.append(lon_lat[:, ::-1])
+    offsets = np.concatenate(([0], np.cumsum([len(route) for route in routes])))
+    return np.concatenate(routes), offsets
+
+
+def reference_exposure(geo, colors, coords, offsets, tolerance=20.0, max_angle=45.0,
+                       piece_m=10.0):
+    """map_matching.route_exposure by brute force: every piece of every
+    route edge against every segment edge."""
+
+    ax, ay, bx, by, codes = [], [], [], [], []
+    color_codes = {color: code + 1 for code, color in enumerate(get_traffic_data.COLORS)}
+    for segment_id, points in geo.items():
+        x, y = map_matching.project(points[:, 0], points[:, 1])
+        ax.extend(x[:-1])
+        ay.extend(y[:-1])
+        bx.extend(x[1:])
+        by.extend(y[1:])
+        codes.extend([color_codes.get(colors.get(segment_id), 0)] * (len(points) - 1))
+    ax, ay, bx, by, codes = map(np.array, (ax, ay, bx, by, codes))
+    ex, ey = bx - ax, by - ay
+    length2 = np.maximum(ex * ex + ey * ey, 1e-12)
+
+    exposure = np.zeros((len(offsets) - 1, 5))
+    for r in range(len(offsets) - 1):
+        x, y = map_matching.project(coords[offsets[r]:offsets[r + 1], 1],
+                                    coords[offsets[r]:offsets[r + 1], 0])
+        for i in range(len(x) - 1):
+            dx, dy = x[i + 1] - x[i], y[i + 1] - y[i]
+            length = np.hypot(dx, dy)
+            pieces = max(1, int(np.ceil(length / piece_m)))
+            frac = (np.arange(pieces) + 0.5) / pieces
+            qx = x[i] + frac[:, None] * dx - ax
+            qy = y[i] + frac[:, None] * dy - ay
+            t = np.clip((qx * ex + qy * ey) / length2, 0.0, 1.0)
+            dist = np.hypot(qx - t * ex, qy - t * ey)
+            cos = (ex * dx + ey * dy) / (np.sqrt(length2) * max(length, 1e-12))
+            dist[dist > tolerance] = np.inf
+            dist[:, cos < np.cos(np.radians(max_angle))] = np.inf
+            best = dist.argmin(axis=1)
+            matched = np.isfinite(dist[np.arange(pieces), best])
+            for code in np.where(matched, codes[best], 4):
+                exposure[r, code] += length / pieces
+    return exposure
+
+
+def bench_exposure(num_routes=20000, checked=200, seed=0):
+    """Traffic exposure of routes of 200 points: map_matching's grid index
+    against brute force on the first routes, and its time on all of them."""
+
+    rng = np.random.default_rng(seed)
+    geo = traffic_network(rng)
+    colors = {segment_id: get_traffic_data.COLORS[int(rng.integers(3))]
+              for segment_id in geo if rng.random() < 0.9}
+    coords, offsets = exposure_routes(rng, geo, num_routes)
+
+    start = time.perf_counter()
+    index = map_matching.SegmentIndex(geo, colors)
+    index_sec = time.perf_counter() - start
+    start = time.perf_counter()
+    exposure = map_matching.route_exposure(index, coords, offsets)
+    exposure_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = reference_exposure(geo, colors, coords, offsets[:checked + 1])
+    reference_sec = time.perf_counter() - start
+    assert np.allclose(exposure[:checked], reference, atol=1e-6)
+    matched = exposure[:, :4].sum() / exposure.sum()
+    assert matched > 0.01  # the check means little if nothing matched
+
+    return {'routes': num_routes, 'points': len(coords), 'matched_share': matched,
+            'index_sec': index_sec, 'exposure_sec': exposure_sec,
+            'routes_per_sec': num_routes / exposure_sec,
+            'reference_sec_per_route': reference_sec / checked}
+
+
+def bench_intern(num_routes=20000, seed=0):
+    """Time and peak memory of collecting segments in a dict of float tuples
+    (get_segments) against interning them in a SegmentTable."""
+
+    rng = np.random.default_rng(seed)
+    routes1, routes2 = lattice_routes(rng, num_routes, size=400)
+    arrays = [[np.array(route) for route in routes.values()] for routes in (routes1, routes2)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    all_segments = diff_segments.get_segments([routes1, routes2])
+    dict_sec = time.perf_counter() - start
+    dict_mb = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = SegmentTable()
+    for routes in arrays:
+        table.intern(routes)
+    table_sec = time.perf_counter() - start
+    table_mb = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    assert len(table) == len(all_segments)
+    return {'routes': 2 * num_routes, 'segments': len(table),
+            'dict_sec': dict_sec, 'dict_peak_mb': dict_mb,
+            'table_sec': table_sec, 'table_peak_mb': table_mb,
+            'table_mb': (table.points.nbytes + table.edges.nbytes) / 2**20}
+
+
+BENCHMARKS = {
+    'alternatives': bench_alternatives,
+    'bootstrap': bench_bootstrap,
+    'check_decode': check_decode,
+    'contrasts': bench_contrasts,
+    'decode': bench_decode,
+    'exposure': bench_exposure,
+    'grid': bench_grid,
+    'intern': bench_intern,
+    'merge': bench_merge,
+    'od_pairs': bench_od_pairs,
+    'output': bench_output,
+    'simplify': bench_simplify,
+    'summary': bench_summary,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*",
+                        help="Benchmarks to run; all if none are given.")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}; choose from {', '.join(sorted(BENCHMARKS))}")
+
+    for name in args.names or BENCHMARKS:
+        result = BENCHMARKS[name]()
+        print(name)
+        for key, value in result.items():
+            print(f"\t{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Durable record of which od-pairs a long run has already finished.
+
+Completed IDs are buffered and written in batches. Each batch first flushes
+and fsyncs the output files, then appends one line per ID to the checkpoint
+file, together with the output files' sizes at that moment, and fsyncs that.
+On resume, the output files are truncated back to the last recorded sizes.
+This drops rows whose IDs never made it into the checkpoint, so nothing is
+written twice.
+"""
+
+import os
+import time
+
+
+class Checkpoint(object):
+
+    def __init__(self, checkpoint_fn, output_files, resume=False,
+                 batch_size=50, batch_sec=10.0):
+        """Open the checkpoint for output files that are already open.
+
+        params
+         - checkpoint_fn: str - path of the checkpoint file
+         - output_files: List[file] - outputs opened for appending ('a'
+           mode), e.g. a CSV or the files of a RouteStoreWriter
+         - resume: bool - keep IDs from an earlier run; otherwise start over
+         - batch_size: int - sync after this many completed IDs...
+         - batch_sec: float - ...or once this many seconds have passed
+        """
+
+        self.checkpoint_fn = checkpoint_fn
+        self.output_files = output_files
+        self.batch_size = batch_size
+        self.batch_sec = batch_sec
+        self.done = set()
+        self.pending = []
+        self.last_sync = time.monotonic()
+
+        if resume:
+            self.done, offsets, complete_size = read_checkpoint(checkpoint_fn)
+            # with no IDs recorded, nothing in the output is worth keeping
+            offsets = offsets or [0] * len(output_files)
+            for output_file, offset in zip(output_files, offsets):
+                output_file.flush()
+                output_file.truncate(offset)
+                output_file.seek(offset)
+            self.fout = open(checkpoint_fn, 'a')
+            self.fout.truncate(complete_size)
+        else:
+            self.fout = open(checkpoint_fn, 'w')
+
+    def is_done(self, route_id):
+        return route_id in self.done
+
+    def mark_done(self, route_id):
+        self.done.add(route_id)
+        self.pending.append(route_id)
+        if (len(self.pending) >= self.batch_size or
+                time.monotonic() - self.last_sync >= self.batch_sec):
+            self.sync()
+
+    def sync(self):
+        """Make the output durable, then record the pending IDs."""
+
+        for output_file in self.output_files:
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        offsets = ",".join(str(output_file.tell()) for output_file in self.output_files)
+
+        if self.pending:
+            self.fout.write("".join("{0}\t{1}\n".format(route_id, offsets)
+                                    for route_id in self.pending))
+            self.fout.flush()
+            os.fsync(self.fout.fileno())
+            self.pending = []
+
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.fout.close()
+
+
+def read_checkpoint(checkpoint_fn):
+    """Read completed IDs and the last durable output sizes.
+
+    return
+     - (Set[str], List[int] or None, int) - completed IDs, the sizes the
+       output files had when the last of them was recorded (None if there
+       are none), and the size of the checkpoint file up to its last full
+       line
+    """
+
+    done = set()
+    offsets = None
+    complete_size = 0
+    if not os.path.exists(checkpoint_fn):
+        return done, offsets, complete_size
+
+    with open(checkpoint_fn, 'rb') as fin:
+        for line in fin:
+            # a crash can leave the last line half-written
+            if not line.endswith(b"\n"):
+                break
+
+            route_id, line_offsets = line.decode().rstrip("\n").split("\t")
+            done.add(route_id)
+            offsets = [int(offset) for offset in line_offsets.split(",")]
+            complete_size += len(line)
+
+    return done, offsets, complete_size
@@ -0,0 +1,155 @@
+"""Exact, mergeable histograms of bootstrap differences, one per segment.
+
+In each bootstrap resample every segment gets an integer difference in the
+number of routes using it. Rather than keep every resample's difference
+(segments x iterations), DiffHistograms counts how often each value came
+up, so memory grows with the spread of the differences instead of with the
+number of iterations. Quantiles and means read off the histograms are
+exactly those of the full list of differences, and histograms built from
+different resamples (e.g. in different processes) add up exactly.
+
+Each segment has a window of values [lo, lo + width) stored back to back
+in one flat counts array. Windows start around the first values seen and
+are widened (and the array rebuilt) when a later value falls outside them.
+
+DiffLists has the same interface but keeps every difference and sorts them,
+the way diff_segments originally worked; it is there to check against.
+"""
+
+import numpy as np
+
+
+class DiffHistograms(object):
+
+    def __init__(self, num_segments):
+        self.num_segments = num_segments
+        self.lo = np.zeros(num_segments, dtype=np.int64)
+        self.width = np.zeros(num_segments, dtype=np.int64)
+        self.offsets = np.zeros(num_segments + 1, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int32)
+        self.sums = np.zeros(num_segments, dtype=np.int64)
+        self.iterations = 0  # resamples counted, kept up to date by the caller of add
+
+    def add(self, diffs, first=0):
+        """Count one block of differences.
+
+        params
+         - diffs: int array (block, k) - k resamples' differences for
+           segments first to first + block
+         - first: int - first segment of the block
+        """
+
+        diffs = np.asarray(diffs, dtype=np.int64)
+        block = slice(first, first + len(diffs))
+        if diffs.size == 0:
+            return
+
+        self._cover(block, diffs.min(axis=1), diffs.max(axis=1))
+
+        # position of each value in this block's part of the counts array
+        start, end = self.offsets[first], self.offsets[block.stop]
+        index = diffs + (self.offsets[block] - self.lo[block] - start)[:, None]
+        self.counts[start:end] += np.bincount(index.ravel(), minlength=end - start).astype(np.int32)
+        self.sums[block] += diffs.sum(axis=1)
+
+    def merge(self, other):
+        """Add another DiffHistograms over the same segments into this one."""
+
+        everything = slice(0, self.num_segments)
+        self._cover(everything, other.lo, other.lo + other.width - 1)
+
+        segment = np.repeat(np.arange(other.num_segments), other.width)
+        within = np.arange(len(other.counts)) - other.offsets[segment]
+        index = self.offsets[segment] + (other.lo[segment] - self.lo[segment]) + within
+        self.counts += np.bincount(index, weights=other.counts,
+                                   minlength=len(self.counts)).astype(np.int32)
+        self.sums += other.sums
+        self.iterations += other.iterations
+
+    def _cover(self, block, lo, hi):
+        """Widen the windows of segments in block to cover [lo, hi]; segments
+        with lo > hi are left alone."""
+
+        old_lo, old_width = self.lo[block], self.width[block]
+        old_hi = old_lo + old_width - 1
+        empty = old_width == 0
+        grow = (lo <= hi) & (empty | (lo < old_lo) | (hi > old_hi))
+        if not grow.any():
+            return
+
+        # leave room around new windows so they rarely need widening again
+        new_lo = np.where(empty, lo, np.minimum(old_lo, lo))
+        new_hi = np.where(empty, hi, np.maximum(old_hi, hi))
+        margin = (new_hi - new_lo) // 4 + 1
+
+        lo_all, width_all = self.lo.copy(), self.width.copy()
+        lo_all[block] = np.where(grow, new_lo - margin, old_lo)
+        width_all[block] = np.where(grow, new_hi - new_lo + 1 + 2 * margin, old_width)
+        self._rebuild(lo_all, width_all)
+
+    def _rebuild(self, lo, width):
+        offsets = np.concatenate(([0], np.cumsum(width)))
+        counts = np.zeros(offsets[-1], dtype=np.int32)
+
+        segment = np.repeat(np.arange(self.num_segments), self.width)
+        within = np.arange(len(self.counts)) - self.offsets[segment]
+        counts[offsets[segment] + (self.lo[segment] - lo[segment]) + within] = self.counts
+
+        self.lo, self.width, self.offsets, self.counts = lo, width, offsets, counts
+
+    def values_at(self, position):
+        """The value at a 0-based position in each segment's sorted differences."""
+
+        cumulative = np.cumsum(self.counts, dtype=np.int64)
+        before = np.concatenate(([0], cumulative))[self.offsets[:-1]]
+        index = np.searchsorted(cumulative, before + position + 1, side='left')
+        return self.lo + (index - self.offsets[:-1])
+
+    def means(self):
+        return self.sums / self.iterations
+
+
+class DiffLists(object):
+
+    def __init__(self, num_segments):
+        self.num_segments = num_segments
+        self.blocks = []  # (first, int64 array (block, k)), as given to add
+        self.sums = np.zeros(num_segments, dtype=np.int64)
+        self.iterations = 0  # resamples kept, kept up to date by the caller of add
+        self._sorted = None
+
+    def add(self, diffs, first=0):
+        """Keep one block of differences, see DiffHistograms.add."""
+
+        diffs = np.asarray(diffs, dtype=np.int64)
+        self.blocks.append((first, diffs))
+        self.sums[first:first + len(diffs)] += diffs.sum(axis=1)
+        self._sorted = None
+
+    def merge(self, other):
+        self.blocks.extend(other.blocks)
+        self.sums += other.sums
+        self.iterations += other.iterations
+        self._sorted = None
+
+    def sorted_diffs(self):
+        """int64 array (segments, iterations): each segment's differences, sorted."""
+
+        if self._sorted is None:
+            diffs = np.empty((self.num_segments, self.iterations), dtype=np.int64)
+            filled = np.zeros(self.num_segments, dtype=np.int64)
+            for first, block in self.blocks:
+                rows = slice(first, first + len(block))
+                column = filled[first] if len(block) else 0
+                if (filled[rows] != column).any():
+                    raise ValueError("blocks of one resample must cover the same segments")
+                diffs[rows, column:column + block.shape[1]] = block
+                filled[rows] += block.shape[1]
+            self._sorted = np.sort(diffs, axis=1)
+        return self._sorted
+
+    def values_at(self, position):
+        return self.sorted_diffs()[:, position]
+
+    def means(self):
+        return self.sums / self.iterations
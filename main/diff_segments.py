@@ -1,39 +1,132 @@
-import ast
+import argparse
 import copy
 import csv
+import itertools
 import os
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
-import geojson
+import numpy as np
+from scipy import sparse
 from shapely.geometry import LineString
 
+import instrument
+import route_store
+from route_set import METRICS, RouteSet, pair_alternatives
+from diff_histograms import DiffHistograms, DiffLists
+from geojson_stream import FeatureWriter
+from geopackage import GeoPackageWriter
+from segment_intern import SegmentTable
+from simplify_routes import simplify_routes
+
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIR = SCRIPT_DIR + "/data/"
 
-def main():
-    try:
-        arg1 = sys.argv[1]
-        arg2 = sys.argv[2]
-    except IndexError as error:
-        print("\nERROR: You need to provide two of:\ntraffic_gm, fastest_gm, traffic_gh, fastest_gh.\n")
-        raise
+ENGINES = ["sparse", "legacy"]
+SUMMARIES = {"histogram": DiffHistograms, "sort": DiffLists}
+ALPHA = 0.01  # significance level
+CHUNK_ITERATIONS = 50  # resamples per random stream, see iteration_chunks
+OUTPUT_FIELDS = [('lower', 'int'), ('upper', 'int'), ('median', 'int'), ('mean', 'float'),
+                 ('significant', 'bool')]
+OUTPUT_BATCH = 100000  # segments formatted and written at a time
 
+def main():
     fnames = {
-        "traffic_gm" : DATA_DIR + "chicago_routes_gmaps_traffic.csv",
-        "fastest_gm" : DATA_DIR + "chicago_routes_gmaps_fastest.csv",
-        "traffic_gh" : DATA_DIR + "chicago_routes_gh_traffic.csv",
-        "fastest_gh" : DATA_DIR + "chicago_routes_gh_fastest.csv",
+        "traffic_gm" : "chicago_routes_gmaps_traffic.csv",
+        "fastest_gm" : "chicago_routes_gmaps_fastest.csv",
+        "traffic_gh" : "chicago_routes_gh_traffic.csv",
+        "fastest_gh" : "chicago_routes_gh_fastest.csv",
     }
 
-    output_geojson = DATA_DIR + f"route_diffs_{arg1}_{arg2}.geojson"
-    f1 = fnames[arg1]
-    f2 = fnames[arg2]
-
-    weighted_line(f1, f2, output_geojson)
-
-
-def weighted_line(f1, f2, output_geojson):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("arg1", nargs="?", choices=sorted(fnames), help="First set of routes.")
+    parser.add_argument("arg2", nargs="?", choices=sorted(fnames), help="Second set of routes.")
+    parser.add_argument("--contrast", action="append", default=[], metavar="SET1:SET2",
+                        help="Compare SET1 with SET2; give it more than once to run several " +
+                             "comparisons in one pass over the routes (sparse engine only).")
+    parser.add_argument("--all-pairs", action="store_true",
+                        help="Compare every pair of route sets in one pass (sparse engine only).")
+    parser.add_argument("--engine", choices=ENGINES, default="sparse",
+                        help="Bootstrap with one sparse matrix product, or the original loop.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed, for reproducible resampling.")
+    parser.add_argument("--intern-table", default=None,
+                        help="Segment table (.npz) to reuse and update, so segment IDs are " +
+                             "shared across runs.")
+    parser.add_argument("--merge-reversed", action="store_true",
+                        help="Count a segment and its reverse as the same segment.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Bootstrap in N processes; the output only depends on --seed, not N.")
+    parser.add_argument("--iterations", type=int, default=500,
+                        help="Number of bootstrap resamples.")
+    parser.add_argument("--summary", choices=sorted(SUMMARIES), default="histogram",
+                        help="Count each segment's differences in histograms (memory grows " +
+                             "with segments), or keep and sort all of them (segments x iterations).")
+    parser.add_argument("--format", choices=["geojson", "gpkg"], default="geojson",
+                        help="Output GeoJSON, or a spatially indexed GeoPackage.")
+    parser.add_argument("--significant-only", action="store_true",
+                        help="Only output segments with a significant difference.")
+    parser.add_argument("--simplify", type=float, default=0.0,
+                        help="Douglas-Peucker tolerance (degrees) to simplify routes with first.")
+    parser.add_argument("--snap-grid", type=float, default=0.0,
+                        help="Round route vertices to a grid of this size (degrees).")
+    parser.add_argument("--snap-nodes", default=None,
+                        help="Segment table (.npz) whose points route vertices are snapped to, " +
+                             "e.g. one saved from a run on GraphHopper routes.")
+    parser.add_argument("--snap-tolerance", type=float, default=0.0001,
+                        help="Furthest (degrees) a vertex is moved to a --snap-nodes point.")
+    parser.add_argument("--match-alternatives", choices=METRICS, default=None,
+                        help="Keep every alternative route, and compare each with the " +
+                             "alternative of the other set closest in shape by this distance.")
+    parser.add_argument("--max-match-distance", type=float, default=None,
+                        help="With --match-alternatives, leave routes further apart than " +
+                             "this (meters) unpaired.")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="Folder holding the route sets, where the outputs are written too.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="diff_segments")
+    fnames = {name: os.path.join(args.data_dir, fname) for name, fname in fnames.items()}
+
+    contrasts = [tuple(contrast.split(":")) for contrast in args.contrast]
+    if args.all_pairs:
+        contrasts += list(itertools.combinations(sorted(fnames), 2))
+    for contrast in contrasts:
+        if len(contrast) != 2 or not set(contrast) <= set(fnames):
+            parser.error(f"--contrast must be SET1:SET2 with sets from {sorted(fnames)}")
+    if not contrasts and not (args.arg1 and args.arg2):
+        parser.error("give two sets of routes, --contrast or --all-pairs")
+    if contrasts and args.engine == "legacy":
+        parser.error("--contrast and --all-pairs need the sparse engine")
+    if contrasts and args.match_alternatives:
+        parser.error("--match-alternatives compares two sets of routes, not --contrast or --all-pairs")
+
+    options = dict(seed=args.seed, intern_table=args.intern_table,
+                   merge_reversed=args.merge_reversed, workers=args.workers,
+                   iterations=args.iterations, summary=args.summary, simplify=args.simplify,
+                   snap_grid=args.snap_grid, snap_nodes=args.snap_nodes,
+                   snap_tolerance=args.snap_tolerance, significant_only=args.significant_only)
+    if contrasts:
+        route_files = {name: route_store.prefer_store(fname) for name, fname in fnames.items()}
+        outputs = {(set1, set2): os.path.join(args.data_dir, f"route_diffs_{set1}_{set2}.{args.format}")
+                   for set1, set2 in contrasts}
+        weighted_lines(route_files, outputs, **options)
+        return
+
+    output_fn = os.path.join(args.data_dir, f"route_diffs_{args.arg1}_{args.arg2}.{args.format}")
+    f1 = route_store.prefer_store(fnames[args.arg1])
+    f2 = route_store.prefer_store(fnames[args.arg2])
+
+    weighted_line(f1, f2, output_fn, engine=args.engine, match_alternatives=args.match_alternatives,
+                  max_match_distance=args.max_match_distance, **options)
+
+
+def weighted_line(f1, f2, output_fn, engine="sparse", seed=None, intern_table=None,
+                  merge_reversed=False, workers=None, iterations=500, summary="histogram",
+                  simplify=0.0, snap_grid=0.0, snap_nodes=None, snap_tolerance=0.0001,
+                  significant_only=False, match_alternatives=None, max_match_distance=None):
     """Determine if there is a significant difference in where routes go.
 
     This function is long as shit, but here's what it does:
@@ -51,9 +144,36 @@ def weighted_line(f1, f2, output_geojson):
     What is the single responsibility principle, anyway?
 
     params
-     - f1: str - filename of first routes CSV
-     - f2: str - filename of second routes CSV
-     - output_geojson: str - filename of output GeoJSON file
+     - f1: str - filename of first routes CSV or store
+     - f2: str - filename of second routes CSV or store
+     - output_fn: str - filename of output GeoJSON file, or GeoPackage if
+       it ends in .gpkg (see write_diffs)
+     - engine: str - "sparse" or "legacy", see bootstrap_parallel and
+       bootstrap_legacy
+     - seed: int - random seed; the same seed gives the same output
+     - intern_table: str - .npz file of a SegmentTable to reuse and update,
+       so segment IDs stay the same across runs (sparse engine only)
+     - merge_reversed: bool - count a segment and its reverse as one
+       segment (sparse engine only)
+     - workers: int - bootstrap in this many processes, see
+       bootstrap_parallel (sparse engine only); results depend on the seed
+       but not on the number of workers
+     - iterations: int - number of bootstrap resamples
+     - summary: str - "histogram" or "sort", how each segment's differences
+       are summed up; see SUMMARIES. Both give the same output.
+     - simplify: float - Douglas-Peucker tolerance (degrees) to simplify
+       routes with before finding segments; 0 to leave them be
+     - snap_grid: float - round route vertices to this grid (degrees)
+     - snap_nodes: str - .npz SegmentTable whose points vertices are
+       snapped to, within snap_tolerance degrees
+     - snap_tolerance: float
+     - significant_only: bool - only write out significant segments
+     - match_alternatives: str - "hausdorff" or "frechet" to keep every
+       alternative route and compare each with its closest alternative in
+       the other set, see read_paired_polylines; None to compare the last
+       route read for each ID
+     - max_match_distance: float - with match_alternatives, leave routes
+       further apart than this (meters) unpaired
 
     return
      - None (write output to file instead)
@@ -61,71 +181,16 @@ def weighted_line(f1, f2, output_geojson):
 
     print(f"Computing differences between routes for: \n\t{f1}\n\t{f2}")
 
-    # Get polylines for first CSV
-    # The polylines are stored as "[(lat1,lon1),(lat2,lon2),...,(latn, lonn)]"
-    # so we can use the AST evaluator on them
-    features1 = {}
-    times1 = {}
-    with open(f1, 'r') as fin:
-        csvreader = csv.reader(fin)
-        header = next(csvreader)
-
-        id_idx = header.index("ID")
-        time_idx = header.index("total_time_in_sec")
-        polyline_idx = header.index("polyline_points")
-
-        success1 = 0
-        failure1 = 0
-
-        for line in csvreader:
-            try:
-                route_id = line[id_idx]
-                t_sec = float(line[time_idx])
-                polyline = ast.literal_eval(line[polyline_idx])
-
-                # Flip lat/lon to lon/lat per GeoJSON spec
-                num_coordinates = len(polyline)
-                for i in range(num_coordinates):
-                    polyline[i] = (polyline[i][1], polyline[i][0])
-
-                features1[route_id] = polyline
-                times1[route_id] = t_sec
-                success1 += 1
-            except:
-                failure1 += 1
-
-    # Get polylines for second CSV
-    # The polylines are stored as "[(lat1,lon1),(lat2,lon2),...,(latn, lonn)]"
-    # so we can use the AST evaluator on them
-    features2 = {}
-    times2 = {}
-    with open(f2, 'r') as fin:
-        csvreader = csv.reader(fin)
-        header = next(csvreader)
-
-        id_idx = header.index("ID")
-        time_idx = header.index("total_time_in_sec")
-        polyline_idx = header.index("polyline_points")
-
-        success2 = 0
-        failure2 = 0
-
-        for line in csvreader:
-            try:
-                route_id = line[id_idx]
-                t_sec = float(line[time_idx])
-                polyline = ast.literal_eval(line[polyline_idx])
-
-                # Flip lat/lon to lon/lat per GeoJSON spec
-                num_coordinates = len(polyline)
-                for i in range(num_coordinates):
-                    polyline[i] = (polyline[i][1], polyline[i][0])
-
-                features2[route_id] = polyline
-                times2[route_id] = t_sec
-                success2 += 1
-            except:
-                failure2 += 1
+    # Get polylines for both sets of routes
+    with instrument.span("read_routes"):
+        if match_alternatives:
+            features1, features2 = read_paired_polylines(f1, f2, match_alternatives,
+                                                         max_match_distance,
+                                                         as_arrays=(engine != "legacy"))
+            times1, times2 = {}, {}
+        else:
+            features1, times1 = read_polylines(f1, as_arrays=(engine != "legacy"))
+            features2, times2 = read_polylines(f2, as_arrays=(engine != "legacy"))
 
     print(f"Found {len(features2)} routes for each type.")
 
@@ -148,70 +213,508 @@ def weighted_line(f1, f2, output_geojson):
             del features2[route_id]
             del times2[route_id]
 
-    # Combine polyline segments into dict of all possible route segments
-    # TODO: maybe use douglas peucker
-    all_segments = get_segments([features1, features2])
-    print(f"Found {len(all_segments)} segments in total")
-
-    # Resample route IDs
-    iterations = 500
+    # Simplify and snap routes, so near-duplicate segments along the same
+    # road become one; see simplify_routes.py
+    if simplify or snap_grid or snap_nodes:
+        with instrument.span("simplify_routes"):
+            features1, features2 = simplify_route_sets([features1, features2], simplify,
+                                                       snap_grid, snap_nodes, snap_tolerance)
+        if engine == "legacy":
+            features1, features2 = [{route_id: [tuple(point) for point in route.tolist()]
+                                     for route_id, route in features.items()}
+                                    for features in (features1, features2)]
+
+    # Combine polyline segments into the set of all possible route segments,
+    # and resample route IDs to get the differences for each resample
+    accumulator = SUMMARIES[summary]
     route_ids = list(features1.keys())
-    for i in range(iterations):
-        sampled_ids = random.choices(route_ids, k = len(route_ids))  # as of 3.6
+    instrument.count("routes_total", len(route_ids))
+    if engine == "legacy":
+        with instrument.span("segments", engine=engine):
+            all_segments = get_segments([features1, features2])
+        print(f"Found {len(all_segments)} segments in total")
+        instrument.count("segments_total", len(all_segments))
+
+        samples = legacy_samples(route_ids, iterations, random.Random(seed))
+        with instrument.span("bootstrap", engine=engine, iterations=iterations):
+            diffs = bootstrap_legacy(features1, features2, all_segments, samples,
+                                     accumulator(len(all_segments)))
+        segments = np.array(list(all_segments), dtype=np.float64).reshape(-1, 2, 2)
+    else:
+        with instrument.span("segments", engine=engine):
+            table = load_segment_table(intern_table, merge_reversed)
+            segments1, offsets1 = table.intern([features1[route_id] for route_id in route_ids])
+            segments2, offsets2 = table.intern([features2[route_id] for route_id in route_ids])
+            if intern_table:
+                table.save(intern_table)
+
+            # segments used by these routes, in the table's (first seen) order
+            segment_ids = np.unique(np.concatenate((segments1, segments2)))
+        print(f"Found {len(segment_ids)} segments in total")
+        instrument.count("segments_total", len(segment_ids))
+
+        diff_matrix = incidence_matrix(segments1, offsets1, segment_ids) - \
+                      incidence_matrix(segments2, offsets2, segment_ids)
+        with instrument.span("bootstrap", engine=engine, iterations=iterations):
+            diffs = bootstrap_parallel(diff_matrix, iterations, seed, workers or 1, accumulator)
+        segments = table.coords(segment_ids)
+
+    # Calculate significance -- for each segment, look at the set of
+    # differences between the two kinds of routes. If the set of differences
+    # is strongly above or strongly below 0, we say it's significant.
+    with instrument.span("summarize"):
+        stats = summarize(diffs, ALPHA)
+    with instrument.span("write_diffs"):
+        write_diffs(output_fn, segments, stats, significant_only)
+
+
+def weighted_lines(route_files, outputs, seed=None, intern_table=None, merge_reversed=False,
+                   workers=None, iterations=500, summary="histogram", simplify=0.0,
+                   snap_grid=0.0, snap_nodes=None, snap_tolerance=0.0001,
+                   significant_only=False):
+    """weighted_line for several pairs of route sets at once.
+
+    Every route set is read (and simplified) once, and all of them are
+    interned into one SegmentTable. Only routes found in every set are
+    used, so that all comparisons resample the same route IDs: each
+    resample is drawn once and applied to every comparison, by stacking
+    their diff matrices side by side into one matrix for bootstrap_parallel.
+    A comparison's output is what weighted_line would give for the same
+    routes and seed.
+
+    params
+     - route_files: Dict{str : str} - routes CSV or store of each route set
+     - outputs: Dict{(str, str) : str} - output filename for each
+       pair of route set names to compare
+     - the rest: see weighted_line (sparse engine)
+
+    return
+     - None (write output to files instead)
+    """
+
+    names = list(dict.fromkeys(name for contrast in outputs for name in contrast))
+    print(f"Computing differences between routes for {len(outputs)} pairs of: \n\t" +
+          "\n\t".join(route_files[name] for name in names))
+
+    features = {}
+    for name in names:
+        with instrument.span("read_routes", route_set=name):
+            features[name], _ = read_polylines(route_files[name], as_arrays=True)
+        print(f"Found {len(features[name])} routes in {name}")
+
+    # keep routes found in every set, so all comparisons share resamples
+    route_ids = [route_id for route_id in features[names[0]]
+                 if all(route_id in features[name] for name in names[1:])]
+    print(f"Found {len(route_ids)} routes in all sets")
+    instrument.count("routes_total", len(route_ids))
+    route_sets = [{route_id: features[name][route_id] for route_id in route_ids} for name in names]
+    if simplify or snap_grid or snap_nodes:
+        with instrument.span("simplify_routes"):
+            route_sets = simplify_route_sets(route_sets, simplify, snap_grid, snap_nodes,
+                                             snap_tolerance)
+
+    with instrument.span("segments", engine="sparse"):
+        table = load_segment_table(intern_table, merge_reversed)
+        interned = {name: table.intern([routes[route_id] for route_id in route_ids])
+                    for name, routes in zip(names, route_sets)}
+        if intern_table:
+            table.save(intern_table)
+    instrument.count("segments_total", len(table))
+
+    # one incidence matrix per set, over every segment of every set
+    all_ids = np.arange(len(table))
+    incidence = {name: incidence_matrix(segment_ids, offsets, all_ids)
+                 for name, (segment_ids, offsets) in interned.items()}
+
+    # each comparison's columns: the segments either of its sets uses
+    columns, diff_matrices = {}, []
+    for set1, set2 in outputs:
+        columns[set1, set2] = np.unique(np.concatenate((interned[set1][0], interned[set2][0])))
+        diff_matrices.append((incidence[set1] - incidence[set2])[:, columns[set1, set2]])
+        print(f"Found {len(columns[set1, set2])} segments in total for {set1} vs {set2}")
+    stacked = sparse.hstack(diff_matrices, format='csr')
+
+    with instrument.span("bootstrap", engine="sparse", iterations=iterations):
+        diffs = bootstrap_parallel(stacked, iterations, seed, workers or 1, SUMMARIES[summary])
+    with instrument.span("summarize"):
+        stats = summarize(diffs, ALPHA)
+
+    start = 0
+    for contrast, output_fn in outputs.items():
+        end = start + len(columns[contrast])
+        with instrument.span("write_diffs", contrast=":".join(contrast)):
+            write_diffs(output_fn, table.coords(columns[contrast]),
+                        {name: values[start:end] for name, values in stats.items()},
+                        significant_only)
+        start = end
+
+
+def simplify_route_sets(route_sets, simplify, snap_grid, snap_nodes, snap_tolerance):
+    """Run route sets through simplify_routes with weighted_line's options."""
+
+    nodes = SegmentTable.load(snap_nodes).points if snap_nodes else None
+    route_sets, _ = simplify_routes(route_sets, tolerance=simplify, grid_size=snap_grid,
+                                    nodes=nodes, node_tolerance=snap_tolerance)
+    return route_sets
+
+
+def write_diffs(output_fn, segments, stats, significant_only=False):
+    """Write each segment and its summary statistics to a file, streaming
+    them out a batch at a time.
+
+    params
+     - output_fn: str - output file; a GeoPackage (with a spatial index,
+       see geopackage.py) if it ends in .gpkg, else GeoJSON
+     - segments: float64 array (n, 2, 2) - (lon, lat) points of each segment
+     - stats: Dict{str : List} - see summarize, one value per segment
+     - significant_only: bool - leave out segments that are not significant
+    """
+
+    keep = np.ones(len(segments), dtype=bool)
+    if significant_only:
+        keep = np.asarray(stats['significant'], dtype=bool)
+    keep = np.flatnonzero(keep)
+
+    if output_fn.endswith(".gpkg"):
+        writer = GeoPackageWriter(output_fn, "route_diffs", OUTPUT_FIELDS)
+    else:
+        writer = FeatureWriter(output_fn)
+
+    with writer:
+        for start in range(0, len(keep), OUTPUT_BATCH):
+            batch = keep[start:start + OUTPUT_BATCH]
+            columns = {name: [stats[name][i] for i in batch] for name, _ in OUTPUT_FIELDS}
+            if isinstance(writer, GeoPackageWriter):
+                writer.write(segments[batch], columns)
+                continue
+
+            # Code all of this as a GeoJSON! Coordinates are rounded the way
+            # geojson.LineString rounds them.
+            for i, segment in enumerate(segments[batch].tolist()):
+                writer.write({
+                    'type': 'Feature',
+                    'geometry': {'type': 'LineString',
+                                 'coordinates': [[round(x, 6), round(y, 6)] for x, y in segment]},
+                    'properties': {name: columns[name][i] for name, _ in OUTPUT_FIELDS},
+                })
+
+    print(f"Dumped {writer.count} segments into {output_fn}")
+    instrument.count("segments_written_total", writer.count)
+
+
+def legacy_samples(route_ids, iterations, rng):
+    """Resample route IDs with replacement, one list per iteration."""
+
+    for _ in range(iterations):
+        yield rng.choices(route_ids, k = len(route_ids))  # as of 3.6
+
+
+def bootstrap_legacy(features1, features2, all_segments, samples, diffs):
+    """The original bootstrap: walk every sampled route in every iteration.
+
+    params
+     - features1, features2: Dict{str : List[(lon, lat)]} - the two sets of routes
+     - all_segments: Dict{((lon, lat), (lon, lat)) : ...} - every segment
+     - samples: iterable of List[str] - route IDs sampled in each iteration
+     - diffs: DiffHistograms or DiffLists over all_segments (in order) to
+       add each iteration's differences to
+
+    return
+     - diffs
+    """
+
+    segment_index = {segment: i for i, segment in enumerate(all_segments)}
+    for i, sampled_ids in enumerate(samples):
         segment_diffs = get_diffs(features1, features2, sampled_ids)
 
-        for segment in all_segments:
-            all_segments[segment].append(segment_diffs.get(segment, 0))
+        column = np.zeros((len(segment_index), 1), dtype=np.int64)
+        for segment, diff in segment_diffs.items():
+            column[segment_index[segment], 0] = diff
+        diffs.add(column)
+        diffs.iterations += 1
+        instrument.count("bootstrap_iterations_total")
 
-        if i % 10 == 9:
-            print(f"Finished iteration {i+1} of {iterations}")
+    return diffs
 
 
-    # Calculate significance -- for each segment, look at the set of
-    # differences between the two kinds of routes. If the set of differences
-    # is strongly above or strongly below 0, we say it's significant.
-    # 
-    # At each step of this, we consider a particular segment (pt1, pt2). It
-    # is a key into all_segments whose value is the list of differences
-    # observed in resampling. We replace the list with the summary statistics
-    # once they are computed.
-    alpha = 0.01  # significance level
-    for i, segment in enumerate(all_segments):
-        sorted_segment_diffs = sorted(all_segments[segment])
-        lower = sorted_segment_diffs[int(iterations * alpha / 2)]
-        upper = sorted_segment_diffs[int(iterations * (1 - alpha) / 2)]
-        median = sorted_segment_diffs[int(iterations / 2)]
-        mean = sum(sorted_segment_diffs) / iterations
-
-        significant = (lower > 0 and upper > 0) or (lower < 0 and upper < 0)
-        all_segments[segment] = {'lower': lower, 'upper': upper,
-                                 'median': median, 'significant':significant,
-                                 'mean': mean}
-
-        if i % 1000 == 999:
-            print(f"Processed {i+1} out of {len(all_segments)}")
-
-    # Code all of this as a GeoJSON!
-    output = []
-    for feature in all_segments:
-        polyline = geojson.Feature(geometry = geojson.LineString(feature),
-                        properties = {
-                           'lower': all_segments[feature]['lower'],
-                           'upper': all_segments[feature]['upper'],
-                           'median': all_segments[feature]['median'],
-                           'mean': all_segments[feature]['mean'],
-                           'significant': all_segments[feature]['significant']
-                        }
-                   )
-
-        output.append(polyline)
-
-    fc = geojson.FeatureCollection(output)
-    with open(output_geojson, 'w') as fout:
-        geojson.dump(fc, fout)
-
-    print(f"Dumped everything into a file")
+def load_segment_table(intern_table, merge_reversed):
+    """Load a SegmentTable from intern_table if it exists, else start a new one."""
+
+    if not intern_table or not os.path.exists(intern_table):
+        return SegmentTable(merge_reversed=merge_reversed)
+
+    table = SegmentTable.load(intern_table)
+    if table.merge_reversed != merge_reversed:
+        raise ValueError(f"{intern_table} was built with merge_reversed={table.merge_reversed}")
+    print(f"Loaded {len(table)} segments from {intern_table}")
+    return table
+
+
+def incidence_matrix(segment_ids, offsets, columns):
+    """Count how many times each route uses each segment.
+
+    params
+     - segment_ids, offsets: interned routes, see SegmentTable.intern; one
+       row each
+     - columns: int array - sorted segment IDs, one column each
+
+    return
+     - scipy.sparse.csr_matrix (routes, segments) of int64 counts
+    """
+
+    num_routes = len(offsets) - 1
+    rows = np.repeat(np.arange(num_routes), np.diff(offsets))
+    cols = np.searchsorted(columns, segment_ids)
+    data = np.ones(len(rows), dtype=np.int64)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(num_routes, len(columns)))
+
+
+def bootstrap_weights(num_routes, iterations, rng):
+    """How many times each route is drawn in each bootstrap resample.
+
+    Drawing num_routes routes with replacement makes each row a multinomial
+    sample, so all of them are drawn at once.
+
+    return
+     - int64 array (iterations, num_routes)
+    """
+
+    return rng.multinomial(num_routes, np.full(num_routes, 1 / num_routes), size=iterations)
+
+
+def iteration_chunks(iterations, seed):
+    """Split the resamples into fixed chunks, each with its own random stream.
+
+    The streams are spawned from one SeedSequence, so the resamples only
+    depend on the seed, not on how the chunks are shared out to workers.
+
+    return
+     - List[(SeedSequence, int)] - seed and number of resamples per chunk
+    """
+
+    sizes = [min(CHUNK_ITERATIONS, iterations - start)
+             for start in range(0, iterations, CHUNK_ITERATIONS)]
+    return list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+
+
+def bootstrap_chunks(diff_by_segment, chunks, accumulator=DiffHistograms, block_size=None):
+    """Resample chunk by chunk, adding each resample's differences to diffs.
+
+    params
+     - diff_by_segment: sparse (segments, routes) - times the first route
+       of each pair uses each segment, minus times the second one does
+       (the transposed diff_matrix of bootstrap_parallel)
+     - chunks: List[(SeedSequence, int)] - see iteration_chunks
+     - accumulator: DiffHistograms or DiffLists - what to add the
+       differences to, see SUMMARIES
+     - block_size: int - segments multiplied by a chunk's weights at a
+       time, to bound memory; by default enough for about 8 million
+       values per block
+
+    return
+     - an accumulator
+    """
+
+    num_segments, num_routes = diff_by_segment.shape
+    if block_size is None:
+        block_size = max(1, 8000000 // CHUNK_ITERATIONS)
+
+    diffs = accumulator(num_segments)
+    for seed_seq, size in chunks:
+        weights = bootstrap_weights(num_routes, size, np.random.default_rng(seed_seq))
+        weights_by_route = np.ascontiguousarray(weights.T)
+        for start in range(0, num_segments, block_size):
+            end = min(start + block_size, num_segments)
+            diffs.add(diff_by_segment[start:end] @ weights_by_route, start)
+        diffs.iterations += size
+
+    return diffs
+
+
+def share_arrays(arrays):
+    """Copy arrays into shared memory.
+
+    return
+     - (blocks, descriptors): the SharedMemory blocks, to close and unlink
+       when done, and picklable (name, shape, dtype) for attach_arrays
+    """
+
+    blocks, descriptors = [], []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        descriptors.append((block.name, array.shape, array.dtype.str))
+    return blocks, descriptors
+
+
+def attach_arrays(descriptors):
+    """Map arrays shared by share_arrays, without copying them."""
+
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in descriptors]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=block.buf)
+              for block, (_, shape, dtype) in zip(blocks, descriptors)]
+    return blocks, arrays
+
+
+def bootstrap_worker(descriptors, shape, chunks, accumulator, block_size):
+    """Run bootstrap_chunks in a worker process on the shared diff matrix."""
+
+    blocks, (data, indices, indptr) = attach_arrays(descriptors)
+    try:
+        diff_by_segment = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        return bootstrap_chunks(diff_by_segment, chunks, accumulator, block_size)
+    finally:
+        # drop the views into the blocks so they can close; rebinding rather
+        # than del, which would hide an error from before the matrix existed
+        diff_by_segment = data = indices = indptr = None
+        for block in blocks:
+            block.close()
+
+
+def bootstrap_parallel(diff_matrix, iterations, seed, workers, accumulator=DiffHistograms,
+                       block_size=None):
+    """Bootstrap across a pool of worker processes.
+
+    The diff matrix is shared with the workers through shared memory.
+    Chunks of resamples (see iteration_chunks) are dealt out to the workers
+    and each worker sums up its differences in an accumulator; these are
+    merged as they come back. With DiffHistograms, every segment's list of
+    differences is never held anywhere. The result is the same for any
+    number of workers.
+
+    params
+     - diff_matrix: sparse (routes, segments) - times the first route of
+       each pair uses each segment, minus times the second one does
+     - iterations: int - number of resamples
+     - seed: int - random seed
+     - workers: int - number of processes; 1 runs in this process
+     - accumulator: DiffHistograms or DiffLists, see bootstrap_chunks
+     - block_size: int - see bootstrap_chunks
+
+    return
+     - an accumulator
+    """
+
+    diff_by_segment = sparse.csr_matrix(diff_matrix.T)
+    chunks = iteration_chunks(iterations, seed)
+    if workers <= 1:
+        diffs = bootstrap_chunks(diff_by_segment, chunks, accumulator, block_size)
+        instrument.count("bootstrap_iterations_total", diffs.iterations)
+        return diffs
+
+    diffs = accumulator(diff_by_segment.shape[0])
+    blocks, descriptors = share_arrays([diff_by_segment.data, diff_by_segment.indices,
+                                        diff_by_segment.indptr])
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(bootstrap_worker, descriptors, diff_by_segment.shape,
+                                       chunks[worker::workers], accumulator, block_size)
+                       for worker in range(workers)]
+            for future in as_completed(futures):
+                done = diffs.iterations
+                diffs.merge(future.result())
+                print(f"Finished {diffs.iterations} of {iterations} iterations")
+                instrument.count("bootstrap_iterations_total", diffs.iterations - done)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return diffs
+
+
+def summarize(diffs, alpha):
+    """Summary statistics of each segment's resampled differences.
+
+    lower and upper are the alpha / 2 and 1 - alpha / 2 quantiles, so they
+    bound a 1 - alpha interval.
+
+    params
+     - diffs: DiffHistograms or DiffLists
+     - alpha: float - significance level
+
+    return
+     - Dict{str : List} - lower, upper, median, mean and significant, one
+       value per segment
+    """
+
+    iterations = diffs.iterations
+    lower = diffs.values_at(int(iterations * alpha / 2))
+    upper = diffs.values_at(min(int(iterations * (1 - alpha / 2)), iterations - 1))
+    median = diffs.values_at(int(iterations / 2))
+    return summary(lower, upper, median, diffs.means())
+
+
+def summary(lower, upper, median, mean):
+    significant = ((lower > 0) & (upper > 0)) | ((lower < 0) & (upper < 0))
+    return {'lower': lower.tolist(), 'upper': upper.tolist(), 'median': median.tolist(),
+            'significant': significant.tolist(), 'mean': mean.tolist()}
+
+
+def read_polylines(fname, as_arrays=False):
+    """Read route polylines and travel times from a routes CSV or store.
+
+    params
+     - fname: str - routes CSV or route store directory (see route_store.py)
+     - as_arrays: bool - give polylines as float64 arrays rather than lists
+
+    return
+     - features: Dict{str : List[(lon, lat)]} - polylines by route ID
+     - times: Dict{str : float} - travel time in seconds by route ID
+    """
+
+    features = {}
+    times = {}
+    header, routes = route_store.read_routes(fname)
+    for route in routes:
+        try:
+            route_id = route['ID']
+            t_sec = float(route['total_time_in_sec'])
+
+            # Flip lat/lon to lon/lat per GeoJSON spec
+            polyline = route['polyline_points'][:, ::-1]
+            if not as_arrays:
+                polyline = [tuple(point) for point in polyline.tolist()]
+
+            features[route_id] = polyline
+            times[route_id] = t_sec
+        except (TypeError, ValueError):
+            continue
+
+    return features, times
+
+
+def read_paired_polylines(f1, f2, metric, max_distance=None, as_arrays=False):
+    """Read two sets of routes with all their alternatives, and pair them up.
+
+    Each route of f1 is paired with at most one route of f2 with the same
+    ID, the alternatives closest in shape (see route_set.pair_alternatives).
+
+    params
+     - f1, f2: str - routes CSVs or stores
+     - metric: str - "hausdorff" or "frechet"
+     - max_distance: float - leave routes further apart than this (meters)
+       unpaired
+     - as_arrays: bool - give polylines as float64 arrays rather than lists
+
+    return
+     - features1, features2: Dict{str : List[(lon, lat)]} - polylines of
+       each pair, by "ID|name in f1|name in f2"
+    """
 
+    set1, set2 = RouteSet.read(f1), RouteSet.read(f2)
+    pairs = pair_alternatives(set1, set2, metric, max_distance)
+    print(f"Paired {len(pairs)} of {len(set1)} and {len(set2)} routes by {metric} distance.")
+
+    features1, features2 = {}, {}
+    for i, j, _ in pairs:
+        key = f"{set1.ids[i]}|{set1.names[i]}|{set2.names[j]}"
+        for features, routes, k in ((features1, set1, i), (features2, set2, j)):
+            # Flip lat/lon to lon/lat per GeoJSON spec
+            polyline = routes.route(k)[:, ::-1]
+            features[key] = polyline if as_arrays else [tuple(point) for point in polyline.tolist()]
+    return features1, features2
 
 
 def get_segments(dicts):
@@ -1,20 +1,38 @@
+import argparse
 import csv
 import sys
 import json
 import os
 
 from math import floor
-from random import random, randint
 
+import numpy as np
 from geopy.distance import vincenty
 from geopy.distance import great_circle
+from scipy.spatial import cKDTree
 from shapely.geometry import shape, Point
 
+import instrument
+
 ODPAIRS_PER_CITY = 2000
 OUTPUT_HEADER = ["ID", "origin_lon", "origin_lat", "destination_lon", "destination_lat", "straight_line_distance"]
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def odpairs_from_grid_centroids(input_geojson_fn, output_csv_fn, min_dist, max_dist):
+# geopy's Earth models, so vectorized distances agree with get_distance
+EARTH_RADIUS_KM = 6371.009
+WGS84_MAJOR_KM = 6378.137
+WGS84_MINOR_KM = 6356.7523142
+WGS84_FLATTENING = 1 / 298.257223563
+VINCENTY_ITERATIONS = 20
+
+# km per degree, for projecting centroids to a plane
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON = 111.320
+
+
+def odpairs_from_grid_centroids(input_geojson_fn, output_csv_fn, min_dist, max_dist,
+                                num_pairs=ODPAIRS_PER_CITY, seed=None, distance="vincenty",
+                                stratify=False, distribution=None, unique=False):
     """Randomly select origin-destination pairs from combinations of grid cells.
 
     Args:
@@ -22,50 +40,309 @@ def odpairs_from_grid_centroids(input_geojson_fn, output_csv_fn, min_dist, max_d
         output_csv_fn: path to output CSV file for od-pairs
         min_dist: only include od-pairs with a Euclidean distance greater than this threshold (km)
         max_dist: only include od-pairs with a Euclidean distance under this threshold (km)
+        num_pairs: number of od-pairs to generate
+        seed: seed for the random number generator; the same seed gives the same od-pairs
+        distance: "vincenty" or "great_circle"
+        stratify: fill 1 km distance bins to a quota instead of sampling
+            pairs uniformly (see stratified_od_pairs)
+        distribution: relative number of od-pairs wanted in each 1 km bin
+            from min_dist up, if stratified; equal numbers if None
+        unique: never repeat an (origin, destination) pair
     Returns:
         Void. Writes output origin-destination pairs along with straight-line distance to CSV file
     """
 
+    with instrument.span("read_centroids"):
+        lat, lon, rids, cids = read_centroids(input_geojson_fn)
+    print("{0} grid cells".format(len(lat)))
+    instrument.count("grid_cells_total", len(lat))
+
+    rng = np.random.default_rng(seed)
+    with instrument.span("sample_od_pairs", stratify=stratify):
+        if stratify:
+            bin_edges = distance_bin_edges(min_dist, max_dist)
+            if distribution is None:
+                distribution = [1] * (len(bin_edges) - 1)
+            quotas = bin_quotas(num_pairs, distribution, len(bin_edges) - 1)
+            origins, destinations, dist_km = stratified_od_pairs(lat, lon, bin_edges, quotas, rng,
+                                                                 distance, unique)
+        else:
+            origins, destinations, dist_km = sample_od_pairs(lat, lon, num_pairs, min_dist,
+                                                             max_dist, rng, distance, unique)
+    with instrument.span("write_od_pairs"):
+        write_od_pairs(output_csv_fn, lat, lon, rids, cids, origins, destinations, dist_km)
+    instrument.count("od_pairs_total", len(origins))
+
+    dist_bins = np.bincount(np.floor(dist_km).astype(np.int64), minlength=floor(max_dist))
+    for i in range(0, len(dist_bins)):
+        print("{0} between {1} and {2} km in length.".format(dist_bins[i], i, i+1))
+
+
+def read_centroids(input_geojson_fn):
+    """Read grid cell centroids and IDs.
+
+    Returns:
+        (lat, lon, rids, cids): float64 arrays of centroid latitude and
+        longitude, and lists of row and column IDs as strings
+    """
+
     with open(input_geojson_fn, 'r') as fin:
         gridcells = json.load(fin)['features']
 
-    for feature in gridcells:
-        feature['centroid'] = (shape(feature['geometry']).centroid.y, shape(feature['geometry']).centroid.x)
-        feature['properties']['rid'] = str(feature['properties']['rid'])
-        feature['properties']['cid'] = str(feature['properties']['cid'])
+    lat = np.empty(len(gridcells))
+    lon = np.empty(len(gridcells))
+    for i, feature in enumerate(gridcells):
+        centroid = shape(feature['geometry']).centroid
+        lat[i] = centroid.y
+        lon[i] = centroid.x
 
-    print("{0} grid cells".format(len(gridcells)))
-    routes_added = 0
+    rids = [str(feature['properties']['rid']) for feature in gridcells]
+    cids = [str(feature['properties']['cid']) for feature in gridcells]
+    return lat, lon, rids, cids
 
-    with open(output_csv_fn, 'w') as fout:
-        csvwriter = csv.writer(fout)
-        csvwriter.writerow(OUTPUT_HEADER)
-        num_features = len(gridcells)
-        dist_bins = [0] * max_dist
 
-        while routes_added < ODPAIRS_PER_CITY:
-            i = randint(0, num_features - 1)
-            j = randint(0, num_features - 1)
-            if i != j:
-                # randomly determine which point will be origin and which destination
-                feature1 = gridcells[i]
-                feature2 = gridcells[j]
+def sample_od_pairs(lat, lon, num_pairs, min_dist, max_dist, rng, distance="vincenty",
+                    unique=False, block_size=100000, max_empty_blocks=20):
+    """Draw random (origin, destination) pairs of points within a distance range.
+
+    Candidate pairs are drawn block_size at a time, and out-of-range ones are
+    rejected in bulk. Pairs are drawn with replacement, as the one-at-a-time
+    loop did, so the same pair may come up more than once unless unique.
+
+    Args:
+        lat, lon: float64 arrays of points
+        num_pairs: number of pairs to return
+        min_dist, max_dist: distance range in km, inclusive
+        rng: numpy.random.Generator
+        distance: "vincenty" or "great_circle"
+        unique: never repeat an (origin, destination) pair
+        block_size: candidate pairs drawn at once
+        max_empty_blocks: give up after this many blocks in a row add no
+            pairs (e.g. if no pair is in range, or every one is taken)
+    Returns:
+        (origins, destinations, dist_km): arrays of point indices and
+        distances; fewer than num_pairs if it gave up
+    """
+
+    distance_km = DISTANCES[distance]
+    num_points = len(lat)
+    if num_points < 2:
+        raise ValueError("Need at least two grid cells to make od-pairs")
+
+    seen = PairSet(num_points) if unique else None
+    # starting empty, so no pairs at all (e.g. num_pairs 0) is an empty sample
+    origins = [np.empty(0, dtype=np.int64)]
+    destinations = [np.empty(0, dtype=np.int64)]
+    dists = [np.empty(0, dtype=np.float64)]
+    found = 0
+    empty_blocks = 0
+    while found < num_pairs and empty_blocks < max_empty_blocks:
+        i = rng.integers(0, num_points, size=block_size)
+        j = rng.integers(0, num_points, size=block_size)
+        i, j = i[i != j], j[i != j]
 
-                dist_km = get_distance(feature1['centroid'], feature2['centroid'])
+        dist_km = distance_km(lat[i], lon[i], lat[j], lon[j])
+        keep = (dist_km >= min_dist) & (dist_km <= max_dist)
+        if seen is not None:
+            keep &= seen.new(i, j, keep)
+            seen.add(i[keep], j[keep])
+        origins.append(i[keep])
+        destinations.append(j[keep])
+        dists.append(dist_km[keep])
+        added = int(keep.sum())
+        empty_blocks = 0 if added else empty_blocks + 1
+        found += added
 
-                # aim for ~same number of routes as I can query the APIs for
-                if dist_km >= min_dist and dist_km <= max_dist:
-                    dist_bins[floor(dist_km)] += 1
-                    routes_added += 1
+    if found < num_pairs:
+        print("Only found {0} of {1} od-pairs between {2:g} and {3:g} km.".format(
+            found, num_pairs, min_dist, max_dist))
 
-                    if routes_added % 500 == 0:
-                        print("{0} routes added of {1}".format(routes_added, ODPAIRS_PER_CITY))
+    return (np.concatenate(origins)[:num_pairs], np.concatenate(destinations)[:num_pairs],
+            np.concatenate(dists)[:num_pairs])
 
-                    rowcolID = ";".join([feature1['properties']['rid'], feature1['properties']['cid'], feature2['properties']['rid'], feature2['properties']['cid']])
-                    csvwriter.writerow([rowcolID, round(feature1['centroid'][1], 6), round(feature1['centroid'][0], 6), round(feature2['centroid'][1], 6), round(feature2['centroid'][0], 6), round(dist_km, 6)])
 
-        for i in range(0, len(dist_bins)):
-            print("{0} between {1} and {2} km in length.".format(dist_bins[i], i, i+1))
+def distance_bin_edges(min_dist, max_dist, bin_width=1.0):
+    """Edges of the distance bins from min_dist to max_dist, in km."""
+
+    edges = np.arange(min_dist, max_dist, bin_width).tolist()
+    return np.array(edges + [max_dist], dtype=np.float64)
+
+
+def bin_quotas(num_pairs, distribution, num_bins):
+    """Split num_pairs across bins in proportion to distribution.
+
+    Rounds by largest remainder, so the quotas add up to num_pairs exactly.
+    """
+
+    weights = np.asarray(distribution, dtype=np.float64)
+    if len(weights) != num_bins:
+        raise ValueError(f"Need a weight for each of the {num_bins} distance bins, " +
+                         f"got {len(weights)}")
+    if (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("Distance bin weights must be non-negative and not all zero")
+
+    exact = num_pairs * weights / weights.sum()
+    quotas = np.floor(exact).astype(np.int64)
+    remainders = np.argsort(-(exact - quotas), kind='stable')
+    quotas[remainders[:num_pairs - quotas.sum()]] += 1
+    return quotas
+
+
+class PairSet(object):
+    """The (origin, destination) pairs picked so far, to keep od-pairs unique."""
+
+    def __init__(self, num_points):
+        self.num_points = num_points
+        self.keys = np.empty(0, dtype=np.int64)  # sorted
+
+    def key(self, origins, destinations):
+        return origins.astype(np.int64) * self.num_points + destinations
+
+    def new(self, origins, destinations, candidates):
+        """Which candidate pairs are new: not picked before, and not repeated
+        earlier in this batch.
+
+        return
+         - bool array - True where a candidate pair is new
+        """
+
+        keys = self.key(origins, destinations)
+        candidate_idx = np.flatnonzero(candidates)
+        unique_keys, first = np.unique(keys[candidate_idx], return_index=True)
+        unseen = ~np.isin(unique_keys, self.keys, assume_unique=True)
+
+        new = np.zeros(len(keys), dtype=bool)
+        new[candidate_idx[first[unseen]]] = True
+        return new
+
+    def add(self, origins, destinations):
+        self.keys = np.union1d(self.keys, self.key(origins, destinations))
+
+
+def stratified_od_pairs(lat, lon, bin_edges, quotas, rng, distance="vincenty", unique=False,
+                        block_size=100000, max_empty_blocks=20):
+    """Draw od-pairs to fill a quota of pairs in each distance bin.
+
+    Instead of drawing two cells and rejecting pairs that are too short or
+    too long, destinations are drawn inside the bin's annulus around each
+    origin: a point at a random angle and a distance drawn uniformly over
+    the annulus' area is snapped to the grid cell it falls in, found with a
+    KD-tree over the projected centroids. Points off the grid are rejected.
+    As grid cells are the same size, every pair of cells in a bin is about
+    equally likely, as with rejection sampling, but almost no draws are
+    wasted however narrow the bin.
+
+    The projection is only used to aim; every pair's distance is computed
+    exactly and checked against the bin.
+
+    Args:
+        lat, lon: float64 arrays of grid cell centroids
+        bin_edges: float64 array of bin edges in km; the last bin includes
+            its upper edge
+        quotas: number of pairs wanted in each bin
+        rng: numpy.random.Generator
+        distance: "vincenty" or "great_circle"
+        unique: never repeat an (origin, destination) pair
+        block_size: origins drawn at once
+        max_empty_blocks: give up on a bin after this many blocks in a row
+            add nothing to it (e.g. if it is longer than the city)
+    Returns:
+        (origins, destinations, dist_km): arrays of point indices and
+        distances, in random order
+    """
+
+    distance_km = DISTANCES[distance]
+    num_points = len(lat)
+    if num_points < 2:
+        raise ValueError("Need at least two grid cells to make od-pairs")
+
+    # project to km, and find the size of a grid cell there
+    lat0 = np.radians(lat.mean())
+    x = lon * KM_PER_DEG_LON * np.cos(lat0)
+    y = lat * KM_PER_DEG_LAT
+    half_width = grid_spacing(x) / 2
+    half_height = grid_spacing(y) / 2
+    cell_reach = 1.001 * np.hypot(half_width, half_height)
+    tree = cKDTree(np.column_stack((x, y)))
+
+    seen = PairSet(num_points) if unique else None
+    # starting empty, so no pairs at all (e.g. num_pairs 0) is an empty sample
+    origins = [np.empty(0, dtype=np.int64)]
+    destinations = [np.empty(0, dtype=np.int64)]
+    dists = [np.empty(0, dtype=np.float64)]
+    for b, quota in enumerate(np.asarray(quotas).tolist()):
+        lo, hi = bin_edges[b], bin_edges[b + 1]
+        last = b == len(quotas) - 1
+
+        # aim a little past the bin's edges, as the projection and snapping
+        # to centroids both move points; the exact distance decides
+        pad = 0.01 * hi + cell_reach
+        aim_lo, aim_hi = max(lo - pad, 0.0), hi + pad
+        found = 0
+        empty_blocks = 0
+        while found < quota and empty_blocks < max_empty_blocks:
+            i = rng.integers(0, num_points, size=block_size)
+            r = np.sqrt(rng.uniform(aim_lo ** 2, aim_hi ** 2, size=block_size))
+            theta = rng.uniform(0, 2 * np.pi, size=block_size)
+            target_x = x[i] + r * np.cos(theta)
+            target_y = y[i] + r * np.sin(theta)
+
+            # nothing found within a cell's reach gives j == num_points
+            _, j = tree.query(np.column_stack((target_x, target_y)),
+                              distance_upper_bound=cell_reach)
+            on_grid = j < num_points
+            i, j, target_x, target_y = i[on_grid], j[on_grid], target_x[on_grid], target_y[on_grid]
+            on_grid = ((np.abs(target_x - x[j]) <= half_width) &
+                       (np.abs(target_y - y[j]) <= half_height) & (i != j))
+            i, j = i[on_grid], j[on_grid]
+
+            dist_km = distance_km(lat[i], lon[i], lat[j], lon[j])
+            keep = (dist_km >= lo) & ((dist_km < hi) | (last & (dist_km <= hi)))
+            if seen is not None:
+                keep &= seen.new(i, j, keep)
+            keep &= np.cumsum(keep) <= quota - found
+            if seen is not None:
+                seen.add(i[keep], j[keep])
+
+            added = int(keep.sum())
+            empty_blocks = 0 if added else empty_blocks + 1
+            origins.append(i[keep])
+            destinations.append(j[keep])
+            dists.append(dist_km[keep])
+            found += added
+
+        if found < quota:
+            print("Only found {0} of {1} od-pairs between {2:g} and {3:g} km.".format(
+                found, quota, lo, hi))
+
+    origins, destinations, dists = [np.concatenate(v) for v in (origins, destinations, dists)]
+    order = rng.permutation(len(origins))
+    return origins[order], destinations[order], dists[order]
+
+
+def grid_spacing(v):
+    """Smallest gap between distinct coordinates: a grid cell's size along an axis."""
+
+    gaps = np.diff(np.unique(np.round(v, 9)))
+    gaps = gaps[gaps > 1e-6]
+    return gaps.min() if len(gaps) else 1.0
+
+
+def write_od_pairs(output_csv_fn, lat, lon, rids, cids, origins, destinations, dist_km):
+    """Write od-pairs, given as arrays of centroid indices, to CSV."""
+
+    # format each cell's fields once, not once per od-pair
+    cells = [(f"{rid};{cid}", str(round(cell_lon, 6)), str(round(cell_lat, 6)))
+             for rid, cid, cell_lat, cell_lon in zip(rids, cids, lat.tolist(), lon.tolist())]
+
+    with open(output_csv_fn, 'w') as fout:
+        csvwriter = csv.writer(fout)
+        csvwriter.writerow(OUTPUT_HEADER)
+        for i, j, dist in zip(origins.tolist(), destinations.tolist(), dist_km.tolist()):
+            origin_id, origin_lon, origin_lat = cells[i]
+            destination_id, destination_lon, destination_lat = cells[j]
+            csvwriter.writerow([origin_id + ";" + destination_id, origin_lon, origin_lat,
+                                destination_lon, destination_lat, round(dist, 6)])
 
 
 def get_distance(orig_pt, dest_pt):
@@ -80,18 +357,136 @@ def get_distance(orig_pt, dest_pt):
         return great_circle(orig_pt, dest_pt).kilometers
 
 
+def great_circle_km(lat1, lon1, lat2, lon2):
+    """Vectorized great-circle distance in km, as geopy's great_circle computes it."""
+
+    lat1, lon1, lat2, lon2 = [np.radians(v) for v in (lat1, lon1, lat2, lon2)]
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    delta_lon = lon2 - lon1
+    cos_delta_lon, sin_delta_lon = np.cos(delta_lon), np.sin(delta_lon)
+
+    d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lon) ** 2 +
+                           (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon) ** 2),
+                   sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon)
+    return EARTH_RADIUS_KM * d
+
+
+def vincenty_km(lat1, lon1, lat2, lon2):
+    """Vectorized Vincenty distance in km on the WGS-84 ellipsoid.
+
+    Follows geopy's vincenty, iterating every pair until all have converged
+    or the iteration limit is hit. Pairs that fail to converge (nearly
+    antipodal points) fall back on great_circle_km, as get_distance does.
+    """
+
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(v, dtype=np.float64))
+                              for v in (lat1, lon1, lat2, lon2)]
+    major, minor, f = WGS84_MAJOR_KM, WGS84_MINOR_KM, WGS84_FLATTENING
+
+    delta_lon = lon2 - lon1
+    reduced_lat1 = np.arctan((1 - f) * np.tan(lat1))
+    reduced_lat2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_reduced1, cos_reduced1 = np.sin(reduced_lat1), np.cos(reduced_lat1)
+    sin_reduced2, cos_reduced2 = np.sin(reduced_lat2), np.cos(reduced_lat2)
+
+    lambda_lon = delta_lon.copy()
+    active = np.ones(delta_lon.shape, dtype=bool)
+    sin_sigma = np.zeros(delta_lon.shape)
+    cos_sigma = np.zeros(delta_lon.shape)
+    sigma = np.zeros(delta_lon.shape)
+    cos_sq_alpha = np.zeros(delta_lon.shape)
+    cos2_sigma_m = np.zeros(delta_lon.shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(VINCENTY_ITERATIONS + 1):
+            if not active.any():
+                break
+            idx = np.flatnonzero(active)
+            lam = lambda_lon[idx]
+            s1, c1, s2, c2 = sin_reduced1[idx], cos_reduced1[idx], sin_reduced2[idx], cos_reduced2[idx]
+            sin_lambda, cos_lambda = np.sin(lam), np.cos(lam)
+
+            ss = np.sqrt((c2 * sin_lambda) ** 2 + (c1 * s2 - s1 * c2 * cos_lambda) ** 2)
+            cs = s1 * s2 + c1 * c2 * cos_lambda
+            sg = np.arctan2(ss, cs)
+            sin_alpha = c1 * c2 * sin_lambda / ss
+            csa = 1 - sin_alpha ** 2
+            c2sm = np.where(csa != 0, cs - 2 * (s1 * s2 / csa), 0.0)
+            C = f / 16. * csa * (4 + f * (4 - 3 * csa))
+
+            new_lambda = delta_lon[idx] + (1 - C) * f * sin_alpha * (
+                sg + C * ss * (c2sm + C * cs * (-1 + 2 * c2sm ** 2)))
+
+            sin_sigma[idx], cos_sigma[idx], sigma[idx] = ss, cs, sg
+            cos_sq_alpha[idx], cos2_sigma_m[idx] = csa, c2sm
+            lambda_lon[idx] = new_lambda
+
+            # coincident points are done, at distance 0
+            done = (ss == 0) | (np.abs(new_lambda - lam) <= 10e-12)
+            active[idx[done]] = False
+
+        u_sq = cos_sq_alpha * (major ** 2 - minor ** 2) / minor ** 2
+        A = 1 + u_sq / 16384. * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        B = u_sq / 1024. * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4. * (
+            cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) -
+            B / 6. * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos2_sigma_m ** 2)))
+        dist_km = np.where(sin_sigma == 0, 0.0, minor * A * (sigma - delta_sigma))
+
+    if active.any():
+        dist_km[active] = great_circle_km(np.degrees(lat1[active]), np.degrees(lon1[active]),
+                                          np.degrees(lat2[active]), np.degrees(lon2[active]))
+    return dist_km
+
+
+DISTANCES = {"vincenty": vincenty_km, "great_circle": great_circle_km}
+
+
 def main():
-    min_dist = 0
-    max_dist = 20  # distance in KM
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", default=SCRIPT_DIR + "/data/chicago_grid.geojson",
+                        help="GeoJSON of grid cells, as written by grid_creation.py.")
+    parser.add_argument("--output", default=SCRIPT_DIR + "/data/chicago_od_pairs.csv")
+    parser.add_argument("--num-pairs", type=int, default=ODPAIRS_PER_CITY)
+    parser.add_argument("--min-dist", type=float, default=0, help="Shortest od-pair, in km.")
+    parser.add_argument("--max-dist", type=float, default=20, help="Longest od-pair, in km.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed, for reproducible od-pairs.")
+    parser.add_argument("--distance", choices=sorted(DISTANCES), default="vincenty")
+    parser.add_argument("--stratify", action="store_true",
+                        help="Fill each 1 km distance bin to a quota instead of sampling uniformly.")
+    parser.add_argument("--bin-quota", type=int, default=None,
+                        help="With --stratify, od-pairs per bin (overrides --num-pairs).")
+    parser.add_argument("--distribution", default=None,
+                        help="With --stratify, comma separated relative number of od-pairs " +
+                             "per 1 km bin, from --min-dist up (default equal).")
+    parser.add_argument("--unique", action="store_true",
+                        help="Never repeat an (origin, destination) pair.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="generate_od_pairs")
 
-    input_geojson_fn = SCRIPT_DIR + "/data/chicago_grid.geojson"
-    output_csv_fn = SCRIPT_DIR + "/data/chicago_od_pairs.csv"
+    num_pairs = args.num_pairs
+    distribution = None
+    if args.distribution:
+        distribution = [float(w) for w in args.distribution.split(",")]
+    if args.bin_quota is not None:
+        num_bins = len(distance_bin_edges(args.min_dist, args.max_dist)) - 1
+        num_pairs = args.bin_quota * num_bins
+        distribution = None
 
-    odpairs_from_grid_centroids(input_geojson_fn = input_geojson_fn,
-                                output_csv_fn = output_csv_fn,
-                                min_dist = min_dist,
-                                max_dist = max_dist)
+    odpairs_from_grid_centroids(input_geojson_fn = args.grid,
+                                output_csv_fn = args.output,
+                                min_dist = args.min_dist,
+                                max_dist = args.max_dist,
+                                num_pairs = num_pairs,
+                                seed = args.seed,
+                                distance = args.distance,
+                                stratify = args.stratify or args.bin_quota is not None,
+                                distribution = distribution,
+                                unique = args.unique)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,48 @@
+"""Write a GeoJSON FeatureCollection one feature at a time.
+
+geojson.dump needs every Feature of a FeatureCollection in memory before it
+writes anything. FeatureWriter writes each feature as soon as it is given
+one, so memory stays flat however many features there are, and the file it
+writes is the same text geojson.dump would have written.
+
+Usage:
+    with FeatureWriter(fn) as writer:
+        for feature in features:
+            writer.write(feature)
+"""
+
+from geojson.codec import GeoJSONEncoder
+from geojson.mapping import to_mapping
+
+
+class FeatureWriter(object):
+
+    def __init__(self, fn):
+        """Start a FeatureCollection in fn, replacing anything already there."""
+
+        self.fn = fn
+        self.count = 0
+        self.encoder = GeoJSONEncoder(allow_nan=False)  # what geojson.dump uses
+        self.fout = open(fn, 'w')
+        self.fout.write('{"type": "FeatureCollection", "features": [')
+
+    def write(self, feature):
+        """Add one feature: a geojson.Feature or a plain dict shaped like one."""
+
+        if self.count:
+            self.fout.write(", ")
+        self.fout.write(self.encoder.encode(to_mapping(feature)))
+        self.count += 1
+
+    def close(self):
+        """Finish the FeatureCollection; the file is not valid GeoJSON until then."""
+
+        if not self.fout.closed:
+            self.fout.write("]}")
+            self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
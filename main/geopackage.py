@@ -0,0 +1,227 @@
+"""Write line segments to a GeoPackage, with an R-tree spatial index.
+
+A GeoPackage is an SQLite database laid out by the OGC GeoPackage standard
+(http://www.geopackage.org/spec130/), so QGIS and GDAL open it directly and
+use its R-tree index to draw and filter only what is in view. It is written
+here with the standard library's sqlite3:
+ - the metadata tables the standard requires (spatial reference systems,
+   contents, geometry columns, extensions),
+ - one feature table of LineStrings in WGS84 (lon, lat), plus attribute
+   columns,
+ - an rtree_<table>_geom virtual table with each feature's bounding box,
+   filled in batch by batch along with the features, and the standard's
+   triggers that keep it up to date when the file is edited later (added
+   last, as they need functions plain SQLite does not have).
+
+Geometries are GeoPackage binary blobs (a small header with the bounding
+box, then WKB), built for a whole batch of segments at once with NumPy.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+APPLICATION_ID = 0x47504B47  # "GPKG"
+USER_VERSION = 10300  # GeoPackage 1.3.0
+SRS_ID = 4326
+WGS84_WKT = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+             'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+             'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,'
+             'AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]')
+
+SQL_TYPES = {'int': 'INTEGER', 'float': 'DOUBLE', 'bool': 'BOOLEAN', 'str': 'TEXT'}
+
+# header (magic, version, flags: little endian with an [minx, maxx, miny,
+# maxy] envelope, srs id, envelope), then a little endian WKB LineString
+# of two points
+SEGMENT_BLOB = np.dtype([('magic', 'S2'), ('version', 'u1'), ('flags', 'u1'), ('srs_id', '<i4'),
+                         ('envelope', '<f8', 4), ('byte_order', 'u1'), ('wkb_type', '<u4'),
+                         ('num_points', '<u4'), ('points', '<f8', (2, 2))])
+WKB_LINESTRING = 2
+
+METADATA_SQL = """
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+    organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL, description TEXT);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT uk_gc_table_name UNIQUE (table_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+CREATE TABLE gpkg_extensions (
+    table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL, scope TEXT NOT NULL,
+    CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+"""
+
+# from the standard's R-tree extension (F.3); t is the table and c the
+# geometry column. The ST_ functions are provided by whatever edits the
+# file (e.g. GDAL), not by plain SQLite, so these only run there.
+RTREE_TRIGGERS_SQL = """
+CREATE TRIGGER rtree_{t}_{c}_insert AFTER INSERT ON {t}
+WHEN (new.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (
+    NEW.fid, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER rtree_{t}_{c}_update1 AFTER UPDATE OF {c} ON {t}
+WHEN OLD.fid = NEW.fid AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (
+    NEW.fid, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER rtree_{t}_{c}_update2 AFTER UPDATE OF {c} ON {t}
+WHEN OLD.fid = NEW.fid AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid;
+END;
+CREATE TRIGGER rtree_{t}_{c}_update3 AFTER UPDATE ON {t}
+WHEN OLD.fid != NEW.fid AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid;
+  INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (
+    NEW.fid, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER rtree_{t}_{c}_update4 AFTER UPDATE ON {t}
+WHEN OLD.fid != NEW.fid AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM rtree_{t}_{c} WHERE id IN (OLD.fid, NEW.fid);
+END;
+CREATE TRIGGER rtree_{t}_{c}_delete AFTER DELETE ON {t}
+WHEN old.{c} NOT NULL
+BEGIN
+  DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid;
+END;
+"""
+
+
+def segment_blobs(segments):
+    """GeoPackage geometry blobs of LineStrings.
+
+    params
+     - segments: float64 array (n, 2, 2) - the two (lon, lat) points of
+       each segment
+
+    return
+     - (blobs, envelopes): List[bytes], and float64 array (n, 4) of each
+       segment's minx, maxx, miny, maxy
+    """
+
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+    envelopes = np.column_stack((segments[:, :, 0].min(axis=1), segments[:, :, 0].max(axis=1),
+                                 segments[:, :, 1].min(axis=1), segments[:, :, 1].max(axis=1)))
+
+    records = np.zeros(len(segments), dtype=SEGMENT_BLOB)
+    records['magic'] = b'GP'
+    records['flags'] = 0b00000011
+    records['srs_id'] = SRS_ID
+    records['envelope'] = envelopes
+    records['byte_order'] = 1
+    records['wkb_type'] = WKB_LINESTRING
+    records['num_points'] = 2
+    records['points'] = segments
+
+    data = records.tobytes()
+    size = SEGMENT_BLOB.itemsize
+    return [data[i:i + size] for i in range(0, len(data), size)], envelopes
+
+
+class GeoPackageWriter(object):
+
+    def __init__(self, fn, table, fields):
+        """Start a GeoPackage with one table of line segments, replacing fn.
+
+        params
+         - fn: str - output .gpkg file
+         - table: str - feature table name (letters, digits and _)
+         - fields: List[(str, str)] - attribute column names and types, one
+           of SQL_TYPES
+        """
+
+        if os.path.exists(fn):
+            os.remove(fn)
+        self.fn = fn
+        self.table = table
+        self.fields = [name for name, _ in fields]
+        self.count = 0
+        self.bounds = [np.inf, np.inf, -np.inf, -np.inf]  # min x, min y, max x, max y
+
+        self.conn = sqlite3.connect(fn)
+        self.conn.execute(f"PRAGMA application_id = {APPLICATION_ID}")
+        self.conn.execute(f"PRAGMA user_version = {USER_VERSION}")
+        self.conn.executescript(METADATA_SQL)
+        self.conn.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            [("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+             ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+             ("WGS 84 geodetic", SRS_ID, "EPSG", SRS_ID, WGS84_WKT, None)])
+
+        columns = "".join(f', "{name}" {SQL_TYPES[kind]}' for name, kind in fields)
+        self.conn.execute(f'CREATE TABLE "{table}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          f'geom LINESTRING{columns})')
+        self.conn.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) " +
+                          "VALUES (?, 'features', ?, ?)", (table, table, SRS_ID))
+        self.conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'LINESTRING', ?, 0, 0)",
+                          (table, SRS_ID))
+        self.conn.execute(f"CREATE VIRTUAL TABLE rtree_{table}_geom USING rtree(id, minx, maxx, miny, maxy)")
+
+        names = "".join(f', "{name}"' for name in self.fields)
+        self._insert = f'INSERT INTO "{table}" (geom{names}) VALUES (?{", ?" * len(self.fields)})'
+
+    def write(self, segments, columns):
+        """Add a batch of segments.
+
+        params
+         - segments: float64 array (n, 2, 2) - (lon, lat) points of each
+         - columns: Dict{str : sequence} - n values for each field
+        """
+
+        blobs, envelopes = segment_blobs(segments)
+        if len(blobs) == 0:
+            return
+        values = [list(columns[name]) for name in self.fields]
+        self.conn.executemany(self._insert, zip(blobs, *values))
+
+        # fids count up from 1 in a new table
+        ids = range(self.count + 1, self.count + len(blobs) + 1)
+        self.conn.executemany(f"INSERT INTO rtree_{self.table}_geom VALUES (?, ?, ?, ?, ?)",
+                              zip(ids, *envelopes.T.tolist()))
+        self.bounds = [min(self.bounds[0], envelopes[:, 0].min()),
+                       min(self.bounds[1], envelopes[:, 2].min()),
+                       max(self.bounds[2], envelopes[:, 1].max()),
+                       max(self.bounds[3], envelopes[:, 3].max())]
+        self.count += len(blobs)
+
+    def close(self):
+        """Finish the file: its extent, and the spatial index's metadata."""
+
+        if self.conn is None:
+            return
+
+        t, c = self.table, "geom"
+        if self.count:
+            self.conn.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? " +
+                              "WHERE table_name = ?", (*map(float, self.bounds), t))
+        self.conn.execute("INSERT INTO gpkg_extensions VALUES (?, ?, 'gpkg_rtree_index', " +
+                          "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                          (t, c))
+        self.conn.executescript(RTREE_TRIGGERS_SQL.format(t=t, c=c))
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -12,17 +12,28 @@ import argparse
 import time
 import json
 import ast
+import threading
 import traceback
 import urllib.parse
 import urllib.request
 import argparse
 import datetime
+import os
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from random import random
-from time import strftime
 
 import googlemaps
 
+import instrument
+import polyline
+from checkpoint import Checkpoint
+from route_cache import RouteCache
+from route_store import ROUTE_FIELDS, RouteStoreWriter
+
+RATE_WINDOW = 100  # od-pairs per routes_per_second observation
+
 class API(object, metaclass = ABCMeta):
 
     def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, output_num=1):
@@ -36,8 +47,11 @@ class API(object, metaclass = ABCMeta):
             self.get_alternatives = False
         self.output_num = output_num
         self.logfile_fn = "logs/chicago_grid_PLATFORM_log.txt"
+        self.log = None  # opened on first write, see write_to_log
         self.queries_made = 0
         self.exceptions = 0
+        # guards the counters and the log file when queried from many threads
+        self.lock = threading.RLock()
 
     @classmethod
     @abstractmethod
@@ -46,16 +60,38 @@ class API(object, metaclass = ABCMeta):
         return [Route()]
 
     def write_to_log(self, mess_type="LOG", message=""):
-        with open(self.logfile_fn, 'a') as fout:
-            fout.write("[{0}] At {1}: {2}. {3} queries made.\n".format(mess_type, strftime("%Y-%m-%d %H:%M:%S"), message, self.queries_made))
+        # one buffered handle, kept open, rather than reopening the file per line
+        with self.lock:
+            if self.log is None:
+                self.log = instrument.LogFile(self.logfile_fn)
+            self.log.write(mess_type, message, "{0} queries made.".format(self.queries_made))
+        instrument.event("log", level=mess_type, message=message)
+
+    def is_cached(self, origin, destination):
+        return False
 
     def end(self):
         self.write_to_log("END", "Ending script")
+        if self.log is not None:
+            self.log.close()
 
     def reset(self):
-        self.queries_made = 0
-        self.exceptions = 0
+        with self.lock:
+            self.queries_made = 0
+            self.exceptions = 0
         self.write_to_log("RESET", "Returned counts to zero")
+        if self.log is not None:
+            self.log.flush()
+
+    def count_exception(self):
+        with self.lock:
+            self.exceptions += 1
+        instrument.count("api_exceptions_total")
+
+    def count_query(self):
+        with self.lock:
+            self.queries_made += 1
+        instrument.count("api_queries_total")
 
 
 class Route(dict):
@@ -73,84 +109,122 @@ class Route(dict):
 
 class GoogleAPI(API):
 
-    def __init__(self, api_key_fn, api_limit = 2500, stop_at_api_limit = True, output_num = 1):
+    def __init__(self, api_key_fn, api_limit = 2500, stop_at_api_limit = True, output_num = 1,
+                 cache = None):
         super().__init__(api_key_fn, api_limit, stop_at_api_limit, output_num)
         self.logfile_fn = self.logfile_fn.replace("PLATFORM", "google")
         self.write_to_log("START", "Starting Google API")
         self.client = None
+        self.cache = cache
+        self.mode = "driving"
+
+    def is_cached(self, origin, destination):
+        return self.cache is not None and self.cache.contains(
+            origin, destination, self.mode, self.get_alternatives)
 
     def get_routes(self, origin, destination, route_id):
-        if not self.client:
-            self.connect_to_api()
+        route_jsons = None
+        if self.cache is not None:
+            route_jsons = self.cache.get(origin, destination, self.mode, self.get_alternatives)
+        from_cache = route_jsons is not None
+        if from_cache:
+            instrument.count("api_cache_hits_total")
+
+        if not from_cache:
+            if not self.client:
+                self.connect_to_api()
+
+            start = time.perf_counter()
+            try:
+                route_jsons = self.client.directions(
+                    origin = origin,
+                    destination = destination,
+                    units = "metric",
+                    mode = self.mode,
+                    departure_time = "now",
+                    alternatives = self.get_alternatives
+                )
 
-        routes = []
-        try:
-            route_jsons = self.client.directions(
-                origin = origin,
-                destination = destination,
-                units = "metric",
-                mode = "driving",
-                departure_time = "now",
-                alternatives = self.get_alternatives
-            )
+            except Exception:
+                traceback.print_exc()
+                self.count_exception()
+                self.write_to_log("EXCEPTION", "Connection failed")
+                return [Route()]
+
+            finally:
+                # failed and timed out queries count towards latency too
+                instrument.observe("api_latency_seconds", time.perf_counter() - start)
 
-        except Exception:
-            traceback.print_exc()
-            self.exceptions += 1
-            self.write_to_log("EXCEPTION", "Connection failed")
-            return [Route()]
-                        
         try:
-            idx = 0
-            for route_json in route_jsons:
-                # no waypoints - take first leg, which is entire trip
-                route = route_json.get('legs')[0]
-
-                # overview_polyline would provide smoothed overall line
-                # overviewPolylinePoints = route_json.get('overview_polyline').get('points')
-                # instead, we take the least-smoothed version at the step-level
-                route_steps = route.get('steps')
-                route_points = []
-                for step in route_steps:
-                    polyline_str = step.get("polyline", {"points":""}).get("points")
-                    polyline_pts = self.decode(polyline_str)
-                    # check if first point duplicates last point from previous step
-                    if polyline_pts and route_points and polyline_pts[0] == route_points[-1]:
-                        polyline_pts.pop(0)
-                    route_points.extend(polyline_pts)
-
-                total_time_sec = route.get('duration').get('value')
-                total_distance_meters = route.get('distance').get('value')
-
-                maneuvers = list()
-                for i in range(0, len(route_steps)):
-                    if 'maneuver' in route_steps[i]:
-                        maneuvers.append(route_steps[i].get('maneuver'))
-
-                name = "main"
-                if idx > 0:
-                    name = "alternative {0}".format(idx)
-
-                routes.append(Route(route_id = route_id, name = name,
-                    route_points = route_points, time_sec = total_time_sec,
-                    distance_meters = total_distance_meters, maneuvers = maneuvers))
-
-                idx += 1
+            routes = self.parse_routes(route_jsons, route_id)
 
         except Exception:
             traceback.print_exc()
-            self.exceptions += 1
+            self.count_exception()
             try:
-                self.write_to_log("EXCEPTION", str(route_json))
+                self.write_to_log("EXCEPTION", str(route_jsons))
             except Exception:
                 traceback.print_exc()
                 self.write_to_log("EXCEPTION", "Route processing failed. JSON not valid")
             return [Route()]
 
-        self.queries_made += 1
+        if not from_cache:
+            if self.cache is not None:
+                self.cache.put(route_id, origin, destination, self.mode,
+                               self.get_alternatives, route_jsons)
+            self.count_query()
         return routes
-        
-    
+
+    def parse_routes(self, route_jsons, route_id):
+        """Turn the raw JSON from client.directions into a list of Routes.
+
+        This is separate from get_routes so cached responses can be
+        re-parsed without querying the API again.
+        """
+
+        routes = []
+        idx = 0
+        for route_json in route_jsons:
+            # no waypoints - take first leg, which is entire trip
+            route = route_json.get('legs')[0]
+
+            # overview_polyline would provide smoothed overall line
+            # overviewPolylinePoints = route_json.get('overview_polyline').get('points')
+            # instead, we take the least-smoothed version at the step-level
+            route_steps = route.get('steps')
+            polyline_strs = [step.get("polyline", {"points":""}).get("points")
+                             for step in route_steps]
+            # decode all steps at once, dropping the first point of a step
+            # when it duplicates the last point from the previous step
+            coords, offsets = polyline.decode_many(polyline_strs)
+            route_points = [tuple(point) for point in
+                            polyline.join_steps(coords, offsets).tolist()]
+
+            total_time_sec = route.get('duration').get('value')
+            total_distance_meters = route.get('distance').get('value')
+
+            maneuvers = list()
+            for i in range(0, len(route_steps)):
+                if 'maneuver' in route_steps[i]:
+                    maneuvers.append(route_steps[i].get('maneuver'))
+
+            name = "main"
+            if idx > 0:
+                name = "alternative {0}".format(idx)
+
+            routes.append(Route(route_id = route_id, name = name,
+                route_points = route_points, time_sec = total_time_sec,
+                distance_meters = total_distance_meters, maneuvers = maneuvers))
+
+            idx += 1
+
+        return routes
+
+    def end(self):
+        if self.cache is not None:
+            self.write_to_log("CACHE", self.cache.stats())
+        super().end()
+
     def connect_to_api(self):
         # ValueError if invalid API-Key
         self.client = googlemaps.Client(key=self.api_key)
@@ -161,9 +235,7 @@ class GoogleAPI(API):
         http://code.google.com/apis/maps/documentation/polylinealgorithm.html
 
         This is a generic method that returns a list of (latitude, longitude)
-        tuples.
-
-        Code taken from: https://gist.github.com/signed0/2031157
+        tuples. See polyline.py for the vectorized decoder it wraps.
 
         :param point_str: Encoded polyline string.
         :type point_str: string
@@ -172,63 +244,101 @@ class GoogleAPI(API):
 
         '''
 
-        # sone coordinate offset is represented by 4 to 5 binary chunks
-        coord_chunks = [[]]
-        for char in point_str:
-
-            # convert each character to decimal from ascii
-            value = ord(char) - 63
-
-            # values that have a chunk following have an extra 1 on the left
-            split_after = not (value & 0x20)
-            value &= 0x1F
-
-            coord_chunks[-1].append(value)
-
-            if split_after:
-                coord_chunks.append([])
-
-        del coord_chunks[-1]
-
-        coords = []
-
-        for coord_chunk in coord_chunks:
-            coord = 0
-
-            for i, chunk in enumerate(coord_chunk):
-                coord |= chunk << (i * 5)
-
-            #there is a 1 on the right if the coord is negative
-            if coord & 0x1:
-                coord = ~coord #invert
-            coord >>= 1
-            coord /= 100000.0
-
-            coords.append(coord)
-
-        # convert the 1 dimensional list to a 2 dimensional list and offsets to
-        # actual values
-        points = []
-        prev_x = 0
-        prev_y = 0
-        for i in range(0, len(coords) - 1, 2):
-            if coords[i] == 0 and coords[i + 1] == 0:
-                continue
+        return [tuple(point) for point in polyline.decode(point_str).tolist()]
+
+
+class TokenBucket(object):
+    """Rate limiter shared by all workers querying the same API.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; each
+    query takes one token, blocking until one is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_routes_concurrently(api, od_pairs, workers=4, qps=5.0):
+    """Query routes for many od-pairs with a pool of worker threads.
+
+    All workers share one token bucket, so the API sees at most `qps`
+    queries per second no matter how many workers there are. If the API
+    stops at its limit, no query past `api.api_limit` is issued.
+
+    params
+     - api: API - e.g. GoogleAPI; anything whose client has .directions()
+       works, so a stubbed googlemaps.Client can be used in place of it
+     - od_pairs: List[Dict] - dicts with 'id', 'origin', 'destination'
+     - workers: int - number of threads making queries
+     - qps: float - queries per second shared between all workers
+
+    return
+     - generator of (od_pair, List[Route]), in the same order as od_pairs,
+       so output does not depend on which worker finished first
+    """
+
+    bucket = TokenBucket(qps, capacity=max(1, workers))
+    issued = [0]
+    issued_lock = threading.Lock()
+
+    def fetch(od_pair):
+        # cached pairs neither count towards the limit nor wait for a token
+        if api.is_cached(od_pair['origin'], od_pair['destination']):
+            return api.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
+
+        with issued_lock:
+            if api.stop_at_api_limit and issued[0] >= api.api_limit:
+                return None
+            issued[0] += 1
+        bucket.acquire()
+        return api.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
+
+    # keep a bounded window of queries in flight and yield them in order
+    pending = deque()
+    od_iter = iter(od_pairs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            od_pair = next(od_iter, None)
+            if od_pair is not None:
+                pending.append((od_pair, executor.submit(fetch, od_pair)))
+
+        for _ in range(workers * 4):
+            submit_next()
 
-            prev_x += coords[i + 1]
-            prev_y += coords[i]
-            # a round to 6 digits ensures that the floats are the same as when
-            # they were encoded
-            points.append((round(prev_y, 6), round(prev_x, 6)))
+        try:
+            while pending:
+                od_pair, future = pending.popleft()
+                routes = future.result()
+                if routes is None:
+                    api.write_to_log("API LIMIT", f"Stopped before route ID {od_pair['id']}")
+                    break
 
-        return points
+                yield od_pair, routes
+                submit_next()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
-def main():
-    input_odpairs_fn = "data/chicago_od_pairs.csv"
-    output_routes_g_fn = "data/chicago_routes_gmaps.csv"
+def read_od_pairs(input_odpairs_fn):
+    """Read all origin/destination pairs from CSV into list."""
 
-    # Read all origin/destination pairs from CSV into list
     od_pairs = []
     with open(input_odpairs_fn, 'r') as fin:
         # open file with origin long, origin lat, dest long, dest lat
@@ -257,43 +367,144 @@ def main():
                 'destination' : destination
             })  # this style is very javascript
 
-    # Do routing requests for each o/d pair
-    with open(output_routes_g_fn, 'w') as foutg:
-        fieldnames = ['ID', 'name', 'polyline_points', 'total_time_in_sec',
-                      'total_distance_in_meters', 'number_of_steps', 'maneuvers']
-        csvwriter_g = csv.DictWriter(foutg, fieldnames=fieldnames)
+    return od_pairs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of concurrent query threads; 1 queries serially.")
+    parser.add_argument("--qps", type=float, default=5.0,
+                        help="Queries per second shared by all workers (only with --workers > 1).")
+    parser.add_argument("--cache", default="data/google_directions_cache.sqlite",
+                        help="SQLite file caching raw API responses.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always query the API and do not store responses.")
+    parser.add_argument("--cache-ttl-hours", type=float, default=7 * 24,
+                        help="Cached responses older than this are queried again.")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="Least recently used responses are evicted past this many.")
+    parser.add_argument("--store", action="store_true",
+                        help="Write a route store (see route_store.py) instead of a CSV.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip od-pairs finished by an earlier run and append to its output.")
+    parser.add_argument("--od-pairs", default="data/chicago_od_pairs.csv",
+                        help="od-pairs CSV, as written by generate_od_pairs.py.")
+    parser.add_argument("--output", default=None,
+                        help="Routes CSV (or store, with --store) to write; " +
+                             "data/chicago_routes_gmaps.csv (.routes) if not given.")
+    parser.add_argument("--api-key", default="api_keys/google.txt",
+                        help="File holding the Google Maps API key.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="get_routes")
+
+    input_odpairs_fn = args.od_pairs
+    output_routes_g_fn = "data/chicago_routes_gmaps.csv"
+    if args.store:
+        output_routes_g_fn = "data/chicago_routes_gmaps.routes"
+    output_routes_g_fn = args.output or output_routes_g_fn
+    checkpoint_fn = output_routes_g_fn + ".checkpoint"
+
+    od_pairs = read_od_pairs(input_odpairs_fn)
+    resume = args.resume and os.path.exists(output_routes_g_fn)
+
+    # Routes go either to a route store or to a CSV with the polylines
+    # written out as lists of tuples
+    if args.store:
+        store_writer = RouteStoreWriter(output_routes_g_fn, ROUTE_FIELDS, append = resume)
+        output_files = store_writer.files
+        write_route = store_writer.write
+    else:
+        foutg = open(output_routes_g_fn, 'a' if resume else 'w')
+        csvwriter_g = csv.DictWriter(foutg, fieldnames=ROUTE_FIELDS)
+        output_files = [foutg]
+        write_route = csvwriter_g.writerow
+
+    checkpoint = Checkpoint(checkpoint_fn, output_files, resume = resume)
+    if not args.store and foutg.tell() == 0:
         csvwriter_g.writeheader()
-        g = GoogleAPI(api_key_fn = "api_keys/google.txt", api_limit = 2400, 
-                      stop_at_api_limit = True, output_num = 2)
-        
-        g.write_to_log("LOG", "Starting script.")
 
-        for od_pair in od_pairs:
-            try:
-                routes_g = g.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
-                for route in routes_g:
-                    csvwriter_g.writerow(route)
-
-                if (g.exceptions + 1) % 40 == 0:
-                    g.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format((g.exceptions, m.exceptions)))
-                    #break
-
-                if g.queries_made % 10 == 0:
-                    g.write_to_log("LOG", "Every 10 query check")
-
-                # when almost hit API limit, shutdown
-                if g.stop_at_api_limit and g.queries_made == g.api_limit:
-                    g.write_to_log("API LIMIT", f"Current route ID is {od_pair['id']}")
-                    g.reset()
-                else:
-                    # be nice to API
-                    time.sleep(1 + (0.5 - random()))
-
-            except KeyboardInterrupt:
-                traceback.print_exc()
-                break
+    od_pairs = [od_pair for od_pair in od_pairs if not checkpoint.is_done(od_pair['id'])]
+    print(f"{len(checkpoint.done)} od-pairs already done, {len(od_pairs)} to go.")
+
+    # routes per second over each window of RATE_WINDOW od-pairs
+    window = {'od_pairs': 0, 'routes': 0, 'start': time.perf_counter()}
+
+    def write_routes(od_pair, routes_g):
+        for route in routes_g:
+            write_route(route)
+
+        # a failed query returns a single empty Route; retry it on resume
+        if not (len(routes_g) == 1 and not routes_g[0]['ID']):
+            checkpoint.mark_done(od_pair['id'])
+            window['routes'] += len(routes_g)
+            instrument.count("routes_written_total", len(routes_g))
+
+        window['od_pairs'] += 1
+        if window['od_pairs'] == RATE_WINDOW:
+            now = time.perf_counter()
+            instrument.observe("routes_per_second", window['routes'] / (now - window['start']),
+                               buckets=instrument.RATE_BUCKETS)
+            instrument.flush()
+            window.update(od_pairs=0, routes=0, start=now)
+
+    cache = None
+    if not args.no_cache:
+        cache = RouteCache(args.cache, ttl_sec = args.cache_ttl_hours * 3600,
+                           max_entries = args.cache_max_entries)
+    g = GoogleAPI(api_key_fn = args.api_key, api_limit = 2400, 
+                  stop_at_api_limit = True, output_num = 2, cache = cache)
+    
+    g.write_to_log("LOG", "Starting script.")
 
-        g.end()
+    # Do routing requests for each o/d pair
+    with instrument.span("get_routes", workers=args.workers):
+        try:
+            if args.workers > 1:
+                try:
+                    for od_pair, routes_g in fetch_routes_concurrently(g, od_pairs, args.workers, args.qps):
+                        write_routes(od_pair, routes_g)
+                except KeyboardInterrupt:
+                    traceback.print_exc()
+                return
+
+            for od_pair in od_pairs:
+                try:
+                    cached = g.is_cached(od_pair['origin'], od_pair['destination'])
+                    routes_g = g.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
+                    write_routes(od_pair, routes_g)
+
+                    if cached:  # no query made, so no need to wait
+                        continue
+
+                    if (g.exceptions + 1) % 40 == 0:
+                        g.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format(g.exceptions))
+                        #break
+
+                    if g.queries_made % 10 == 0:
+                        g.write_to_log("LOG", "Every 10 query check")
+                        if g.cache is not None:
+                            g.write_to_log("CACHE", g.cache.stats())
+
+                    # when almost hit API limit, shutdown
+                    if g.stop_at_api_limit and g.queries_made == g.api_limit:
+                        g.write_to_log("API LIMIT", f"Current route ID is {od_pair['id']}")
+                        checkpoint.sync()
+                        g.reset()
+                    else:
+                        # be nice to API
+                        time.sleep(1 + (0.5 - random()))
+
+                except KeyboardInterrupt:
+                    traceback.print_exc()
+                    break
+
+        finally:
+            checkpoint.close()
+            for output_file in output_files:
+                output_file.close()
+            g.end()
 
 if __name__ == "__main__":
     main()
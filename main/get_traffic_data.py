@@ -1,12 +1,40 @@
+import argparse
 import csv
-import json
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import instrument
+from traffic_segments import TrafficSegments
+from traffic_store import TrafficStore
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASE_URL = "http://webapps1.cityofchicago.org/traffic/"
+COLORS = ['green', 'yellow', 'red']
+FEED_PARAMS = {'green': "sra", 'yellow': "sra_yellow", 'red': "sra_red"}
+
+def make_session(retries=3, backoff=0.5, pool_size=3):
+    """Create one HTTP session with pooled connections and retries.
+
+    Failed connections and 429/5xx responses are retried up to `retries`
+    times, waiting backoff * 2^(n - 1) seconds before the nth retry.
+    """
+
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-def get_data(color):
+
+def get_data(color, session=None, base_url=BASE_URL, timeout=10.0, metrics=None):
     """Get traffic data for low- / medium- / high-traffic segments.
 
     Make request to get traffic data, parse output, and return list of
@@ -15,6 +43,11 @@ def get_data(color):
     params
      - color: str - either 'green', 'yellow', or 'red' for low-, medium-
        or high-traffic. This determines the request to execute
+     - session: requests.Session - session to reuse; see make_session
+     - base_url: str - where the sra*.jsp feeds live
+     - timeout: float - seconds to wait for the server
+     - metrics: Dict - if given, metrics[color] is set to the request's
+       latency, payload size and number of segments
 
     return
      - roads: List[int] - list of segment IDs that have that type of
@@ -22,21 +55,16 @@ def get_data(color):
     """
     
     # Set request URL
-    base = "http://webapps1.cityofchicago.org/traffic/"
-    url_parm = ""
-    if color == "green":
-        url_param = "sra"
-    elif color == "yellow":
-        url_param = "sra_yellow"
-    elif color == "red":
-        url_param = "sra_red"
-    else:
+    if color not in FEED_PARAMS:
         print("Invalid parameter color; must be 'green', 'yellow', 'red'.")
         return
 
-    url = base + url_param + ".jsp"
-    r = requests.get(url)
+    url = base_url + FEED_PARAMS[color] + ".jsp"
+    start = time.perf_counter()
+    r = (session or requests).get(url, timeout=timeout)
+    r.raise_for_status()
     response = r.json()
+    latency = time.perf_counter() - start
 
     # Expected format:
     # { "sra_red" :  (or sra_yellow or sra_green)
@@ -52,54 +80,58 @@ def get_data(color):
     roads = map(lambda value: int(value["segmentid"]), response_values)
     roads = list(roads)
 
+    instrument.observe("traffic_feed_latency_seconds", latency, color=color)
+    instrument.count("traffic_segments_fetched_total", len(roads), color=color)
+    if metrics is not None:
+        retries = getattr(r.raw, "retries", None)
+        metrics[color] = {'latency_sec': latency, 'bytes': len(r.content),
+                          'segments': len(roads),
+                          'retries': len(retries.history) if retries else 0}
+
     return roads
 
 
-def parse_poly1():
-    """Read the data from poly1.txt and return segmentID : lat/lon info.
+def get_all_data(colors=COLORS, base_url=BASE_URL, timeout=10.0, retries=3, backoff=0.5):
+    """Fetch all traffic feeds concurrently over one pooled session.
 
     params
-     - None, but expects file data/poly1.txt to exist
+     - colors: List[str] - feeds to fetch, see get_data
+     - base_url, timeout: see get_data
+     - retries, backoff: see make_session
 
     return
-     - geo: Dict[int : List[pair]], where pair = {"x": float, "y": float},
-       and the int key is the segment ID
+     - all_roads: Dict[str : List[int]] - segment IDs for each color
+     - metrics: Dict[str : Dict] - latency, payload size, segment count
+       and retries for each color
     """
 
-    geo = {
-        # int : List[{'x': float, 'y': float}]
-    }
+    metrics = {}
+    with make_session(retries, backoff, pool_size=len(colors)) as session, \
+            ThreadPoolExecutor(max_workers=len(colors)) as executor:
+        futures = {color: executor.submit(get_data, color, session, base_url, timeout, metrics)
+                   for color in colors}
+        all_roads = {color: future.result() for color, future in futures.items()}
 
-    poly1_fname = SCRIPT_DIR + "/data/poly1.txt"
-    with open(poly1_fname) as poly1:
-        assert next(poly1).strip() == "["
-        assert next(poly1).strip() == "{"
+    return all_roads, metrics
 
-        # Line format:
-        # 111:[[{x:-87.aa,y:41.bb}, {x:-87.cc,y:41.dd}, ...]],
-        # so line.strip().split(":")[0] gives the segment ID,
-        # and everything after is the rest of the line.
-        for line in poly1:
-            # Last line
-            if line.strip() == "}":
-                break
 
-            line = line.strip().split(":")
-            segment_id = int(line[0])
-            rest = ":".join(line[1:])
+def parse_poly1():
+    """Read the data from poly1.txt and return segmentID : lat/lon info.
 
-            # Remove possible trailing comma -- always there except last line
-            if rest[-1] == ",":
-                rest = rest[:-1]
+    poly1.txt is compiled once into a binary segment table next to it
+    (data/poly1.table/), which is memory-mapped on every later call and
+    rebuilt automatically when poly1.txt changes. See traffic_segments.py.
 
-            # Convert to proper JSON by quoting keys x and y
-            rest = rest.replace('x', '"x"').replace('y', '"y"')
-            rest = json.loads(rest)
-            coords = rest[0]  # list of pairs
+    params
+     - None, but expects file data/poly1.txt to exist
 
-            geo[segment_id] = coords
+    return
+     - geo: TrafficSegments - maps int segment ID to a float64 array of
+       (x, y) = (lon, lat) points
+    """
 
-    return geo
+    poly1_fname = SCRIPT_DIR + "/data/poly1.txt"
+    return TrafficSegments.from_poly1(poly1_fname)
 
 
 def write_to_csv(all_roads, geo, out_fn):
@@ -111,15 +143,15 @@ def write_to_csv(all_roads, geo, out_fn):
     Where the road segment is a polyline (i.e., length of list is more
     than 2), we code each line as its own row in the CSV.
 
-    e.g., if the road is ({x:1, y:2}, {x:3, y:4}, {x:5, y:6})
+    e.g., if the road is ((1, 2), (3, 4), (5, 6))
     then the CSV has two rows for this road, one from (1,2) --> (3,4)
     and another from (3,4) --> (5,6).
 
     params
      - all_roads: Dict[str : List[int]] - strings are red/yellow/green,
        values are list of segment IDs that have that type of traffic.
-     - geo: Dict[int : List[pair]], with pair = {"x": float,"y": float},
-       and the int key is the segment ID
+     - geo: TrafficSegments (or any mapping) - int segment ID to an array
+       of (x, y) = (lon, lat) points
      - out_fn: str - output file name
 
     return
@@ -129,50 +161,122 @@ def write_to_csv(all_roads, geo, out_fn):
     output_header = ["road_id", "color", "origin_lon",
                      "origin_lat", "dest_lon", "dest_lat"]
 
-    segments_written = 0
-    with open(out_fn, 'w') as fout:
+    with instrument.span("write_traffic_csv"), open(out_fn, 'w') as fout:
         csvwriter = csv.writer(fout)
         csvwriter.writerow(output_header)
 
         for color in ['green', 'yellow', 'red']:
             roads = all_roads[color]
+            segments_written = 0
             for road_id in roads:
-                # road is a list of coordinates, {x:___, y:___}.
+                # road is a list of coordinates, (x, y).
                 # we want to encode each pair of coordinates as its
                 # own row in the CSV.
-                road = geo[road_id]
+                road = geo[road_id].tolist()
                 for origin, dest in zip(road, road[1:]):
-                    origin_lon = origin['x']
-                    origin_lat = origin['y']
-                    dest_lon = dest['x']
-                    dest_lat = dest['y']
+                    origin_lon, origin_lat = origin
+                    dest_lon, dest_lat = dest
 
                     row = [road_id, color, origin_lon, origin_lat,
                            dest_lon, dest_lat]
                     csvwriter.writerow(row)
-
                     segments_written += 1
-                    if segments_written % 100 == 0:
-                        print(f"Added {segments_written} segments so far.")
 
-            print(f"Added all {color} roads.")
+            instrument.count("traffic_segments_written_total", segments_written, color=color)
+            print(f"Added all {color} roads ({segments_written} segments).")
+
+def collect(store_fn, interval=60.0, duration=None, **fetch_args):
+    """Poll the traffic feeds and record every snapshot in a TrafficStore.
+
+    params
+     - store_fn: str - time-series store to append to
+     - interval: float - seconds between snapshots
+     - duration: float - seconds to run for; None runs until interrupted
+     - fetch_args: passed on to get_all_data
+
+    return
+     - None (snapshots are written to the store)
+    """
+
+    store = TrafficStore(store_fn)
+    start = time.time()
+    next_poll = start
+    try:
+        while duration is None or next_poll <= start + duration:
+            timestamp = time.time()
+            try:
+                with instrument.span("traffic_snapshot"):
+                    all_roads, metrics = get_all_data(**fetch_args)
+                    changed = store.append(timestamp, all_roads)
+                instrument.count("traffic_snapshots_total")
+                instrument.count("traffic_segments_changed_total", changed)
+                print(f"Snapshot {len(store.times)} at {time.strftime('%H:%M:%S')}: " +
+                      f"{changed} segments changed color.")
+            except (requests.RequestException, KeyError, TypeError, ValueError) as error:
+                # a failed fetch or a malformed feed only loses this snapshot
+                instrument.count("traffic_snapshot_failures_total")
+                print(f"Snapshot failed at {time.strftime('%H:%M:%S')}: {error}")
+            instrument.flush()
+
+            # keep to the schedule even if a fetch was slow
+            next_poll += interval
+            time.sleep(max(0, next_poll - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default=BASE_URL,
+                        help="Where the sra*.jsp feeds live, e.g. a local stand-in server.")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="Seconds to wait for each feed.")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Retries for failed connections and 429/5xx responses.")
+    parser.add_argument("--backoff", type=float, default=0.5,
+                        help="Backoff factor between retries, in seconds.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep polling and record snapshots in a time-series store.")
+    parser.add_argument("--interval", type=float, default=60.0,
+                        help="Seconds between snapshots (with --daemon).")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Minutes to poll for (with --daemon); until interrupted if not given.")
+    parser.add_argument("--store", default=SCRIPT_DIR + "/data/traffic_history.bin",
+                        help="Time-series store for --daemon snapshots.")
+    parser.add_argument("--output", default=SCRIPT_DIR + "/data/traffic.csv",
+                        help="CSV of segment colors to write.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="get_traffic_data")
+
+    if args.daemon:
+        duration = args.duration * 60 if args.duration is not None else None
+        collect(args.store, args.interval, duration, base_url=args.base_url,
+                timeout=args.timeout, retries=args.retries, backoff=args.backoff)
+        return
 
-if __name__ == "__main__":
     # Get all traffic data
-    all_roads = {
-        # color: List[int]
-    }
-    for color in ['green', 'yellow', 'red']:
-        all_roads[color] = get_data(color)
+    with instrument.span("fetch_traffic"):
+        all_roads, metrics = get_all_data(COLORS, args.base_url, args.timeout,
+                                          args.retries, args.backoff)
+    for color in COLORS:
+        m = metrics[color]
+        print(f"Fetched {m['segments']} {color} segments ({m['bytes']} bytes) in " +
+              f"{m['latency_sec']:.3f} s with {m['retries']} retries.")
 
     # Read data downloaded from City of Chicago traffic tracker website.
     # Stored in poly1.txt, which is extremely messy.
     #
     # TODO: put in README where poly1 came from. poly2 and
     # poly4 are empty. poly3 is I think the regions.
-    geo = parse_poly1()
+    with instrument.span("parse_poly1"):
+        geo = parse_poly1()
 
     # Dump to CSV
-    out_fn = SCRIPT_DIR + "/data/traffic.csv"
-    write_to_csv(all_roads, geo, out_fn)
+    write_to_csv(all_roads, geo, args.output)
+
 
+if __name__ == "__main__":
+    main()
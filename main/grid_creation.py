@@ -3,17 +3,255 @@ import json
 import argparse
 from math import ceil, floor
 
-from geojson import Polygon, Feature, FeatureCollection, dump
+import numpy as np
+import shapely
 from shapely.geometry import shape, Point
+from shapely.prepared import prep
+
+import instrument
+from geojson_stream import FeatureWriter
 
 """
 Code adapted from answer to question here:
 http://gis.stackexchange.com/questions/54119/creating-square-grid-polygon-shapefile-with-python
 """
 
-SCALE = 3
+SCALE = 3  # fewest decimal places of a degree kept in cell IDs
+
+
+def corner_offsets(grid_height, grid_width):
+    """(dy, dx) from the bottom-left corner of a cell to its other corners,
+    ending back at the bottom-left corner."""
+    return [(grid_height, 0), (grid_height, grid_width), (0, grid_width), (0, 0)]
+
+
+def id_scale(grid_height, grid_width):
+    """Decimal places needed for cell IDs to tell cells of this size apart."""
+
+    scale = SCALE
+    while scale < 9 and any(abs(size * 10**scale - round(size * 10**scale)) > 1e-6
+                            for size in (grid_height, grid_width)):
+        scale += 1
+    return scale
+
+
+def contains_points(boundary, x, y):
+    """Vectorized point-in-polygon test: is each (x[i], y[i]) inside boundary?"""
+
+    if hasattr(shapely, "contains_xy"):  # shapely 2
+        shapely.prepare(boundary)
+        return shapely.contains_xy(boundary, x, y)
+
+    prepared = prep(boundary)
+    return np.fromiter((prepared.contains(Point(pt)) for pt in zip(x.tolist(), y.tolist())),
+                       dtype=bool, count=len(x))
+
+
+def grid_cells(xmin, xmax, ymin, ymax, grid_height, grid_width, boundary):
+    """Find the grid cells with at least one corner inside the boundary.
+
+    All corners are tested against the boundary in one vectorized call.
+
+    return
+     - (cols, rows): int64 arrays with the column and row of each cell, the
+       cell's bottom-left corner being (xmin + col * grid_width, ymin + row *
+       grid_height). Cells are ordered column by column and bottom to top
+       within a column.
+    """
+
+    # get rows, columns
+    rows = ceil((ymax - ymin) / grid_height)
+    cols = ceil((xmax - xmin) / grid_width)
+
+    cols, rows = [v.ravel() for v in np.meshgrid(np.arange(cols), np.arange(rows), indexing='ij')]
+    x_left = xmin + (cols * grid_width)
+    y_bottom = ymin + (rows * grid_height)
+
+    intersects = np.zeros(len(cols), dtype=bool)
+    for dy, dx in corner_offsets(grid_height, grid_width):
+        intersects |= contains_points(boundary, x_left + dx, y_bottom + dy)
+
+    return cols[intersects], rows[intersects]
+
+
+class QuadGrid(object):
+    """A grid plus coarser grids built from it, each cell split 2 x 2 into
+    the cells of the level below.
+
+    Level 0 is the grid itself. A level k cell covers 2**k x 2**k level 0
+    cells and exists if any of them does, so every level covers the same
+    area. Parent and child links are index arrays, so sampling and
+    aggregation can move between levels without rescanning the boundary.
+    """
+
+    def __init__(self, xmin, ymin, grid_height, grid_width, cols, rows):
+        """params
+         - xmin, ymin: float - bottom-left corner shared by every level
+         - grid_height, grid_width: float - level 0 cell size in degrees
+         - cols, rows: List[int64 array] - per level, the column and row of
+           each cell in units of that level's cell size, column-major sorted
+        """
+
+        self.xmin = float(xmin)
+        self.ymin = float(ymin)
+        self.grid_height = float(grid_height)
+        self.grid_width = float(grid_width)
+        self.cols = cols
+        self.rows = rows
+        self.scale = id_scale(self.grid_height, self.grid_width)
+
+        # parents[k][i]: index at level k + 1 of cell i at level k. Children
+        # of cell i at level k are children[k][child_offsets[k][i]:child_offsets[k][i + 1]]
+        self.parents = []
+        self.children = [None]
+        self.child_offsets = [None]
+        for level in range(1, self.levels):
+            parent = np.searchsorted(self.keys(level), self.key(cols[level - 1] >> 1,
+                                                                rows[level - 1] >> 1))
+            self.parents.append(parent)
+            self.children.append(np.argsort(parent, kind='stable'))
+            self.child_offsets.append(np.searchsorted(parent, np.arange(len(cols[level]) + 1),
+                                                      sorter=self.children[-1]))
+        self.parents.append(None)
+
+    @classmethod
+    def build(cls, xmin, xmax, ymin, ymax, grid_height, grid_width, boundary, levels=0):
+        """Grid the boundary, then add `levels` coarser levels."""
+
+        cols, rows = grid_cells(xmin, xmax, ymin, ymax, grid_height, grid_width, boundary)
+        all_cols, all_rows = [cols], [rows]
+        for _ in range(levels):
+            keys = np.unique(cls.key(all_cols[-1] >> 1, all_rows[-1] >> 1))
+            all_cols.append(keys >> 32)
+            all_rows.append(keys & 0xFFFFFFFF)
+        return cls(xmin, ymin, grid_height, grid_width, all_cols, all_rows)
+
+    @staticmethod
+    def key(cols, rows):
+        # sorts column-major
+        return (cols << 32) | rows
+
+    def keys(self, level):
+        return self.key(self.cols[level], self.rows[level])
 
-def grid(output_grid_fn, xmin, xmax, ymin, ymax, grid_height, grid_width, boundary):
+    @property
+    def levels(self):
+        return len(self.cols)
+
+    def __len__(self):
+        return len(self.cols[0])
+
+    def cell_size(self, level):
+        """(height, width) in degrees of the cells at a level."""
+        return self.grid_height * 2**level, self.grid_width * 2**level
+
+    def corners(self, level=0):
+        """(x_left, y_bottom) float64 arrays: bottom-left corners of the cells."""
+
+        height, width = self.cell_size(level)
+        return self.xmin + (self.cols[level] * width), self.ymin + (self.rows[level] * height)
+
+    def ids(self, level=0):
+        """(rid, cid) int64 arrays: the bottom-left corner in units of 10**-scale degrees."""
+
+        x_left, y_bottom = self.corners(level)
+        return (np.rint(y_bottom * 10**self.scale).astype(np.int64),
+                np.rint(x_left * 10**self.scale).astype(np.int64))
+
+    def centroids(self, level=0):
+        """(lon, lat) float64 arrays: the centers of the cells."""
+
+        height, width = self.cell_size(level)
+        x_left, y_bottom = self.corners(level)
+        return x_left + width / 2, y_bottom + height / 2
+
+    def parent(self, level, cells):
+        """Index at level + 1 of the parent of each of cells (indices at level)."""
+        return self.parents[level][cells]
+
+    def children_of(self, level, cell):
+        """Indices at level - 1 of the (up to 4) children of a cell at level."""
+
+        offsets = self.child_offsets[level]
+        return self.children[level][offsets[cell]:offsets[cell + 1]]
+
+    def descendants(self, level, cell):
+        """Indices at level 0 of all the cells under a cell at level."""
+
+        cells = np.array([cell])
+        for k in range(level, 0, -1):
+            offsets = self.child_offsets[k]
+            cells = np.concatenate([self.children[k][offsets[c]:offsets[c + 1]]
+                                    for c in cells.tolist()])
+        return np.sort(cells)
+
+    def ancestors(self, cells, level):
+        """Index at level of the cell containing each of cells (indices at level 0)."""
+
+        cells = np.asarray(cells)
+        for k in range(level):
+            cells = self.parents[k][cells]
+        return cells
+
+    def features(self, level=0):
+        """Generate GeoJSON features (plain dicts) for the cells at a level.
+
+        Level 0 features are the ones grid has always written; coarser ones
+        also carry their level.
+        """
+
+        height, width = self.cell_size(level)
+        x_left, y_bottom = self.corners(level)
+        rids, cids = self.ids(level)
+        for x, y, rid, cid in zip(x_left.tolist(), y_bottom.tolist(), rids.tolist(), cids.tolist()):
+            # corners, rounded the way geojson.Polygon does
+            x0, y0 = round(x, 6), round(y, 6)
+            x1, y1 = round(x + width, 6), round(y + height, 6)
+            properties = {'rid': rid, 'cid': cid}
+            if level:
+                properties['level'] = level
+            yield {"type": "Feature",
+                   "geometry": {"type": "Polygon",
+                                "coordinates": [[[x0, y0], [x0, y1], [x1, y1], [x1, y0], [x0, y0]]]},
+                   "properties": properties}
+
+    def save(self, fn):
+        """Save the grid, every level included, to an .npz file."""
+
+        arrays = {}
+        for level in range(self.levels):
+            arrays[f'cols{level}'] = self.cols[level]
+            arrays[f'rows{level}'] = self.rows[level]
+        np.savez(fn, origin=np.array([self.xmin, self.ymin, self.grid_height, self.grid_width]),
+                 **arrays)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            xmin, ymin, grid_height, grid_width = data['origin'].tolist()
+            levels = sum(1 for name in data.files if name.startswith('cols'))
+            return cls(xmin, ymin, grid_height, grid_width,
+                       [data[f'cols{level}'] for level in range(levels)],
+                       [data[f'rows{level}'] for level in range(levels)])
+
+
+def level_fn(output_grid_fn, level):
+    """File name of a grid level's GeoJSON; level 0 is output_grid_fn itself."""
+
+    if level == 0:
+        return output_grid_fn
+    base, ext = os.path.splitext(output_grid_fn)
+    return f"{base}_L{level}{ext}"
+
+
+def grid(output_grid_fn, xmin, xmax, ymin, ymax, grid_height, grid_width, boundary, levels=0):
+    """Grid the boundary and write each level's cells to GeoJSON, streaming.
+
+    The QuadGrid itself is saved next to output_grid_fn, as .npz.
+
+    return
+     - QuadGrid
+    """
 
     # check all floats
     xmin = float(xmin)
@@ -23,44 +261,21 @@ def grid(output_grid_fn, xmin, xmax, ymin, ymax, grid_height, grid_width, bounda
     grid_width = float(grid_width)
     grid_height = float(grid_height)
 
-    # get rows, columns
-    rows = ceil((ymax - ymin) / grid_height)
-    cols = ceil((xmax - xmin) / grid_width)
+    with instrument.span("build_grid", levels=levels):
+        quad_grid = QuadGrid.build(xmin, xmax, ymin, ymax, grid_height, grid_width, boundary,
+                                   levels)
+    for level in range(quad_grid.levels):
+        with instrument.span("write_grid", level=level):
+            with FeatureWriter(level_fn(output_grid_fn, level)) as writer:
+                for feature in quad_grid.features(level):
+                    writer.write(feature)
+        print(f"Level {level}: {len(quad_grid.cols[level])} cells of " +
+              "{0:g} x {1:g} degrees.".format(*quad_grid.cell_size(level)))
+        instrument.count("grid_cells_total", len(quad_grid.cols[level]), level=level)
+
+    quad_grid.save(os.path.splitext(output_grid_fn)[0] + ".npz")
+    return quad_grid
 
-    # create grid cells
-    countcols = 0
-    features = []
-    while countcols < cols:
-        # set x coordinate for this column
-        grid_x_left = xmin + (countcols * grid_width)
-        countcols += 1
-
-        countrows = 0
-        while countrows < rows:
-            # update y coordinate for this row
-            grid_y_bottom = ymin + (countrows * grid_height)
-            countrows += 1
-
-            # check if grid centroid contained in county boundary
-            bottomleftcorner = (grid_x_left, grid_y_bottom)
-            coords = [bottomleftcorner]
-
-            # add other three corners of gridcell before closing grid with starting point again
-            for i in [(0.001, 0), (0.001, 0.001), (0, 0.001), (0, 0)]:
-                coords.append((bottomleftcorner[0] + i[1], bottomleftcorner[1] + i[0]))
-
-            intersects = False
-            for corner in coords[1:]:
-                if boundary.contains(Point(corner)):
-                    intersects = True
-                    break
-
-            if intersects:
-                properties = {'rid': round(grid_y_bottom * 10**SCALE), 'cid': round(grid_x_left * 10**SCALE)}
-                features.append(Feature(geometry=Polygon([coords]), properties=properties))
-
-    with open(output_grid_fn, 'w') as fout:
-        dump(FeatureCollection(features), fout)
 
 def main():
     """Generate grid for a GeoJSON json file passed on the command line.
@@ -72,7 +287,16 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("features_geojson", help="Path to GeoJSON with features to be gridded.")
     parser.add_argument("output_folder", help="Folder to contain output grid GeoJSONs.")
+    parser.add_argument("--grid-size", type=float, default=0.001,
+                        help="Width and height of the finest grid cells, in degrees.")
+    parser.add_argument("--levels", type=int, default=0,
+                        help="Coarser levels to add, each doubling the cell size.")
+    parser.add_argument("--output", default=None,
+                        help="Grid GeoJSON to write; <output_folder>/<features_geojson>_grid.geojson " +
+                             "if not given.")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.configure(args.metrics, script="grid_creation")
 
     with open(args.features_geojson, 'r', encoding = 'utf8') as fin:
         feature = json.load(fin)
@@ -92,13 +316,14 @@ def main():
     ymin = bb[1]  # most southern point
     ymax = bb[3]  # most northern point
 
-    grid_height = 0.001
-    grid_width = 0.001
+    grid_height = args.grid_size
+    grid_width = args.grid_size
     xmin = floor(xmin * 10**SCALE) / 10**SCALE
     ymax = ceil(ymax * 10**SCALE) / 10**SCALE
 
-    grid("{0}_grid.geojson".format(os.path.join(args.output_folder, args.features_geojson)),
-         xmin, xmax, ymin, ymax, grid_height, grid_width, boundary)
+    output_grid_fn = args.output or \
+        "{0}_grid.geojson".format(os.path.join(args.output_folder, args.features_geojson))
+    grid(output_grid_fn, xmin, xmax, ymin, ymax, grid_height, grid_width, boundary, args.levels)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,262 @@
+"""Spans, counters and histograms for the scripts, written as JSON lines or
+as a Prometheus text file.
+
+    with instrument.span("bootstrap"):
+        ...
+    instrument.count("api_queries_total")
+    instrument.observe("api_latency_seconds", latency)
+
+Every script takes --metrics FILE (see add_arguments and configure):
+ - FILE.prom: a Prometheus text file (e.g. for node_exporter's textfile
+   collector) with every counter and histogram, rewritten on each flush
+   and at exit. Spans are the span_seconds histogram, labelled by span.
+ - anything else: JSON lines, one per span and event as they end, plus one
+   with every counter and histogram at exit.
+Without --metrics nothing is recorded. Each function then only checks one
+global and returns, and span returns a shared do-nothing context manager,
+so calls cost well under a microsecond. Even so, they belong around stages,
+batches and queries, not inside per-point loops.
+
+LogFile is the text log that get_routes writes to: opened once, buffered,
+and flushed on request and at exit, instead of reopened for every line.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from time import strftime
+
+# upper bounds of histogram buckets; the last bucket is +Inf
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+RATE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+NULL_SPAN = contextlib.nullcontext()
+
+_metrics = None  # the Metrics being recorded to, if any
+
+
+class Metrics(object):
+
+    def __init__(self, path, labels=None):
+        """Record to path, a .prom file or else JSON lines.
+
+        params
+         - path: str - output file, replaced
+         - labels: Dict{str : str} - labels added to every metric, e.g. the
+           script's name
+        """
+
+        self.path = path
+        self.prometheus = path.endswith(".prom")
+        self.labels = dict(labels or {})
+        self.counters = {}  # (name, labels) : float
+        self.histograms = {}  # (name, labels) : [buckets, counts, sum, count]
+        self.lock = threading.Lock()
+        self.out = None if self.prometheus else open(path, 'w')
+
+    def count(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    break
+            else:
+                i = len(histogram[0])
+            histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def event(self, kind, name, fields):
+        if self.out is None:
+            return
+        # ts, type and name take precedence over fields of the same name
+        record = dict(self.labels, **fields)
+        record.update(ts=round(time.time(), 6), type=kind, name=name)
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.out is not None:  # unless closed meanwhile
+                self.out.write(line + "\n")
+
+    def snapshot(self):
+        """Dict of every counter and histogram (with cumulative buckets)."""
+
+        def labelled(key):
+            return dict(self.labels, **dict(key[1]))
+
+        with self.lock:
+            counters = [dict(name=key[0], labels=labelled(key), value=value)
+                        for key, value in sorted(self.counters.items())]
+            histograms = []
+            for key, (buckets, counts, total, count) in sorted(self.histograms.items()):
+                cumulative = [sum(counts[:i + 1]) for i in range(len(counts))]
+                histograms.append(dict(name=key[0], labels=labelled(key), sum=total, count=count,
+                                       buckets=dict(zip([str(b) for b in buckets] + ["+Inf"],
+                                                        cumulative))))
+        return {'counters': counters, 'histograms': histograms}
+
+    def flush(self):
+        if self.prometheus:
+            write_prometheus(self.path, self.snapshot())
+        elif self.out is not None:
+            with self.lock:
+                self.out.flush()
+
+    def close(self):
+        if self.out is not None:
+            self.event("metrics", "summary", self.snapshot())
+        self.flush()
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
+
+def write_prometheus(path, snapshot):
+    """Write a snapshot in Prometheus' text format, replacing path at once."""
+
+    def label_text(labels, extra=None):
+        labels = dict(labels, **(extra or {}))
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{prometheus_escape(value)}"'
+                              for key, value in sorted(labels.items())) + "}"
+
+    lines, typed = [], set()
+    for counter in snapshot['counters']:
+        if counter['name'] not in typed:
+            typed.add(counter['name'])
+            lines.append(f"# TYPE {counter['name']} counter")
+        lines.append(f"{counter['name']}{label_text(counter['labels'])} {counter['value']:g}")
+    for histogram in snapshot['histograms']:
+        name = histogram['name']
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        for bound, count in histogram['buckets'].items():
+            lines.append(f"{name}_bucket{label_text(histogram['labels'], {'le': bound})} {count}")
+        lines.append(f"{name}_sum{label_text(histogram['labels'])} {histogram['sum']:g}")
+        lines.append(f"{name}_count{label_text(histogram['labels'])} {histogram['count']}")
+
+    with open(path + ".tmp", 'w') as fout:
+        fout.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def configure(path, **labels):
+    """Start recording to path (see the module docstring); None turns
+    recording off. Labels are added to every metric."""
+
+    global _metrics
+    if _metrics is not None:
+        _metrics.close()
+    _metrics = Metrics(path, labels) if path else None
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="Record timings and counts to FILE: Prometheus text if it ends " +
+                             "in .prom, else JSON lines.")
+
+
+def enabled():
+    return _metrics is not None
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter."""
+    if _metrics is not None:
+        _metrics.count(name, value, labels)
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """Add a value to a histogram."""
+    if _metrics is not None:
+        _metrics.observe(name, value, labels, buckets)
+
+
+def event(name, **fields):
+    """Write a JSON line (with JSON lines output only)."""
+    if _metrics is not None:
+        _metrics.event("event", name, fields)
+
+
+def span(name, **labels):
+    """Context manager timing a block into the span_seconds histogram, and
+    writing a JSON line when it ends."""
+    if _metrics is None:
+        return NULL_SPAN
+    return _span(name, labels)
+
+
+@contextlib.contextmanager
+def _span(name, labels):
+    # recorded where it started, even if configure or close runs meanwhile
+    metrics = _metrics
+    start, wall = time.perf_counter(), time.time()
+    error = None
+    try:
+        yield
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("span_seconds", seconds, dict(labels, span=name), SECONDS_BUCKETS)
+        metrics.event("span", name, dict(labels, start=round(wall, 6), seconds=round(seconds, 6),
+                                         **({'error': error} if error else {})))
+
+
+def flush():
+    """Write out what has been recorded so far."""
+    if _metrics is not None:
+        _metrics.flush()
+
+
+@atexit.register
+def close():
+    configure(None)
+
+
+class LogFile(object):
+    """A text log opened once and buffered; lines are
+    "[TYPE] At <time>: <message>. <suffix>"."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.out = None
+        self.lock = threading.Lock()
+
+    def write(self, mess_type, message, suffix=""):
+        line = "[{0}] At {1}: {2}. {3}\n".format(mess_type, strftime("%Y-%m-%d %H:%M:%S"),
+                                                 message, suffix)
+        with self.lock:
+            if self.out is None:
+                self.out = open(self.fn, 'a')
+                atexit.register(self.close)
+            self.out.write(line)
+
+    def flush(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.flush()
+
+    def close(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
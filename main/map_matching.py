@@ -0,0 +1,335 @@
+"""Match route polylines onto City of Chicago traffic segments.
+
+Every route is cut into short pieces, and each piece is snapped to the
+nearest traffic segment edge within a distance tolerance that runs in
+(roughly) the same direction. Adding up piece lengths by the color of the
+segment they snapped to gives each route's traffic exposure: meters driven
+in green, yellow and red traffic.
+
+Segment edges are bucketed into a uniform grid in a local metric
+projection, so all pieces of all routes are matched with a handful of
+vectorized NumPy operations per chunk rather than one query per point.
+Route edges whose bounding box covers no cell with a segment edge in it
+cannot match anything, and are counted as unmatched without being cut up.
+
+Usage: python map_matching.py [--routes ...] [--traffic ... | --history ... --at ...]
+"""
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+import instrument
+import route_store
+from get_traffic_data import COLORS, parse_poly1
+from traffic_store import TrafficStore
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA_DIR = SCRIPT_DIR + "/data/"
+
+# meters per degree near Chicago, for an equirectangular projection
+LAT0 = 41.88
+M_PER_DEG_LAT = 110574.0
+M_PER_DEG_LON = 111320.0 * np.cos(np.radians(LAT0))
+
+EXPOSURE_HEADER = ["ID", "name", "total_m"] + [f"{color}_m" for color in COLORS] + \
+                  ["unreported_m", "unmatched_m"]
+
+
+def project(lon, lat):
+    """Project degrees to meters, good enough for distances within a city."""
+    return np.asarray(lon) * M_PER_DEG_LON, np.asarray(lat) * M_PER_DEG_LAT
+
+
+class SegmentIndex(object):
+    """Grid-bucket index over traffic segment edges."""
+
+    def __init__(self, geo, colors, tolerance=20.0, cell_size=40.0):
+        """Index every edge of every segment.
+
+        params
+         - geo: TrafficSegments (or any mapping) - segment ID to (x, y) points
+         - colors: Dict[int : str] - segment ID to 'green'/'yellow'/'red';
+           segments missing from it are indexed as unreported
+         - tolerance: float - meters a route may be from a segment to match
+         - cell_size: float - grid cell size in meters; smaller cells hold
+           fewer edges to check, but the table of cells grows as the area
+           over the square of the size
+        """
+
+        self.tolerance = tolerance
+        self.cell_size = max(cell_size, tolerance)
+
+        ax, ay, bx, by, segment_ids = [], [], [], [], []
+        for segment_id, points in geo.items():
+            points = np.asarray(points)
+            if len(points) < 2:
+                continue
+            ax.append(points[:-1, 0])
+            ay.append(points[:-1, 1])
+            bx.append(points[1:, 0])
+            by.append(points[1:, 1])
+            segment_ids.append(np.full(len(points) - 1, segment_id, dtype=np.int64))
+
+        self.ax, self.ay = project(np.concatenate(ax), np.concatenate(ay))
+        self.bx, self.by = project(np.concatenate(bx), np.concatenate(by))
+        self.segment_ids = np.concatenate(segment_ids)
+
+        # 0 = unreported, then 1, 2, 3 for COLORS
+        color_codes = {color: code + 1 for code, color in enumerate(COLORS)}
+        self.color_codes = np.array([color_codes.get(colors.get(segment_id), 0)
+                                     for segment_id in self.segment_ids.tolist()],
+                                    dtype=np.int64)
+
+        # put each edge in every cell that has a point within the tolerance
+        # of it, so a query only needs to look in its own cell: of the
+        # cells its bounding box (plus the tolerance) touches, those whose
+        # center is within the tolerance plus half a cell's diagonal
+        cx0 = self.cell(np.minimum(self.ax, self.bx) - tolerance)
+        cx1 = self.cell(np.maximum(self.ax, self.bx) + tolerance)
+        cy0 = self.cell(np.minimum(self.ay, self.by) - tolerance)
+        cy1 = self.cell(np.maximum(self.ay, self.by) + tolerance)
+        nx = cx1 - cx0 + 1
+        ny = cy1 - cy0 + 1
+        counts = nx * ny
+
+        edge = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        centers_x = (cx0[edge] + k // ny[edge] + 0.5) * self.cell_size
+        centers_y = (cy0[edge] + k % ny[edge] + 0.5) * self.cell_size
+        reach = tolerance + self.cell_size / np.sqrt(2)
+        near = self.distance(centers_x, centers_y, edge) <= reach
+        edge, k = edge[near], k[near]
+
+        # a dense table of cells over the segments' extent: the edges in
+        # cell (cx, cy) are edges[starts[c]:starts[c + 1]], for
+        # c = (cx - x0) * ny + (cy - y0)
+        self.x0, self.y0 = int(cx0.min()), int(cy0.min())
+        self.nx, self.ny = int(cx1.max()) - self.x0 + 1, int(cy1.max()) - self.y0 + 1
+        cells = ((cx0[edge] + k // ny[edge] - self.x0) * self.ny +
+                 (cy0[edge] + k % ny[edge] - self.y0))
+        order = np.argsort(cells, kind='stable')
+        self.edges = edge[order]
+        per_cell = np.bincount(cells, minlength=self.nx * self.ny)
+        self.starts = np.concatenate(([0], np.cumsum(per_cell)))
+
+        # number of cells with edges in each rectangle of cells, from a
+        # summed-area table: occupied[:cx, :cy].sum() is area[cx, cy]
+        occupied = (per_cell > 0).reshape(self.nx, self.ny).astype(np.int64)
+        self.area = np.zeros((self.nx + 1, self.ny + 1), dtype=np.int64)
+        self.area[1:, 1:] = occupied.cumsum(axis=0).cumsum(axis=1)
+
+    def cell(self, v):
+        return np.floor(v / self.cell_size).astype(np.int64)
+
+    def distance(self, px, py, edge):
+        """Distance (meters) from each point to its edge."""
+
+        ex = self.bx[edge] - self.ax[edge]
+        ey = self.by[edge] - self.ay[edge]
+        qx = px - self.ax[edge]
+        qy = py - self.ay[edge]
+        length2 = np.maximum(ex * ex + ey * ey, 1e-12)
+        t = np.clip((qx * ex + qy * ey) / length2, 0.0, 1.0)
+        return np.hypot(qx - t * ex, qy - t * ey)
+
+    def may_match(self, x0, y0, x1, y1):
+        """Whether any cell touching each box (in projected meters) has
+        edges in it; points in a box where it does not never match."""
+
+        cx0 = np.clip(self.cell(np.minimum(x0, x1)) - self.x0, 0, self.nx)
+        cx1 = np.clip(self.cell(np.maximum(x0, x1)) - self.x0 + 1, 0, self.nx)
+        cy0 = np.clip(self.cell(np.minimum(y0, y1)) - self.y0, 0, self.ny)
+        cy1 = np.clip(self.cell(np.maximum(y0, y1)) - self.y0 + 1, 0, self.ny)
+        area = self.area
+        return (area[cx1, cy1] - area[cx0, cy1] - area[cx1, cy0] + area[cx0, cy0]) > 0
+
+    def match(self, px, py, dx, dy, max_angle=45.0):
+        """Find the best edge for each query point.
+
+        params
+         - px, py: arrays - query points in projected meters
+         - dx, dy: arrays - direction of travel at each point
+         - max_angle: float - largest angle in degrees between the direction
+           of travel and the edge's direction; None ignores direction
+
+        return
+         - int64 array - index of the matched edge per point, -1 if none
+        """
+
+        cx = self.cell(px) - self.x0
+        cy = self.cell(py) - self.y0
+        inside = (cx >= 0) & (cx < self.nx) & (cy >= 0) & (cy < self.ny)
+        cells = np.where(inside, cx * self.ny + cy, 0)
+        lo = self.starts[cells]
+        n = np.where(inside, self.starts[cells + 1] - lo, 0)
+
+        point = np.repeat(np.arange(len(px)), n)
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        edge = self.edges[np.repeat(lo, n) + within]
+
+        # distance from each point to each candidate edge, then the angle
+        # for those within the tolerance
+        dist = self.distance(px[point], py[point], edge)
+        ok = dist <= self.tolerance
+        point, edge, dist = point[ok], edge[ok], dist[ok]
+        if max_angle is not None:
+            ex = self.bx[edge] - self.ax[edge]
+            ey = self.by[edge] - self.ay[edge]
+            norm = (np.maximum(np.hypot(ex, ey), 1e-6) *
+                    np.maximum(np.hypot(dx[point], dy[point]), 1e-12))
+            ok = (ex * dx[point] + ey * dy[point]) / norm >= np.cos(np.radians(max_angle))
+            point, edge, dist = point[ok], edge[ok], dist[ok]
+
+        order = np.lexsort((dist, point))
+        point, edge = point[order], edge[order]
+        first = np.ones(len(point), dtype=bool)
+        first[1:] = point[1:] != point[:-1]
+
+        matched = np.full(len(px), -1, dtype=np.int64)
+        matched[point[first]] = edge[first]
+        return matched
+
+
+def route_exposure(index, coords, offsets, piece_m=10.0, max_angle=45.0,
+                   chunk_size=1000000):
+    """Meters each route spends in each traffic color.
+
+    params
+     - index: SegmentIndex
+     - coords: float64 array (n, 2) - (lat, lon) points of all routes
+     - offsets: int64 array - route i is coords[offsets[i]:offsets[i + 1]]
+     - piece_m: float - longest piece a route edge is cut into, in meters
+     - max_angle: see SegmentIndex.match
+     - chunk_size: int - pieces matched at once, to bound memory
+
+    return
+     - float64 array (routes, 5) - meters unreported, green, yellow, red,
+       and unmatched
+    """
+
+    num_routes = len(offsets) - 1
+    x, y = project(coords[:, 1], coords[:, 0])
+
+    # edges between consecutive points of the same route
+    point_route = np.repeat(np.arange(num_routes), np.diff(offsets))
+    starts = np.flatnonzero(point_route[:-1] == point_route[1:])
+    route = point_route[starts]
+    ex = x[starts + 1] - x[starts]
+    ey = y[starts + 1] - y[starts]
+    length = np.hypot(ex, ey)
+
+    # edges nowhere near a segment are all unmatched; the rest go on
+    near = index.may_match(x[starts], y[starts], x[starts + 1], y[starts + 1])
+    exposure = np.bincount(route[~near] * 5 + 4, weights=length[~near], minlength=num_routes * 5)
+    starts, route, ex, ey, length = starts[near], route[near], ex[near], ey[near], length[near]
+
+    # cut long edges into pieces no longer than piece_m, and match about
+    # chunk_size pieces at a time
+    pieces = np.maximum(1, np.ceil(length / piece_m)).astype(np.int64)
+    piece_ends = np.cumsum(pieces)
+    bounds = np.searchsorted(piece_ends, np.arange(0, piece_ends[-1] if len(pieces) else 0,
+                                                   chunk_size), side='right')
+    bounds = np.append(np.unique(bounds), len(pieces))
+
+    for first_edge, last_edge in zip(bounds[:-1], bounds[1:]):
+        chunk_pieces = pieces[first_edge:last_edge]
+        edge = np.repeat(np.arange(first_edge, last_edge), chunk_pieces)
+        k = np.arange(len(edge)) - np.repeat(np.cumsum(chunk_pieces) - chunk_pieces, chunk_pieces)
+        frac = (k + 0.5) / pieces[edge]
+        px = x[starts[edge]] + frac * ex[edge]
+        py = y[starts[edge]] + frac * ey[edge]
+
+        matched = index.match(px, py, ex[edge], ey[edge], max_angle)
+        code = np.where(matched >= 0, index.color_codes[matched], 4)
+        exposure += np.bincount(route[edge] * 5 + code, weights=length[edge] / pieces[edge],
+                                minlength=num_routes * 5)
+
+    return exposure.reshape(num_routes, 5)
+
+
+def read_traffic_colors(traffic_csv):
+    """Read segment colors from the traffic.csv written by get_traffic_data."""
+
+    colors = {}
+    with open(traffic_csv, 'r') as fin:
+        for row in csv.DictReader(fin):
+            colors[int(row['road_id'])] = row['color']
+    return colors
+
+
+def read_route_points(routes_fn):
+    """Read routes into (ids, names, coords, offsets), skipping unparseable ones."""
+
+    ids, names, points = [], [], []
+    header, routes = route_store.read_routes(routes_fn)
+    for route in routes:
+        if route['polyline_points'] is None or not route['ID']:
+            continue
+        ids.append(route['ID'])
+        names.append(route['name'])
+        points.append(np.asarray(route['polyline_points']))
+
+    counts = np.array([len(p) for p in points], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    coords = np.concatenate(points) if points else np.empty((0, 2))
+    return ids, names, coords, offsets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", default=DATA_DIR + "chicago_routes_gmaps.csv",
+                        help="Routes CSV or store to match.")
+    parser.add_argument("--traffic", default=DATA_DIR + "traffic.csv",
+                        help="Segment colors, as written by get_traffic_data.py.")
+    parser.add_argument("--history", default=None,
+                        help="Take segment colors from this time-series store instead...")
+    parser.add_argument("--at", type=float, default=None,
+                        help="...at this time (seconds since the epoch; default latest).")
+    parser.add_argument("--tolerance", type=float, default=20.0,
+                        help="Meters a route may be from a segment to match it.")
+    parser.add_argument("--max-angle", type=float, default=45.0,
+                        help="Largest angle in degrees between route and segment direction.")
+    parser.add_argument("--output", default=DATA_DIR + "chicago_routes_gmaps_exposure.csv")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="map_matching")
+
+    if args.history:
+        store = TrafficStore(args.history)
+        if not store.times:
+            # e.g. a collector has created the store but not polled yet
+            store.close()
+            parser.error(f"no snapshots in {args.history} yet")
+        colors = store.snapshot_at(args.at if args.at is not None else store.times[-1])
+        store.close()
+    else:
+        colors = read_traffic_colors(args.traffic)
+
+    start = time.perf_counter()
+    with instrument.span("load"):
+        index = SegmentIndex(parse_poly1(), colors, tolerance=args.tolerance)
+        ids, names, coords, offsets = read_route_points(route_store.prefer_store(args.routes))
+    loaded = time.perf_counter()
+
+    with instrument.span("match"):
+        exposure = route_exposure(index, coords, offsets, max_angle=args.max_angle)
+    print(f"Matched {len(ids)} routes ({len(coords)} points) in " +
+          f"{time.perf_counter() - loaded:.2f} s, after {loaded - start:.2f} s loading.")
+    instrument.count("routes_matched_total", len(ids))
+    instrument.count("route_points_matched_total", len(coords))
+
+    with open(args.output, 'w') as fout:
+        csvwriter = csv.writer(fout)
+        csvwriter.writerow(EXPOSURE_HEADER)
+        for route_id, name, row in zip(ids, names, exposure.tolist()):
+            unreported, green, yellow, red, unmatched = row
+            csvwriter.writerow([route_id, name, round(sum(row), 1)] +
+                               [round(v, 1) for v in (green, yellow, red, unreported, unmatched)])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,96 +1,225 @@
-import csv
+import argparse
+import itertools
 import os
 
+import numpy as np
+
+import instrument
+import route_store
+from route_set import METRICS, RouteSet, pair_alternatives
+
 
 EXPECTED_HEADER = ["ID", "name", "polyline_points", "total_time_in_sec",
                    "total_distance_in_meters", "number_of_steps",
                    "maneuvers", "beauty", "simplicity", "pctNonHighwayTime",
                    "pctNonHighwayDist", "pctNeiTime", "pctNeiDist"]
+GH_FIELDS = EXPECTED_HEADER[EXPECTED_HEADER.index("beauty"):]
+
+OPTIMIZATIONS = ["fastest", "traffic"]
+JOIN_KEYS = ["ID"]
+BATCH_SIZE = 10000  # Google routes joined at a time
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIR = SCRIPT_DIR + "/data/"
 
 def main():
-    # Set up file paths
-    optimization = "fastest"  # "fastest" or "traffic"
-    gmaps_csv = DATA_DIR + f"chicago_routes_gmaps_{optimization}_matched.csv"
-    gh_csv = DATA_DIR + f"chicago_routes_gh_{optimization}.csv"
-    output_csv = DATA_DIR + f"chicago_routes_{optimization}_merged.csv"
-
-    threshold = 0.10  # error tolerance between distance results
-
-    print(f"\nMerging {gmaps_csv} and {gh_csv} with {threshold} threshold " +
-          f"and output to {output_csv}.")
-
-    # Configure indices for expected header
-    route_idx = EXPECTED_HEADER.index("ID")
-    dist_idx = EXPECTED_HEADER.index("total_distance_in_meters")
-    beauty_idx = EXPECTED_HEADER.index("beauty")
-    simplicity_idx = EXPECTED_HEADER.index("simplicity")
-    nhwdist_idx = EXPECTED_HEADER.index("pctNonHighwayDist")
-    nhwtime_idx = EXPECTED_HEADER.index("pctNonHighwayTime")
-    sntime_idx = EXPECTED_HEADER.index("pctNeiTime")
-    sndist_idx = EXPECTED_HEADER.index("pctNeiDist")
-
-    gh_data = {}
-    with open(gh_csv, 'r') as fin:
-        csvreader = csv.reader(fin)
-        gh_header = next(csvreader)
-        assert gh_header == EXPECTED_HEADER[:len(gh_header)]
-
-        for line in csvreader:
-            if not line: continue  # because Windows
-
-            try:
-                route_id = line[route_idx]
-                dist = float(line[dist_idx])
-                beauty = float(line[beauty_idx])
-                simplicity = float(line[simplicity_idx])
-                non_hw_time = float(line[nhwtime_idx])
-                non_hw_dist = float(line[nhwdist_idx])
-                sn_time = float(line[sntime_idx])
-                sn_dist = float(line[sndist_idx])
-                gh_data[route_id] = {'dist':dist, 'beauty':beauty, 'simplicity':simplicity, 'non_hw_time':non_hw_time,
-                                     'non_hw_dist':non_hw_dist, 'sn_time':sn_time, 'sn_dist':sn_dist}
-            except ValueError:
-                print("GH:", line)
-
-    with open(gmaps_csv, 'r') as fin:
-        csvreader = csv.reader(fin)
-        api_header = next(csvreader)
-        assert api_header == EXPECTED_HEADER[:len(api_header)]
-
-        processed = 0
-        skipped = 0
-        kept = 0
-        with open(output_csv, 'w') as fout:
-            csvwriter = csv.writer(fout)
-            csvwriter.writerow(EXPECTED_HEADER)
-
-            for line in csvreader:
-                if not line: continue  # because Windows
-
-                route_id = line[route_idx]
-                dist = float(line[dist_idx])
-
-                try:
-                    if route_id not in gh_data:
-                        skipped += 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--optimization", nargs="+", choices=OPTIMIZATIONS, default=["fastest"],
+                        help="Route sets to merge, one merge each.")
+    parser.add_argument("--threshold", nargs="+", type=float, default=[0.10],
+                        help="Error tolerances between distance results; all of them are " +
+                             "evaluated in one pass, with one output each.")
+    parser.add_argument("--join-on", default=",".join(JOIN_KEYS),
+                        help="Comma-separated fields to match routes on, e.g. ID,name to " +
+                             "match alternatives to alternatives.")
+    parser.add_argument("--match", choices=METRICS,
+                        help="Instead of joining on fields, pair each Google route with the " +
+                             "GraphHopper alternative for its ID closest in shape by this distance.")
+    parser.add_argument("--max-match-distance", type=float,
+                        help="With --match, leave routes further apart than this (meters) unmatched.")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="Folder holding the route sets, where the outputs are written too.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="merge_results")
+
+    keys = args.join_on.split(",")
+    for optimization in args.optimization:
+        # Set up file paths
+        gmaps_csv = os.path.join(args.data_dir, f"chicago_routes_gmaps_{optimization}_matched.csv")
+        gh_csv = os.path.join(args.data_dir, f"chicago_routes_gh_{optimization}.csv")
+        output_base = os.path.join(args.data_dir, f"chicago_routes_{optimization}_merged")
+
+        # Route stores are used in place of the CSVs where they exist, and the
+        # output is a store too if the Google routes are in one
+        gmaps_csv = route_store.prefer_store(gmaps_csv)
+        gh_csv = route_store.prefer_store(gh_csv)
+        extension = ".routes" if route_store.is_store(gmaps_csv) else ".csv"
+
+        # with several thresholds, each output is named after its threshold
+        outputs = {}
+        for threshold in args.threshold:
+            suffix = f"_{threshold:g}" if len(args.threshold) > 1 else ""
+            outputs[threshold] = output_base + suffix + extension
+
+        with instrument.span("merge", optimization=optimization):
+            merge(gmaps_csv, gh_csv, outputs, keys, args.match, args.max_match_distance)
+
+
+def merge(gmaps_csv, gh_csv, outputs, keys=JOIN_KEYS, match=None, max_match_distance=None):
+    """Add GraphHopper's route attributes to Google routes of similar length.
+
+    GraphHopper's routes are loaded once into a hash table of join keys and
+    NumPy columns of their numbers. Google's routes are then streamed past
+    in batches: each batch is joined, its distance errors are computed once
+    for every threshold, and each route is written straight to the outputs
+    of the thresholds it is within.
+
+    params
+     - gmaps_csv: str - Google routes, CSV or route store
+     - gh_csv: str - GraphHopper routes, CSV or route store
+     - outputs: Dict{float : str} - output for each error tolerance between
+       distance results; a CSV if it ends in .csv, else a store
+     - keys: List[str] - fields to match routes on; if several GraphHopper
+       routes have the same keys, the last one is used
+     - match: str - if given, ignore keys and join each Google route to the
+       GraphHopper route of the same ID paired with it by shape, by
+       route_set.pair_alternatives with this metric
+     - max_match_distance: float - with match, furthest apart (meters) that
+       routes are paired
+
+    return
+     - Dict{float : int} - number of routes kept for each threshold
+    """
+
+    if match:
+        # the pairing needs the polylines, so both sets are read once more
+        with instrument.span("pair_alternatives", metric=match):
+            set1, set2 = RouteSet.read(gmaps_csv), RouteSet.read(gh_csv)
+            paired = {set1.key(i): set2.key(j)
+                      for i, j, _ in pair_alternatives(set1, set2, match, max_match_distance)}
+        keys = ["ID", "name"]
+        join_key = lambda route: paired.get((route['ID'], route['name']))
+    else:
+        join_key = lambda route: tuple(route[key] for key in keys)
+
+    print(f"\nMerging {gmaps_csv} and {gh_csv} on {match or ', '.join(keys)} with " +
+          f"{', '.join(map(str, outputs))} threshold and output to {', '.join(outputs.values())}.")
+
+    # Polylines are passed through untouched, so don't parse them
+    gh_header, gh_routes = route_store.read_routes(gh_csv, parse=False)
+    assert gh_header == EXPECTED_HEADER[:len(gh_header)]
+    gh_index, gh_distances, gh_values = read_gh_columns(gh_routes, keys)
+
+    api_header, api_routes = route_store.read_routes(gmaps_csv, parse=False)
+    assert api_header == EXPECTED_HEADER[:len(api_header)]
+
+    counts = {'processed': 0, 'skipped': 0}
+    kept = {threshold: 0 for threshold in outputs}
+    writers = {threshold: route_store.route_writer(output, EXPECTED_HEADER)
+               for threshold, output in outputs.items()}
+    try:
+        while True:
+            batch = list(itertools.islice(api_routes, BATCH_SIZE))
+            if not batch:
+                break
+
+            rows = np.array([gh_index.get(join_key(route), -1) for route in batch], dtype=np.int64)
+            dists, bad = parse_floats([route['total_distance_in_meters'] for route in batch])
+            for i in np.flatnonzero(bad):
+                print("API:", batch[i])
+
+            found = rows >= 0
+            counts['skipped'] += int((~found).sum())
+            counts['processed'] += int((found & ~bad).sum())
+
+            # relative error of each joined route, for all thresholds at once
+            errors = np.full(len(batch), np.inf)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                errors[found] = np.abs((dists[found] - gh_distances[rows[found]]) / dists[found])
+
+            # each route is merged (and formatted as CSV) once, then written
+            # to every output keeping it
+            keeps = {threshold: errors < threshold for threshold in outputs}
+            for i in np.flatnonzero(errors < max(outputs)):
+                merged = {field: batch[i][field] for field in api_header}
+                merged.update(zip(GH_FIELDS, gh_values[rows[i]]))
+                line = None
+                for threshold, writer in writers.items():
+                    if not keeps[threshold][i]:
                         continue
-
-                    if route_id in gh_data and abs((dist - gh_data[route_id]['dist']) / dist) < threshold:
-                        line.extend([gh_data[route_id]['beauty'], gh_data[route_id]['simplicity'],
-                                     gh_data[route_id]['non_hw_time'], gh_data[route_id]['non_hw_dist'],
-                                     gh_data[route_id]['sn_time'], gh_data[route_id]['sn_dist']])
-                        csvwriter.writerow(line)
-                        kept += 1
-
-                    processed += 1
-                except ValueError:
-                    print("API:", line)
-
-    print(f"{processed} external API routes processed, {skipped} skipped, " +
-          f"and {kept} kept.")
+                    if isinstance(writer, route_store.RouteCSVWriter):
+                        line = line or writer.format(merged)
+                        writer.write_line(line)
+                    else:
+                        writer.write(merged)
+                    kept[threshold] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    instrument.count("routes_processed_total", counts['processed'])
+    instrument.count("routes_skipped_total", counts['skipped'])
+    for threshold in outputs:
+        print(f"{counts['processed']} external API routes processed, {counts['skipped']} " +
+              f"skipped, and {kept[threshold]} kept with {threshold} threshold.")
+        instrument.count("routes_kept_total", kept[threshold], threshold=f"{threshold:g}")
+    return kept
+
+
+def read_gh_columns(gh_routes, keys):
+    """Load GraphHopper routes into a hash table and columns of numbers.
+
+    Routes with a field that is not a number are left out.
+
+    return
+     - index: Dict{tuple : int} - row of each route's join keys
+     - distances: float64 array - total_distance_in_meters of each row
+     - values: List[List[float]] - GH_FIELDS of each row
+    """
+
+    fields = ['total_distance_in_meters'] + GH_FIELDS
+    route_keys, strings = [], []
+    for route in gh_routes:
+        route_keys.append(tuple(route[key] for key in keys))
+        strings.extend(route[field] for field in fields)
+
+    numbers, bad = parse_floats(strings)
+    numbers = numbers.reshape(-1, len(fields))
+    bad_rows = bad.reshape(-1, len(fields)).any(axis=1)
+    for i in np.flatnonzero(bad_rows):
+        values = strings[i * len(fields):(i + 1) * len(fields)]
+        print("GH:", dict(zip(keys + fields, list(route_keys[i]) + values)))
+
+    good = np.flatnonzero(~bad_rows)
+    index = {}
+    for row, i in enumerate(good):
+        index[route_keys[i]] = row
+    return index, numbers[good, 0], numbers[good, 1:].tolist()
+
+
+def parse_floats(values):
+    """Parse strings to a float64 array, all at once when possible.
+
+    return
+     - (floats, bad): float64 array, NaN where a value is not a number,
+       and a bool array marking those
+    """
+
+    if not any(value is None for value in values):
+        try:
+            return np.array(values, dtype=np.float64), np.zeros(len(values), dtype=bool)
+        except ValueError:
+            pass
+
+    floats = np.empty(len(values), dtype=np.float64)
+    bad = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            floats[i] = float(value)
+        except (TypeError, ValueError):
+            floats[i], bad[i] = np.nan, True
+    return floats, bad
 
 
 if __name__ == "__main__":
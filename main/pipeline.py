@@ -0,0 +1,419 @@
+"""Run the whole workflow, re-running only the stages that are out of date.
+
+The stages are the scripts in this folder:
+
+    grid_creation -> generate_od_pairs -> get_routes --+-> map_matching
+    get_traffic_data ----------------------------------+
+    merge_results (one per optimization)
+    diff_segments
+
+Each stage declares the files it reads and writes, and which stage comes
+after which follows from those. A stage's fingerprint is a SHA-256 of its
+parameters, its inputs' contents, and the source of its script and the
+local modules that script imports. A stage is run when its fingerprint
+differs from the one recorded after its last successful run, or when one of
+its outputs is missing, so an edit anywhere upstream re-runs exactly the
+stages it reaches. Files of unchanged size and modification time are not
+hashed again.
+
+Every stage runs as its own process, up to --jobs at a time, so stages that
+do not depend on each other (e.g. fetching traffic and fetching routes) run
+side by side. Each stage's output goes to a log file, and each run's stages,
+with wall time and peak memory (ru_maxrss from os.wait4), are added to a
+JSON manifest.
+
+Stages whose inputs come from outside the pipeline (GraphHopper's routes,
+the map-matched Google routes) are skipped, with those after them, while
+those inputs are missing. Where a route store exists in place of one of
+those CSVs (see route_store.prefer_store), the store is what merge_results
+and diff_segments read, so it is the input declared and fingerprinted.
+
+map_matching's exposure CSV is an output of its own, for analysis; no later
+stage reads it.
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import route_store
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA_DIR = SCRIPT_DIR + "/data/"
+
+OPTIMIZATIONS = ["fastest", "traffic"]
+HASH_CHUNK = 1 << 20  # bytes read at a time when hashing files
+
+
+class Stage(object):
+
+    def __init__(self, name, script, args, inputs, outputs, params=None):
+        """One script run.
+
+        params
+         - name: str - unique stage name
+         - script: str - script in this folder, e.g. "get_routes.py"
+         - args: List[str] - its command line arguments
+         - inputs: List[str] - files or folders it reads
+         - outputs: List[str] - files or folders it writes
+         - params: dict - settings that change its outputs but are not in
+           args (args are always part of the fingerprint)
+        """
+
+        self.name = name
+        self.script = script
+        self.args = [str(arg) for arg in args]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+    def command(self):
+        return [sys.executable, os.path.join(SCRIPT_DIR, self.script)] + self.args
+
+
+def workflow_stages(data_dir=DATA_DIR, grid_size=0.001, num_pairs=None, seed=None, workers=1,
+                    qps=5.0, base_url=None, threshold=0.10, contrasts=None, iterations=500):
+    """The workflow's stages, reading and writing files in data_dir."""
+
+    def path(fname):
+        return os.path.join(data_dir, fname)
+
+    def routes_path(fname):
+        # the file merge_results and diff_segments will read
+        return route_store.prefer_store(path(fname))
+
+    boundary = path("chicago_boundary.geojson")
+    grid = path("chicago_grid.geojson")
+    od_pairs = path("chicago_od_pairs.csv")
+    routes = path("chicago_routes_gmaps.csv")
+    traffic = path("traffic.csv")
+    poly1 = os.path.join(SCRIPT_DIR, "data", "poly1.txt")  # always read from here
+
+    od_args = ["--grid", grid, "--output", od_pairs]
+    if num_pairs is not None:
+        od_args += ["--num-pairs", num_pairs]
+    if seed is not None:
+        od_args += ["--seed", seed]
+    traffic_args = ["--output", traffic] + (["--base-url", base_url] if base_url else [])
+
+    stages = [
+        Stage("grid", "grid_creation.py",
+              [boundary, data_dir, "--grid-size", grid_size, "--output", grid],
+              [boundary], [grid, os.path.splitext(grid)[0] + ".npz"]),
+        Stage("od_pairs", "generate_od_pairs.py", od_args, [grid], [od_pairs]),
+        Stage("routes", "get_routes.py",
+              ["--od-pairs", od_pairs, "--output", routes, "--workers", workers, "--qps", qps,
+               "--cache", path("google_directions_cache.sqlite")],
+              [od_pairs], [routes]),
+        Stage("traffic", "get_traffic_data.py", traffic_args, [poly1], [traffic]),
+        Stage("exposure", "map_matching.py",
+              ["--routes", routes, "--traffic", traffic,
+               "--output", path("chicago_routes_gmaps_exposure.csv")],
+              [routes, traffic, poly1], [path("chicago_routes_gmaps_exposure.csv")]),
+    ]
+
+    for optimization in OPTIMIZATIONS:
+        gmaps = routes_path(f"chicago_routes_gmaps_{optimization}_matched.csv")
+        # the output is a store when the Google routes are
+        extension = ".routes" if route_store.is_store(gmaps) else ".csv"
+        stages.append(Stage(
+            f"merge_{optimization}", "merge_results.py",
+            ["--optimization", optimization, "--threshold", threshold, "--data-dir", data_dir],
+            [gmaps, routes_path(f"chicago_routes_gh_{optimization}.csv")],
+            [path(f"chicago_routes_{optimization}_merged{extension}")]))
+
+    contrasts = contrasts or [f"{optimization}_gm:{optimization}_gh" for optimization in OPTIMIZATIONS]
+    diff_args = ["--data-dir", data_dir, "--iterations", iterations, "--workers", workers]
+    diff_inputs, diff_outputs = [], []
+    for contrast in contrasts:
+        diff_args += ["--contrast", contrast]
+        for name in contrast.split(":"):
+            provider = "gmaps" if name.endswith("_gm") else "gh"
+            fname = routes_path(f"chicago_routes_{provider}_{name.rsplit('_', 1)[0]}.csv")
+            if fname not in diff_inputs:
+                diff_inputs.append(fname)
+        diff_outputs.append(path(f"route_diffs_{contrast.replace(':', '_')}.geojson"))
+    if seed is not None:
+        diff_args += ["--seed", seed]
+    stages.append(Stage("diff", "diff_segments.py", diff_args, diff_inputs, diff_outputs))
+
+    return stages
+
+
+def hash_path(path, known):
+    """SHA-256 of a file's contents, or of a folder's file names and contents.
+
+    params
+     - known: Dict{str : [int, int, str]} - size, modification time and
+       hash of files hashed before; used when a file's size and time still
+       match, and updated
+    """
+
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                fn = os.path.join(root, fname)
+                digest.update(os.path.relpath(fn, path).encode() + b"\0")
+                digest.update(hash_path(fn, known).encode())
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    entry = known.get(path)
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    known[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return known[path][2]
+
+
+def local_sources(script):
+    """The script and every module of this folder it imports, directly or not."""
+
+    sources, todo = set(), [os.path.join(SCRIPT_DIR, script)]
+    while todo:
+        fn = todo.pop()
+        if fn in sources:
+            continue
+        sources.add(fn)
+        with open(fn) as fin:
+            tree = ast.parse(fin.read(), fn)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module_fn = os.path.join(SCRIPT_DIR, name.split(".")[0] + ".py")
+                if os.path.exists(module_fn):
+                    todo.append(module_fn)
+    return sorted(sources)
+
+
+def fingerprint(stage, known):
+    """SHA-256 of the stage's command, params, inputs and source code."""
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage.script, stage.args, stage.params], sort_keys=True).encode())
+    for fn in stage.inputs + local_sources(stage.script):
+        digest.update(fn.encode() + b"\0" + hash_path(fn, known).encode())
+    return digest.hexdigest()
+
+
+def dependencies(stages):
+    """Dict{str : set} - names of the stages whose outputs each stage reads."""
+
+    producer = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producer[output] = stage.name
+    return {stage.name: {producer[fn] for fn in stage.inputs if fn in producer} - {stage.name}
+            for stage in stages}
+
+
+def upstream(stages, targets):
+    """The stages needed for targets: themselves and all they depend on."""
+
+    depends = dependencies(stages)
+    needed, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(depends[name])
+    return [stage for stage in stages if stage.name in needed]
+
+
+def load_manifest(manifest_fn):
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn) as fin:
+            return json.load(fin)
+    return {'stages': {}, 'hashes': {}, 'runs': []}
+
+
+def save_manifest(manifest, manifest_fn):
+    # written to the side and renamed, so an interrupted save keeps the old one
+    with open(manifest_fn + ".tmp", 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    os.replace(manifest_fn + ".tmp", manifest_fn)
+
+
+def run(stages, manifest_fn, log_dir, jobs=2, force=(), dry_run=False, metrics_dir=None):
+    """Run the stages that are out of date, up to jobs at a time.
+
+    A stage starts once every stage it depends on has finished; its
+    fingerprint is only taken then, since it depends on their outputs.
+
+    params
+     - stages: List[Stage]
+     - manifest_fn: str - JSON manifest of fingerprints and runs, updated
+       after every stage
+     - log_dir: str - folder for each stage's output, <name>.log
+     - jobs: int - most stages running at once
+     - force: Iterable[str] - names of stages to run even if up to date
+     - dry_run: bool - only print which stages would run; as an up to date
+       stage's outputs are not rebuilt, this assumes the ones before it
+       leave their outputs unchanged
+     - metrics_dir: str - if given, each stage records its timings and
+       counts (see instrument.py) to <name>.jsonl here; this is not part
+       of the fingerprint, so it does not make stages stale
+
+    return
+     - Dict{str : dict} - this run's record of each stage: its status
+       ("ran", "cached", "failed", "missing inputs", "skipped" after a
+       failure upstream, or "stale" in a dry run), and for stages that ran,
+       wall_sec, max_rss_mb and exit_code
+    """
+
+    manifest = load_manifest(manifest_fn)
+    known = manifest['hashes']
+    depends = dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    os.makedirs(log_dir, exist_ok=True)
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    record = {}
+    running = {}  # pid : (stage, Popen, start time, fingerprint, log file)
+    waiting = [stage.name for stage in stages]
+    run_start = time.time()
+
+    def settle(name, status, **fields):
+        record[name] = dict(status=status, **fields)
+        print(f"{name}: {status}" + "".join(f", {key} {value}" for key, value in fields.items()))
+
+    while waiting or running:
+        # start whatever is ready, while there is room
+        progress = False
+        for name in list(waiting):
+            if len(running) >= jobs:
+                break
+            stage = by_name[name]
+            before = [record.get(dep, {}).get('status') for dep in depends[name]]
+            if any(status is None for status in before):
+                continue  # not done yet
+            waiting.remove(name)
+            progress = True
+
+            if any(status not in ("ran", "cached", "stale") for status in before):
+                settle(name, "skipped")
+                continue
+            missing = [fn for fn in stage.inputs if not os.path.exists(fn)]
+            if missing and "stale" not in before:
+                settle(name, "missing inputs", missing=missing)
+                continue
+
+            previous = manifest['stages'].get(name, {})
+            if "stale" in before:
+                stale, stamp = True, None
+            else:
+                stamp = fingerprint(stage, known)
+                stale = (name in force or stamp != previous.get('fingerprint') or
+                         not all(os.path.exists(fn) for fn in stage.outputs))
+            if not stale:
+                settle(name, "cached")
+                continue
+            if dry_run:
+                settle(name, "stale")
+                continue
+
+            command = stage.command()
+            if metrics_dir:
+                command += ["--metrics", os.path.join(metrics_dir, name + ".jsonl")]
+            log = open(os.path.join(log_dir, name + ".log"), 'w')
+            print(f"{name}: running {' '.join(command)}")
+            proc = subprocess.Popen(command, cwd=SCRIPT_DIR, stdout=log, stderr=subprocess.STDOUT)
+            running[proc.pid] = (stage, proc, time.perf_counter(), stamp, log)
+
+        if not running:
+            if waiting and not progress:
+                raise ValueError(f"stages {', '.join(waiting)} depend on each other")
+            continue
+
+        # wait for any stage to finish; its rusage is that process's alone
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        stage, proc, start, stamp, log = running.pop(pid)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        log.close()
+
+        fields = {'wall_sec': round(time.perf_counter() - start, 3),
+                  'max_rss_mb': round(usage.ru_maxrss / 1024, 1),  # KB on Linux
+                  'exit_code': proc.returncode}
+        if proc.returncode == 0:
+            manifest['stages'][stage.name] = dict(
+                fields, fingerprint=stamp, finished=time.time(),
+                outputs={fn: hash_path(fn, known) for fn in stage.outputs if os.path.exists(fn)})
+            settle(stage.name, "ran", **fields)
+        else:
+            settle(stage.name, "failed", **fields)
+        save_manifest(manifest, manifest_fn)
+
+    if not dry_run:
+        manifest['runs'].append({'started': run_start, 'wall_sec': round(time.time() - run_start, 3),
+                                 'stages': record})
+        save_manifest(manifest, manifest_fn)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*",
+                        help="Stages to bring up to date, with all they depend on; all if none " +
+                             "are given.")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="Folder every stage reads from and writes to.")
+    parser.add_argument("--manifest", default=None,
+                        help="Run manifest; <data-dir>/pipeline_manifest.json if not given.")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="Most stages running at once.")
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE",
+                        help="Run these stages even if up to date, e.g. traffic for fresh data.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print which stages are out of date.")
+    parser.add_argument("--grid-size", type=float, default=0.001)
+    parser.add_argument("--num-pairs", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Query threads for get_routes, processes for diff_segments.")
+    parser.add_argument("--qps", type=float, default=5.0)
+    parser.add_argument("--base-url", default=None, help="Traffic feed location.")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--contrast", action="append", default=None, metavar="SET1:SET2")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--metrics-dir", default=None,
+                        help="Have each stage record timings and counts to <stage>.jsonl here.")
+    args = parser.parse_args()
+
+    stages = workflow_stages(args.data_dir, args.grid_size, args.num_pairs, args.seed,
+                             args.workers, args.qps, args.base_url, args.threshold,
+                             args.contrast, args.iterations)
+    names = [stage.name for stage in stages]
+    for name in args.targets + args.force:
+        if name not in names:
+            parser.error(f"unknown stage {name}; stages are {', '.join(names)}")
+    if args.targets:
+        stages = upstream(stages, args.targets)
+
+    manifest_fn = args.manifest or os.path.join(args.data_dir, "pipeline_manifest.json")
+    record = run(stages, manifest_fn, os.path.join(args.data_dir, "pipeline_logs"), args.jobs,
+                 args.force, args.dry_run, args.metrics_dir)
+    if any(entry['status'] == "failed" for entry in record.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Vectorized encoder/decoder for Google's encoded polyline format.
+
+https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+The decoder returns exactly the same floats as the original pure Python
+GoogleAPI.decode for any valid coordinates (|value| <= 180). That function
+accumulated float offsets and then rounded each point to 6 digits, which
+lands on the double closest to k / 1e5 for the exact integer offset sum k.
+Here we sum the integer offsets directly and divide once, which gives that
+same double.
+"""
+
+import numpy as np
+
+
+def _decode_numbers(values, last):
+    """Decode varints from 5-bit chunks.
+
+    params
+     - values: int64 array - chunks with the continuation bit cleared
+     - last: bool array - whether each chunk is the last of its value; the
+       final chunk must be one
+
+    return
+     - int64 array of signed values
+    """
+
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    ends = np.flatnonzero(last)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # chunk i of a value is shifted left by 5 * i
+    value_index = np.cumsum(last) - last
+    shifts = 5 * (np.arange(len(values)) - starts[value_index])
+    numbers = np.bitwise_or.reduceat(values << shifts, starts)
+
+    # there is a 1 on the right if the value is negative
+    return np.where(numbers & 1, ~numbers, numbers) >> 1
+
+
+def decode_many(point_strs):
+    """Decode many polylines into one flat coordinate buffer.
+
+    params
+     - point_strs: List[str] - encoded polylines
+
+    return
+     - (coords, offsets) - coords is a float64 array of shape (n, 2) holding
+       (latitude, longitude) rows for all polylines back to back; the points
+       of polyline i are coords[offsets[i]:offsets[i + 1]]
+    """
+
+    lengths = np.fromiter(map(len, point_strs), dtype=np.int64, count=len(point_strs))
+    num_strs = len(lengths)
+    buf = np.frombuffer("".join(point_strs).encode("latin-1"), dtype=np.uint8)
+    if len(buf) == 0:
+        return np.empty((0, 2)), np.zeros(num_strs + 1, dtype=np.int64)
+
+    char_str = np.repeat(np.arange(num_strs), lengths)
+    str_starts = np.concatenate(([0], np.cumsum(lengths)))
+
+    # A value cut off at the end of a polyline is dropped, as it was by the
+    # original decoder. Find the chunks that are followed by an end chunk in
+    # the same polyline and decode only those.
+    values = buf.astype(np.int64) - 63
+
+    # values that have a chunk following have an extra 1 on the left
+    last = (values & 0x20) == 0
+    values &= 0x1F
+
+    ends_through = np.concatenate(([0], np.cumsum(last)))
+    ends_in_str = ends_through[str_starts]
+    complete = ends_through[:-1] < ends_in_str[1:][char_str]
+    numbers = _decode_numbers(values[complete], last[complete])
+
+    # an odd value left over at the end of a polyline is dropped as well
+    num_counts = np.diff(ends_in_str)
+    pair_counts = num_counts // 2
+    num_str = np.repeat(np.arange(num_strs), num_counts)
+    num_index = np.arange(len(numbers)) - np.repeat(ends_in_str[:-1], num_counts)
+    pairs = numbers[num_index < 2 * pair_counts[num_str]].reshape(-1, 2)
+
+    # offsets to actual values, restarting at every polyline
+    pair_starts = np.concatenate(([0], np.cumsum(pair_counts)))
+    totals = np.cumsum(pairs, axis=0)
+    before = np.concatenate((np.zeros((1, 2), dtype=np.int64), totals))[pair_starts[:-1]]
+    totals -= np.repeat(before, pair_counts, axis=0)
+
+    # a pair of zero offsets repeats the previous point and is skipped
+    keep = (pairs != 0).any(axis=1)
+    kept_counts = np.bincount(np.repeat(np.arange(num_strs), pair_counts)[keep],
+                              minlength=num_strs)
+    offsets = np.concatenate(([0], np.cumsum(kept_counts)))
+    return totals[keep] / 100000.0, offsets
+
+
+def decode(point_str):
+    """Decode one polyline into a float64 array of (latitude, longitude) rows."""
+
+    return decode_many([point_str])[0]
+
+
+def join_steps(coords, offsets):
+    """Join decoded step polylines into one route.
+
+    Where a step starts at the point the previous step ended on, that
+    point is kept only once.
+
+    params
+     - coords, offsets: output of decode_many for a route's steps
+
+    return
+     - float64 array of shape (n, 2)
+    """
+
+    counts = np.diff(offsets)
+    nonempty = np.flatnonzero(counts)
+    firsts = offsets[nonempty]
+    lasts = offsets[nonempty + 1] - 1
+
+    keep = np.ones(len(coords), dtype=bool)
+    repeated = (coords[firsts[1:]] == coords[lasts[:-1]]).all(axis=1)
+    keep[firsts[1:][repeated]] = False
+    return coords[keep]
+
+
+def encode(points):
+    """Encode (latitude, longitude) points as a polyline string.
+
+    params
+     - points: array-like of shape (n, 2)
+
+    return
+     - str
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return ""
+
+    # round half up, as the reference implementation does
+    ints = np.floor(points * 100000.0 + 0.5).astype(np.int64)
+    deltas = np.diff(ints, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+    # left shift, inverting negative values
+    values = deltas << 1
+    values = np.where(deltas < 0, ~values, values)
+
+    # split into 5-bit chunks, low bits first; every chunk but the last of a
+    # value gets the continuation bit 0x20
+    shifts = 5 * np.arange(7)
+    chunks = (values[:, None] >> shifts) & 0x1F
+    num_chunks = 7 - np.argmax(chunks[:, ::-1] != 0, axis=1)
+    num_chunks[values == 0] = 1
+    in_value = np.arange(7) < num_chunks[:, None]
+    chunks |= np.where(np.arange(7) < num_chunks[:, None] - 1, 0x20, 0)
+    return (chunks[in_value] + 63).astype(np.uint8).tobytes().decode("ascii")
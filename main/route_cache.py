@@ -0,0 +1,152 @@
+"""Persistent cache of raw directions responses.
+
+Responses are stored in SQLite, addressed by a hash of everything that
+determines the answer: origin, destination, travel mode, whether
+alternatives were requested and the departure time, bucketed so that
+queries made within the same window share an entry. The raw JSON is kept
+so routes can be re-parsed later without querying the API again.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    route_id TEXT,
+    origin TEXT,
+    destination TEXT,
+    mode TEXT,
+    alternatives INTEGER,
+    departure_bucket INTEGER,
+    created REAL,
+    last_used REAL,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class RouteCache(object):
+
+    def __init__(self, cache_fn, ttl_sec=7 * 24 * 3600, max_entries=100000,
+                 bucket_sec=3600):
+        """Open (or create) a cache file.
+
+        params
+         - cache_fn: str - path to the SQLite file
+         - ttl_sec: float - entries older than this are treated as missing
+           and deleted; None keeps them forever
+         - max_entries: int - least recently used entries are evicted past
+           this many; None for no limit
+         - bucket_sec: int - width of the departure time buckets
+        """
+
+        self.cache_fn = cache_fn
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.bucket_sec = bucket_sec
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_fn, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def departure_bucket(self, departure_time="now"):
+        if departure_time == "now":
+            departure_time = time.time()
+        elif hasattr(departure_time, "timestamp"):
+            departure_time = departure_time.timestamp()
+        return int(departure_time // self.bucket_sec)
+
+    def make_key(self, origin, destination, mode, alternatives, departure_time="now"):
+        params = [list(origin), list(destination), mode, bool(alternatives),
+                  self.departure_bucket(departure_time)]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest(), params
+
+    def get(self, origin, destination, mode, alternatives, departure_time="now"):
+        """Return the cached list of route JSONs, or None on a miss."""
+
+        key, _ = self.make_key(origin, destination, mode, alternatives, departure_time)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT created, response FROM responses WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is not None and self.ttl_sec is not None and now - row[0] > self.ttl_sec:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                self.expired += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return json.loads(row[1])
+
+    def contains(self, origin, destination, mode, alternatives, departure_time="now"):
+        key, _ = self.make_key(origin, destination, mode, alternatives, departure_time)
+        with self.lock:
+            row = self.conn.execute("SELECT created FROM responses WHERE key = ?",
+                                    (key,)).fetchone()
+        return row is not None and (self.ttl_sec is None or time.time() - row[0] <= self.ttl_sec)
+
+    def put(self, route_id, origin, destination, mode, alternatives, route_jsons,
+            departure_time="now"):
+        key, params = self.make_key(origin, destination, mode, alternatives, departure_time)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, route_id, json.dumps(params[0]), json.dumps(params[1]), mode,
+                 int(params[3]), params[4], now, now, json.dumps(route_jsons)))
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones over the limit.
+
+        Callers must hold self.lock.
+        """
+
+        if self.ttl_sec is not None:
+            cursor = self.conn.execute("DELETE FROM responses WHERE created < ?",
+                                       (time.time() - self.ttl_sec,))
+            self.expired += cursor.rowcount
+
+        if self.max_entries is not None:
+            count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+                self.evicted += cursor.rowcount
+
+    def responses(self):
+        """Yield (route_id, route_jsons) for every cached response."""
+
+        with self.lock:
+            rows = self.conn.execute("SELECT route_id, response FROM responses "
+                                     "ORDER BY created").fetchall()
+        for route_id, response in rows:
+            yield route_id, json.loads(response)
+
+    def stats(self):
+        return ("{0} hits, {1} misses, {2} expired, {3} evicted"
+                .format(self.hits, self.misses, self.expired, self.evicted))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
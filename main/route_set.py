@@ -0,0 +1,252 @@
+"""Sets of routes keyed by (ID, name), and pairing of alternative routes.
+
+get_routes asks for alternatives, so one OD pair (one ID) can have several
+routes, named "main", "alternative 1", and so on. Dicts keyed by ID alone
+keep only one of them. A RouteSet keeps them all:
+ - points: float64 (P, 2) array of every route's (lat, lon) points back
+   to back, those of route i at points[offsets[i]:offsets[i + 1]]
+ - ids, names, rows: ID, name and other fields of each route
+ - index: route number of each (ID, name), and alternatives: route
+   numbers of each ID
+
+pair_alternatives matches the routes of two sets with the same ID one to
+one, by shape: the pairing that minimizes the total Hausdorff (or discrete
+Frechet) distance between paired routes. Hausdorff distances between long
+routes are computed with a KD-tree per route, so a pair of routes with n
+and m points takes O((n + m) log(n + m)) rather than O(n m); for short ones,
+one matrix of point distances per route, to all the other set's
+alternatives at once, is quicker. Frechet distances need O(n m);
+they are computed for many pairs at once, and skipped where the Hausdorff
+distance (never more than the Frechet distance) already rules a pair out.
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+import route_store
+
+METRICS = ["hausdorff", "frechet"]
+
+# meters per degree, for an equirectangular projection
+M_PER_DEG_LAT = 110574.0
+M_PER_DEG_LON = 111320.0
+
+FRECHET_BATCH = 256  # route pairs per discrete Frechet dynamic program
+DENSE_POINTS = 1000000  # largest point distance matrix used in place of KD-trees
+
+
+class RouteSet(object):
+
+    def __init__(self, ids, names, points, offsets, rows=None):
+        """A set of routes; see the module docstring for the attributes."""
+
+        self.ids = list(ids)
+        self.names = list(names)
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rows = rows if rows is not None else [{} for _ in self.ids]
+
+        # a later route with the same (ID, name) shadows an earlier one
+        self.index = {}
+        self.alternatives = {}
+        for i, key in enumerate(zip(self.ids, self.names)):
+            if key in self.index:
+                self.alternatives[key[0]].remove(self.index[key])
+            self.index[key] = i
+            self.alternatives.setdefault(key[0], []).append(i)
+
+    @classmethod
+    def read(cls, path):
+        """Read a routes CSV or store; routes whose polyline does not parse
+        are left out."""
+
+        _, routes = route_store.read_routes(path)
+        ids, names, polylines, rows = [], [], [], []
+        for route in routes:
+            points = route.pop('polyline_points')
+            if points is None:
+                continue
+            ids.append(route['ID'])
+            names.append(route['name'])
+            polylines.append(points)
+            rows.append(route)
+
+        offsets = np.concatenate(([0], np.cumsum([len(points) for points in polylines])))
+        points = np.concatenate(polylines) if polylines else np.empty((0, 2))
+        return cls(ids, names, points, offsets, rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def key(self, i):
+        return (self.ids[i], self.names[i])
+
+    def route(self, i):
+        """(lat, lon) points of route i."""
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+
+def projector(lat0):
+    """Project (lat, lon) points to meters around latitude lat0."""
+
+    scale = np.array([M_PER_DEG_LAT, M_PER_DEG_LON * np.cos(np.radians(lat0))])
+    return lambda points: np.asarray(points, dtype=np.float64).reshape(-1, 2) * scale
+
+
+def hausdorff(a, b, tree_a=None, tree_b=None):
+    """Hausdorff distance between point sets a and b, via KD-trees."""
+
+    tree_a = tree_a or cKDTree(a)
+    tree_b = tree_b or cKDTree(b)
+    return max(tree_b.query(a)[0].max(), tree_a.query(b)[0].max())
+
+
+def hausdorff_rows(a, others, offsets):
+    """Hausdorff distances between point set a and each of several others.
+
+    params
+     - a: array (n, 2)
+     - others: array (M, 2) - the other point sets back to back, set l at
+       others[offsets[l]:offsets[l + 1]], none empty
+
+    return
+     - float64 array - distance to each of the others
+    """
+
+    d = cdist(a, others)
+    from_a = np.minimum.reduceat(d, offsets[:-1], axis=1).max(axis=0)
+    to_a = np.maximum.reduceat(d.min(axis=0), offsets[:-1])
+    return np.maximum(from_a, to_a)
+
+
+def discrete_frechet(curves1, curves2):
+    """Discrete Frechet distance between each pair of polylines.
+
+    All pairs go through the dynamic program together, one anti-diagonal at
+    a time: cell (i, j) only needs cells on the two diagonals before it.
+    Shorter curves are padded by repeating their last point, which leaves
+    their distance unchanged.
+
+    params
+     - curves1, curves2: List[array (n, 2)] - the pairs, none empty
+
+    return
+     - float64 array - distance of each pair
+    """
+
+    def padded(curves):
+        longest = max(len(curve) for curve in curves)
+        stacked = np.empty((len(curves), longest, 2))
+        for k, curve in enumerate(curves):
+            stacked[k, :len(curve)] = curve
+            stacked[k, len(curve):] = curve[-1]
+        return stacked
+
+    a, b = padded(curves1), padded(curves2)
+    pairs, n, m = len(a), a.shape[1], b.shape[1]
+    previous2 = np.full((pairs, n), np.inf)  # diagonal k - 2, indexed by i
+    previous = np.full((pairs, n), np.inf)  # diagonal k - 1
+    for k in range(n + m - 1):
+        i = np.arange(max(0, k - m + 1), min(n, k + 1))
+        d = np.sqrt(((a[:, i] - b[:, k - i]) ** 2).sum(axis=2))
+        current = np.full((pairs, n), np.inf)
+        if k == 0:
+            current[:, 0] = d[:, 0]
+        else:
+            # (i - 1, j) and (i, j - 1) are on diagonal k - 1, (i - 1, j - 1) on k - 2
+            before = np.maximum(i - 1, 0)
+            up = np.where(i > 0, previous[:, before], np.inf)
+            diagonal = np.where(i > 0, previous2[:, before], np.inf)
+            best = np.minimum(np.minimum(up, previous[:, i]), diagonal)
+            current[:, i] = np.maximum(d, best)
+        previous2, previous = previous, current
+    return previous[:, n - 1]
+
+
+def pair_alternatives(set1, set2, metric="hausdorff", max_distance=None):
+    """Pair up the routes of two RouteSets that have the same ID.
+
+    For each ID, routes of set1 are matched one to one with routes of set2
+    so that the total distance between matched routes is smallest. With
+    more routes on one side, the extra ones go unmatched.
+
+    params
+     - set1, set2: RouteSet
+     - metric: str - "hausdorff" or "frechet"; distances are in meters
+     - max_distance: float - leave pairs further apart than this unmatched;
+       routes with no points are never matched
+
+    return
+     - List[(int, int, float)] - route in set1, route in set2 and their
+       distance, for each pair, in set1 order
+    """
+
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}")
+    if len(set1) == 0 or len(set2) == 0:
+        return []
+    to_meters = projector(np.median(set1.points[:, 0]))
+    limit = np.inf if max_distance is None else max_distance
+
+    # Hausdorff distances between the alternatives of each ID; inf where
+    # either route has no points
+    groups, candidates = [], []
+    for route_id, routes1 in set1.alternatives.items():
+        routes2 = set2.alternatives.get(route_id)
+        if not routes2:
+            continue
+
+        points1 = [to_meters(set1.route(i)) for i in routes1]
+        points2 = [to_meters(set2.route(j)) for j in routes2]
+        distances = np.full((len(routes1), len(routes2)), np.inf)
+        with2 = [l for l, points in enumerate(points2) if len(points)]
+        if with2:
+            all2 = np.concatenate([points2[l] for l in with2])
+            offsets2 = np.concatenate(([0], np.cumsum([len(points2[l]) for l in with2])))
+            trees2 = {}
+            for k, points in enumerate(points1):
+                if len(points) == 0:
+                    continue
+                if len(points) * len(all2) <= DENSE_POINTS:
+                    distances[k, with2] = hausdorff_rows(points, all2, offsets2)
+                    continue
+                tree = cKDTree(points)
+                for l in with2:
+                    if l not in trees2:
+                        trees2[l] = cKDTree(points2[l])
+                    distances[k, l] = hausdorff(points, points2[l], tree, trees2[l])
+
+        if metric == "frechet":
+            # Hausdorff values must not stand in for Frechet ones
+            in_range = np.isfinite(distances) & (distances <= limit)
+            distances[~in_range] = np.inf
+            for k, l in zip(*np.nonzero(in_range)):
+                candidates.append((len(points1[k]), len(points2[l]), len(groups), k, l,
+                                   points1[k], points2[l]))
+        groups.append((routes1, routes2, distances))
+
+    # Frechet distances where Hausdorff did not rule them out, in batches of
+    # pairs of similar lengths so little goes to padding
+    candidates.sort(key=lambda candidate: candidate[:2])
+    for first in range(0, len(candidates), FRECHET_BATCH):
+        batch = candidates[first:first + FRECHET_BATCH]
+        frechet = discrete_frechet([c[5] for c in batch], [c[6] for c in batch])
+        for (_, _, group, k, l, _, _), distance in zip(batch, frechet):
+            groups[group][2][k, l] = distance
+
+    pairs = []
+    for routes1, routes2, distances in groups:
+        # a finite stand-in for unmatched or out of range, so the assignment
+        # is always solvable and makes as many pairs in range as it can
+        costs = np.where(np.isfinite(distances) & (distances <= limit), distances, 1e12)
+        for k, l in zip(*linear_sum_assignment(costs)):
+            if np.isfinite(distances[k, l]) and distances[k, l] <= limit:
+                pairs.append((routes1[k], routes2[l], float(distances[k, l])))
+
+    pairs.sort()
+    return pairs
@@ -0,0 +1,261 @@
+"""Compact on-disk store for sets of routes.
+
+A store is a directory holding
+ - coords.f8: every route's (latitude, longitude) points back to back, as
+   raw little-endian float64 pairs. It is memory-mapped when read.
+ - routes.csv: one row of metadata per route (ID, name, time, distance,
+   maneuvers and any extra columns), plus `start` and `count` locating the
+   route's points in coords.f8.
+
+Both files are append-only, so a store can be written one route at a time
+and, like the CSV output of get_routes, resumed with a Checkpoint.
+
+The older format is a CSV whose polyline_points column holds the repr of a
+list of (lat, lon) tuples. read_routes reads either format, and
+`python route_store.py <in> <out>` converts between them.
+"""
+
+import argparse
+import ast
+import csv
+import io
+import os
+
+import numpy as np
+
+import instrument
+
+
+ROUTE_FIELDS = ['ID', 'name', 'polyline_points', 'total_time_in_sec',
+                'total_distance_in_meters', 'number_of_steps', 'maneuvers']
+COORDS_FN = "coords.f8"
+ROUTES_FN = "routes.csv"
+COORD_DTYPE = np.dtype('<f8')
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, ROUTES_FN))
+
+
+def prefer_store(csv_fn):
+    """Return the store made from a routes CSV if there is one, else the CSV."""
+
+    store_path = os.path.splitext(csv_fn)[0] + ".routes"
+    return store_path if is_store(store_path) else csv_fn
+
+
+class RouteStoreWriter(object):
+
+    def __init__(self, path, fieldnames=ROUTE_FIELDS, append=False):
+        """Create a store, or open one to add routes to it.
+
+        params
+         - path: str - store directory, created if needed
+         - fieldnames: List[str] - route fields to keep; polyline_points
+           goes to coords.f8 (its routes.csv column is left empty) and
+           everything else to routes.csv
+         - append: bool - keep the routes already in the store
+        """
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        mode = 'a' if append else 'w'
+        self.coords_file = open(os.path.join(path, COORDS_FN), mode + 'b')
+        self.routes_file = open(os.path.join(path, ROUTES_FN), mode)
+        self.csvwriter = csv.DictWriter(self.routes_file, extrasaction='ignore',
+                                        fieldnames=self.fieldnames + ['start', 'count'])
+
+    @property
+    def files(self):
+        """Files to make durable together, e.g. by a Checkpoint."""
+        return [self.coords_file, self.routes_file]
+
+    def write(self, route):
+        """Add one route, a dict with polyline_points and metadata fields."""
+
+        # the header is (re)written whenever the file is empty, which is also
+        # the case after a Checkpoint truncates it back to nothing
+        if self.routes_file.tell() == 0:
+            self.csvwriter.writeheader()
+
+        points = route.get('polyline_points')
+        if points is None or len(points) == 0:
+            points = ()
+        points = np.asarray(points, dtype=COORD_DTYPE).reshape(-1, 2)
+        row = dict(route)
+        row['polyline_points'] = ""
+        row['start'] = self.coords_file.tell() // (2 * COORD_DTYPE.itemsize)
+        row['count'] = len(points)
+        self.coords_file.write(np.ascontiguousarray(points).tobytes())
+        self.csvwriter.writerow(row)
+
+    def close(self):
+        self.coords_file.close()
+        self.routes_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RouteStore(object):
+
+    def __init__(self, path):
+        """Open a store for reading; points are memory-mapped, not loaded."""
+
+        self.path = path
+        with open(os.path.join(path, ROUTES_FN), 'r') as fin:
+            csvreader = csv.DictReader(fin)
+            self.header = [field for field in csvreader.fieldnames
+                           if field not in ('start', 'count')]
+            self.rows = list(csvreader)
+
+        self.starts = np.array([int(row.pop('start')) for row in self.rows], dtype=np.int64)
+        self.counts = np.array([int(row.pop('count')) for row in self.rows], dtype=np.int64)
+        for row in self.rows:
+            row.pop('polyline_points', None)
+
+        coords_fn = os.path.join(path, COORDS_FN)
+        if os.path.getsize(coords_fn) == 0:
+            self.coords = np.empty((0, 2), dtype=COORD_DTYPE)
+        else:
+            self.coords = np.memmap(coords_fn, dtype=COORD_DTYPE, mode='r').reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def points(self, i):
+        """(latitude, longitude) points of route i, as a read-only view."""
+        return self.coords[self.starts[i]:self.starts[i] + self.counts[i]]
+
+    def __iter__(self):
+        for i, row in enumerate(self.rows):
+            route = dict(row)
+            route['polyline_points'] = self.points(i)
+            yield route
+
+
+def parse_points(polyline_points):
+    """Parse the CSV form "[(lat1, lon1), ...]" into a float64 array."""
+    return np.array(ast.literal_eval(polyline_points), dtype=COORD_DTYPE).reshape(-1, 2)
+
+
+def format_points(points):
+    """Format points the way the CSV form stores them."""
+    return str([tuple(point) for point in np.asarray(points).tolist()])
+
+
+def read_routes(path, parse=True):
+    """Read routes from a store or a CSV of routes.
+
+    params
+     - path: str - store directory or CSV file
+     - parse: bool - turn CSV polylines into arrays; if False, CSV rows keep
+       the polyline_points string as is (stores always give arrays)
+
+    return
+     - (header, generator of dict rows) - rows hold polyline_points as a
+       float64 array of (latitude, longitude) rows. A CSV polyline that
+       fails to parse is given as None.
+    """
+
+    if is_store(path):
+        store = RouteStore(path)
+        return store.header, iter(store)
+
+    fin = open(path, 'r')
+    csvreader = csv.DictReader(fin)
+    header = csvreader.fieldnames
+
+    def rows():
+        with fin:
+            for row in csvreader:
+                if not any(row.values()):  # every other row is empty, because Windows
+                    continue
+                if parse:
+                    try:
+                        row['polyline_points'] = parse_points(row['polyline_points'])
+                    except (ValueError, SyntaxError, TypeError):
+                        row['polyline_points'] = None
+                yield row
+
+    return header, rows()
+
+
+class RouteCSVWriter(object):
+
+    def __init__(self, path, fieldnames=ROUTE_FIELDS):
+        """Start a routes CSV, the same interface as RouteStoreWriter."""
+
+        self.path = path
+        self.fout = open(path, 'w')
+        self.csvwriter = csv.DictWriter(self.fout, fieldnames=fieldnames, extrasaction='ignore')
+        self.csvwriter.writeheader()
+        self._line = io.StringIO()
+        self._line_writer = csv.DictWriter(self._line, fieldnames=fieldnames, extrasaction='ignore')
+
+    def write(self, route):
+        if isinstance(route['polyline_points'], np.ndarray):
+            route = dict(route, polyline_points=format_points(route['polyline_points']))
+        self.csvwriter.writerow(route)
+
+    def format(self, route):
+        """The CSV line write would write for route, to write_line it to
+        several files with the same fields without formatting it again."""
+
+        self._line.seek(0)
+        self._line.truncate()
+        if isinstance(route['polyline_points'], np.ndarray):
+            route = dict(route, polyline_points=format_points(route['polyline_points']))
+        self._line_writer.writerow(route)
+        return self._line.getvalue()
+
+    def write_line(self, line):
+        self.fout.write(line)
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def route_writer(path, fieldnames=ROUTE_FIELDS):
+    """A RouteCSVWriter if path ends in .csv, else a RouteStoreWriter."""
+
+    if path.endswith(".csv"):
+        return RouteCSVWriter(path, fieldnames=fieldnames)
+    return RouteStoreWriter(path, fieldnames=fieldnames)
+
+
+def write_routes(path, header, routes):
+    """Write routes to a store directory, or to a CSV if path ends in .csv."""
+
+    with route_writer(path, fieldnames=header) as writer:
+        for route in routes:
+            writer.write(route)
+
+
+def main():
+    """Convert a CSV of routes to a store, or a store back to CSV."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="Routes CSV or store directory.")
+    parser.add_argument("output", help="Output store directory, or CSV if it ends in .csv.")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.metrics, script="route_store")
+
+    with instrument.span("convert_routes"):
+        header, routes = read_routes(args.input)
+        write_routes(args.output, header, routes)
+
+
+if __name__ == "__main__":
+    main()
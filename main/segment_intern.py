@@ -0,0 +1,141 @@
+"""Dense integer IDs for route segments.
+
+diff_segments works on segments, the edges between consecutive points of a
+route. Keyed by ((lon1, lat1), (lon2, lat2)) tuples, every lookup hashes
+four floats and every segment costs a few hundred bytes. A SegmentTable
+interns them instead:
+ - points: float64 (P, 2) array of unique (lon, lat) vertices
+ - edges: int32 (S, 2) array of the two point IDs of each unique segment
+so a route becomes an int32 array of segment IDs. IDs are given out in
+order of first appearance, the same order get_segments' dict keys come in.
+
+One table can intern any number of route sets, so their segment IDs can be
+compared directly, and it can be saved and loaded again so later runs give
+the same segments the same IDs. Optionally, a segment and its reverse
+(A -> B and B -> A) share one ID.
+"""
+
+import numpy as np
+
+
+def point_keys(points):
+    """One fixed-size bytes key per (x, y) point, equal iff the points are."""
+
+    # adding 0.0 turns -0.0 into 0.0, which compare equal as floats
+    points = np.ascontiguousarray(np.asarray(points, dtype=np.float64).reshape(-1, 2) + 0.0)
+    return points.view(np.dtype((np.void, 16))).ravel()
+
+
+def first_occurrence_ids(keys, known_keys):
+    """Give each key an ID: its index in known_keys if it is there, else new
+    IDs from len(known_keys) up in order of first appearance.
+
+    params
+     - keys: array - keys to look up
+     - known_keys: array - keys that already have IDs 0, 1, ...
+
+    return
+     - (ids, new_keys): int64 array of IDs for keys, and the keys given new
+       IDs, in ID order
+    """
+
+    all_keys = np.concatenate((known_keys, keys))
+    unique_keys, first, inverse = np.unique(all_keys, return_index=True, return_inverse=True)
+
+    # keys seen first among known_keys keep their IDs; the rest are numbered
+    # by where they first appear in keys
+    group_ids = np.empty(len(unique_keys), dtype=np.int64)
+    known = first < len(known_keys)
+    group_ids[known] = first[known]
+    new_groups = np.flatnonzero(~known)
+    new_groups = new_groups[np.argsort(first[new_groups], kind='stable')]
+    group_ids[new_groups] = len(known_keys) + np.arange(len(new_groups))
+
+    ids = group_ids[inverse.ravel()[len(known_keys):]]
+    return ids, unique_keys[new_groups]
+
+
+class SegmentTable(object):
+
+    def __init__(self, merge_reversed=False):
+        """An empty table.
+
+        params
+         - merge_reversed: bool - give a segment and its reverse the same ID;
+           the segment is stored the way round it was first seen
+        """
+
+        self.merge_reversed = merge_reversed
+        self.points = np.empty((0, 2), dtype=np.float64)
+        self.edges = np.empty((0, 2), dtype=np.int32)
+        self._point_keys = point_keys(self.points)
+        self._edge_keys = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def edge_keys(self, starts, ends):
+        if self.merge_reversed:
+            starts, ends = np.minimum(starts, ends), np.maximum(starts, ends)
+        return (starts.astype(np.int64) << 32) | ends.astype(np.int64)
+
+    def intern(self, routes):
+        """Get the segment IDs of routes, adding new segments to the table.
+
+        params
+         - routes: List[array (n, 2)] - points of each route
+
+        return
+         - (segment_ids, offsets): segment_ids is an int32 array of every
+           route's segments back to back; those of route i are
+           segment_ids[offsets[i]:offsets[i + 1]]
+        """
+
+        counts = np.array([len(route) for route in routes], dtype=np.int64)
+        point_offsets = np.concatenate(([0], np.cumsum(counts)))
+        if point_offsets[-1] == 0:
+            return np.empty(0, dtype=np.int32), np.zeros(len(routes) + 1, dtype=np.int64)
+        points = np.concatenate([np.asarray(route, dtype=np.float64).reshape(-1, 2)
+                                 for route in routes])
+
+        point_ids, new_point_keys = first_occurrence_ids(point_keys(points), self._point_keys)
+        if len(new_point_keys):
+            self._point_keys = np.concatenate((self._point_keys, new_point_keys))
+            self.points = np.concatenate((self.points, new_point_keys.view(np.float64).reshape(-1, 2)))
+
+        # a segment joins each point to the next one in the same route
+        starts = np.ones(len(points), dtype=bool)
+        starts[point_offsets[1:] - 1] = False
+        starts = np.flatnonzero(starts)
+        edge_starts, edge_ends = point_ids[starts], point_ids[starts + 1]
+
+        segment_ids, new_edge_keys = first_occurrence_ids(self.edge_keys(edge_starts, edge_ends),
+                                                          self._edge_keys)
+        if len(new_edge_keys):
+            # store new segments the way round they were first seen
+            _, first = np.unique(segment_ids, return_index=True)
+            first = first[-len(new_edge_keys):]
+            self._edge_keys = np.concatenate((self._edge_keys, new_edge_keys))
+            self.edges = np.concatenate(
+                (self.edges, np.column_stack((edge_starts[first], edge_ends[first])).astype(np.int32)))
+
+        offsets = np.concatenate(([0], np.cumsum(np.maximum(counts - 1, 0))))
+        return segment_ids.astype(np.int32), offsets
+
+    def coords(self, segment_ids):
+        """float64 array (n, 2, 2): the two (lon, lat) points of each segment."""
+        return self.points[self.edges[np.asarray(segment_ids)]]
+
+    def save(self, fn):
+        np.savez(fn, points=self.points, edges=self.edges,
+                 merge_reversed=np.array(self.merge_reversed))
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            table = cls(merge_reversed=bool(data['merge_reversed']))
+            table.points = data['points']
+            table.edges = data['edges']
+        table._point_keys = point_keys(table.points)
+        table._edge_keys = table.edge_keys(table.edges[:, 0], table.edges[:, 1])
+        return table
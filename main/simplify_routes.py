@@ -0,0 +1,157 @@
+"""Simplify routes and snap their vertices before diffing segments.
+
+Google and GraphHopper put slightly different vertices along the same road,
+so one street turns into several near-duplicate segments in diff_segments.
+This stage:
+ 1. simplifies every route with Douglas-Peucker,
+ 2. optionally moves each vertex to the nearest node of a reference set
+    (e.g. the points of a saved SegmentTable) within a tolerance,
+ 3. optionally rounds each vertex to a grid,
+ 4. drops vertices that now repeat the one before them,
+so routes along the same road share vertices, and so segments. All routes
+are handled at once as one flat array of points. Distances and tolerances
+are in degrees, like the coordinates.
+"""
+
+import time
+
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+from segment_intern import SegmentTable
+
+
+def flatten(routes):
+    """(points, offsets): every route's (lon, lat) points back to back; those
+    of route i are points[offsets[i]:offsets[i + 1]]."""
+
+    counts = [len(route) for route in routes]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    if offsets[-1] == 0:
+        return np.empty((0, 2), dtype=np.float64), offsets
+    points = np.concatenate([np.asarray(route, dtype=np.float64).reshape(-1, 2)
+                             for route in routes])
+    return points, offsets
+
+
+def route_of_points(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def douglas_peucker(points, offsets, tolerance):
+    """Simplify every route with at least two points; return (points, offsets)."""
+
+    counts = np.diff(offsets)
+    route = route_of_points(offsets)
+    is_line = counts >= 2
+    if tolerance <= 0 or not is_line.any():
+        return points, offsets
+
+    # shapely wants line indices 0, 1, ... without gaps
+    line_routes = np.flatnonzero(is_line)
+    line_number = np.cumsum(is_line) - 1
+    on_line = is_line[route]
+    lines = shapely.linestrings(points[on_line], indices=line_number[route[on_line]])
+    simplified = shapely.simplify(lines, tolerance, preserve_topology=False)
+    coords, index = shapely.get_coordinates(simplified, return_index=True)
+
+    # a closed loop can simplify away entirely; keep its endpoints then
+    kept = np.bincount(index, minlength=len(lines))
+    if (kept < 2).any():
+        collapsed = np.flatnonzero(kept < 2)
+        first = offsets[line_routes[collapsed]]
+        last = offsets[line_routes[collapsed] + 1] - 1
+        keep = np.isin(index, collapsed, invert=True)
+        coords = np.concatenate((coords[keep], points[first], points[last]))
+        index = np.concatenate((index[keep], collapsed, collapsed))
+
+    # put the simplified lines back among the routes too short to simplify
+    new_route = np.concatenate((route[~on_line], line_routes[index]))
+    order = np.argsort(new_route, kind='stable')
+    points = np.concatenate((points[~on_line], coords))[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(new_route, minlength=len(counts)))))
+    return points, offsets
+
+
+def snap_to_nodes(points, nodes, tolerance):
+    """Move each point to the nearest node no more than tolerance away."""
+
+    if len(points) == 0 or len(nodes) == 0:
+        return points
+    distances, nearest = cKDTree(nodes).query(points, distance_upper_bound=tolerance)
+    found = np.isfinite(distances)
+    points = points.copy()
+    points[found] = nodes[nearest[found]]
+    return points
+
+
+def snap_to_grid(points, grid_size):
+    # the second rounding drops the float noise of multiplying back
+    return np.round(np.rint(points / grid_size) * grid_size, 10)
+
+
+def drop_repeats(points, offsets):
+    """Drop points equal to the point before them in the same route."""
+
+    route = route_of_points(offsets)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1) | (route[1:] != route[:-1])
+    counts = np.bincount(route[keep], minlength=len(offsets) - 1)
+    return points[keep], np.concatenate(([0], np.cumsum(counts)))
+
+
+def count_segments(route_sets):
+    """Number of distinct segments used by all the routes of route_sets."""
+
+    table = SegmentTable()
+    for routes in route_sets:
+        table.intern(list(routes.values()))
+    return len(table)
+
+
+def simplify_routes(route_sets, tolerance=0.0, grid_size=0.0, nodes=None, node_tolerance=0.0001,
+                    verbose=True):
+    """Simplify and snap several sets of routes together.
+
+    params
+     - route_sets: List[Dict{str : array (n, 2)}] - (lon, lat) routes by ID
+     - tolerance: float - Douglas-Peucker tolerance; 0 to not simplify
+     - grid_size: float - grid to round vertices to; 0 to not round
+     - nodes: array (m, 2) - reference (lon, lat) nodes to snap to, or None
+     - node_tolerance: float - furthest a vertex is moved to a node
+     - verbose: bool - print how much the segments shrank, and how fast
+
+    return
+     - (route_sets, stats): route_sets with float64 (n, 2) arrays in
+       place of the routes, and a dict of point and segment counts before
+       and after, and the seconds taken
+    """
+
+    ids = [list(routes) for routes in route_sets]
+    points, offsets = flatten([routes[route_id] for routes, route_ids in zip(route_sets, ids)
+                               for route_id in route_ids])
+    stats = {'points_before': len(points), 'segments_before': count_segments(route_sets)}
+
+    start = time.perf_counter()
+    points, offsets = douglas_peucker(points, offsets, tolerance)
+    if nodes is not None:
+        points = snap_to_nodes(points, np.asarray(nodes, dtype=np.float64), node_tolerance)
+    if grid_size > 0:
+        points = snap_to_grid(points, grid_size)
+    points, offsets = drop_repeats(points, offsets)
+    stats['seconds'] = time.perf_counter() - start
+
+    simplified, n = [], 0
+    for route_ids in ids:
+        simplified.append({route_id: points[offsets[n + i]:offsets[n + i + 1]]
+                           for i, route_id in enumerate(route_ids)})
+        n += len(route_ids)
+
+    stats['points_after'] = len(points)
+    stats['segments_after'] = count_segments(simplified)
+    if verbose:
+        print(f"Simplified routes from {stats['points_before']} to {stats['points_after']} points " +
+              f"and {stats['segments_before']} to {stats['segments_after']} segments " +
+              f"in {stats['seconds']:.2f} s")
+    return simplified, stats
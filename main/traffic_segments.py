@@ -0,0 +1,132 @@
+"""Compiled, memory-mapped table of City of Chicago traffic segment geometry.
+
+poly1.txt (see get_traffic_data.py) is a JavaScript object literal mapping
+segment IDs to polylines. Parsing it is slow and it never changes, so it is
+compiled once into a directory of .npy files:
+ - ids.npy: segment IDs, sorted
+ - offsets.npy: points of segment ids[i] are coords[offsets[i]:offsets[i + 1]]
+ - coords.npy: float64 (x, y), i.e. (lon, lat), points of all segments
+ - source.sha256: hash of the poly1.txt the table was built from
+
+The table is rebuilt automatically whenever the hash of poly1.txt changes.
+"""
+
+import hashlib
+import os
+import re
+
+import numpy as np
+
+
+POINT_RE = re.compile(r"x:\s*([-+0-9.eE]+)\s*,\s*y:\s*([-+0-9.eE]+)")
+TABLE_FILES = ["ids.npy", "offsets.npy", "coords.npy"]
+
+
+def file_hash(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def parse_poly1_lines(lines):
+    """Parse poly1.txt lines into (segment ID, List[(x, y)]) pairs.
+
+    Line format:
+    111:[[{x:-87.aa,y:41.bb}, {x:-87.cc,y:41.dd}, ...]],
+    so everything before the first ":" is the segment ID, and the points are
+    pulled out of the rest of the line with one regular expression.
+    """
+
+    lines = iter(lines)
+    assert next(lines).strip() == "["
+    assert next(lines).strip() == "{"
+
+    for line in lines:
+        # Last line
+        if line.strip() == "}":
+            break
+
+        segment_id, rest = line.split(":", 1)
+        points = [(float(x), float(y)) for x, y in POINT_RE.findall(rest)]
+        yield int(segment_id), points
+
+
+def compile_poly1(poly1_fname, table_dir):
+    """Compile poly1.txt into a segment table in table_dir."""
+
+    # later entries for the same ID replace earlier ones
+    segments = {}
+    with open(poly1_fname) as poly1:
+        for segment_id, points in parse_poly1_lines(poly1):
+            segments[segment_id] = points
+
+    ids = np.array(sorted(segments), dtype=np.int64)
+    counts = np.array([len(segments[segment_id]) for segment_id in ids], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    coords = np.array([point for segment_id in ids for point in segments[segment_id]],
+                      dtype=np.float64).reshape(-1, 2)
+
+    # the hash goes last, so a half-written table is never mistaken for a
+    # complete one
+    os.makedirs(table_dir, exist_ok=True)
+    hash_fname = os.path.join(table_dir, "source.sha256")
+    if os.path.exists(hash_fname):
+        os.remove(hash_fname)
+    for fname, array in zip(TABLE_FILES, [ids, offsets, coords]):
+        np.save(os.path.join(table_dir, fname), array)
+    with open(hash_fname, 'w') as fout:
+        fout.write(file_hash(poly1_fname))
+
+
+class TrafficSegments(object):
+    """Read-only mapping of segment ID to a float64 array of (x, y) points."""
+
+    def __init__(self, table_dir):
+        self.ids, self.offsets, self.coords = [
+            np.load(os.path.join(table_dir, fname), mmap_mode='r') for fname in TABLE_FILES]
+
+    @classmethod
+    def from_poly1(cls, poly1_fname, table_dir=None):
+        """Load the table for poly1_fname, compiling it first if it is stale."""
+
+        if table_dir is None:
+            table_dir = os.path.splitext(poly1_fname)[0] + ".table"
+
+        hash_fname = os.path.join(table_dir, "source.sha256")
+        stale = True
+        if os.path.exists(hash_fname):
+            with open(hash_fname) as fin:
+                stale = fin.read().strip() != file_hash(poly1_fname)
+
+        if stale:
+            compile_poly1(poly1_fname, table_dir)
+        return cls(table_dir)
+
+    def index(self, segment_id):
+        i = int(np.searchsorted(self.ids, segment_id))
+        if i == len(self.ids) or self.ids[i] != segment_id:
+            raise KeyError(segment_id)
+        return i
+
+    def __getitem__(self, segment_id):
+        i = self.index(segment_id)
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, segment_id):
+        try:
+            self.index(segment_id)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def items(self):
+        for i, segment_id in enumerate(self.ids.tolist()):
+            yield segment_id, self.coords[self.offsets[i]:self.offsets[i + 1]]
@@ -0,0 +1,144 @@
+"""Append-only, compressed time series of traffic segment colors.
+
+Each snapshot of the traffic feeds is stored as the changes since the
+previous snapshot: the segments whose color changed and their new color
+(NONE when a segment dropped out of the feeds). A record on disk is
+
+    <float64 timestamp> <uint32 payload length> <zlib payload>
+
+where the payload is an int32 array of segment IDs followed by a uint8
+array of their new color codes. A record cut short by a crash is ignored
+when reading and overwritten by the next append.
+
+On load, the changes are indexed per segment, so the color of a segment at
+any time takes one binary search: O(log n) in the number of changes.
+"""
+
+import os
+import struct
+import zlib
+
+from bisect import bisect_right
+
+
+NONE = 0
+COLOR_CODES = {'green': 1, 'yellow': 2, 'red': 3}
+COLOR_NAMES = {code: color for color, code in COLOR_CODES.items()}
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class TrafficStore(object):
+
+    def __init__(self, store_fn):
+        """Open (or create) a store and index the snapshots already in it."""
+
+        self.store_fn = store_fn
+        self.times = []  # snapshot timestamps
+        self.current = {}  # segment ID : color code as of the last snapshot
+        self.changes = {}  # segment ID : ([timestamps], [color codes])
+
+        size = 0
+        if os.path.exists(store_fn):
+            with open(store_fn, 'rb') as fin:
+                data = fin.read()
+            size = self._load(data)
+
+        self.fout = open(store_fn, 'ab')
+        self.fout.truncate(size)
+
+    def _load(self, data):
+        """Index every complete record; return the size they take up."""
+
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+            end = pos + RECORD_HEADER.size + length
+            if end > len(data):
+                break
+
+            try:
+                payload = zlib.decompress(data[pos + RECORD_HEADER.size:end])
+            except zlib.error:
+                break
+
+            count = len(payload) // 5
+            segment_ids = struct.unpack('<%di' % count, payload[:4 * count])
+            codes = payload[4 * count:]
+            self._index(timestamp, zip(segment_ids, codes))
+            pos = end
+
+        return pos
+
+    def _index(self, timestamp, delta):
+        self.times.append(timestamp)
+        for segment_id, code in delta:
+            self.current[segment_id] = code
+            times, codes = self.changes.setdefault(segment_id, ([], []))
+            times.append(timestamp)
+            codes.append(code)
+
+    def append(self, timestamp, all_roads):
+        """Add a snapshot.
+
+        params
+         - timestamp: float - seconds since the epoch; must not go backwards
+         - all_roads: Dict[str : List[int]] - segment IDs for each color,
+           as returned by get_traffic_data.get_all_data
+        """
+
+        if self.times and timestamp < self.times[-1]:
+            raise ValueError("Snapshots must be appended in time order")
+
+        snapshot = {}
+        for color, roads in all_roads.items():
+            for road_id in roads or []:
+                snapshot[road_id] = COLOR_CODES[color]
+
+        delta = [(segment_id, code) for segment_id, code in snapshot.items()
+                 if self.current.get(segment_id, NONE) != code]
+        delta.extend((segment_id, NONE) for segment_id, code in self.current.items()
+                     if code != NONE and segment_id not in snapshot)
+        delta.sort()
+
+        payload = (struct.pack('<%di' % len(delta), *[segment_id for segment_id, _ in delta]) +
+                   bytes(code for _, code in delta))
+        payload = zlib.compress(payload)
+        self.fout.write(RECORD_HEADER.pack(timestamp, len(payload)) + payload)
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+
+        self._index(timestamp, delta)
+        return len(delta)
+
+    def color_at(self, segment_id, t):
+        """Color of a segment at time t, or None if it was not reported.
+
+        Uses the latest snapshot taken at or before t.
+        """
+
+        times, codes = self.changes.get(segment_id, ((), ()))
+        i = bisect_right(times, t)
+        if i == 0:
+            return None
+        return COLOR_NAMES.get(codes[i - 1])
+
+    def snapshot_at(self, t):
+        """Colors of all segments at time t, as Dict[int : str]."""
+
+        colors = {}
+        for segment_id in self.changes:
+            color = self.color_at(segment_id, t)
+            if color is not None:
+                colors[segment_id] = color
+        return colors
+
+    def roads_at(self, t):
+        """Segment IDs for each color at time t, shaped like get_all_data's."""
+
+        all_roads = {color: [] for color in COLOR_CODES}
+        for segment_id, color in self.snapshot_at(t).items():
+            all_roads[color].append(segment_id)
+        return all_roads
+
+    def close(self):
+        self.fout.close()